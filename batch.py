@@ -0,0 +1,136 @@
+import numpy as np
+
+from tak import State, Player, Result, evaluate_easy, evaluate_medium, evaluate_hard
+from bitboard import BitboardState
+from utils import get_geometry
+
+# Batched leaf evaluation: the leaves of the search are encoded into rows of NumPy arrays (one element per
+# square) and the heuristics of State.evaluate are computed for every row at once with vectorized operations.
+# Neighbourhoods and lines are represented by 0/1 matrices, so that counting the neighbours (or the pieces in
+# each row and column) of every square is a matrix product.
+
+# Difficulty level used by each of the evaluation functions (see State.evaluate)
+evaluation_levels = {
+    evaluate_easy: 1,
+    evaluate_medium: 2,
+    evaluate_hard: 3
+}
+
+def evaluation_level(evaluation_function) -> int:
+    '''Returns the level of the given evaluation function, which must be one of the functions defined in tak'''
+    if evaluation_function not in evaluation_levels:
+        raise ValueError('Batched evaluation is only available for evaluate_easy, evaluate_medium and evaluate_hard')
+    return evaluation_levels[evaluation_function]
+
+class LeafBatch:
+    '''
+    Preallocated arrays holding up to capacity game states of the same board size. States are added one at a
+    time (their contents are copied, so a move can be undone right after adding the resulting state) and are
+    then evaluated together.
+    '''
+
+    # Masks stored for each state
+    WHITE, BLACK, WALLS, CAPS = range(4)
+
+    def __init__(self, board_size: int, capacity: int):
+        geometry = get_geometry(board_size)
+        squares = board_size * board_size
+
+        self.board_size = board_size
+        self.capacity = capacity
+        self.count = 0
+
+        self.masks = np.zeros((capacity, 4), dtype=np.uint64)
+        self.heights = np.zeros((capacity, squares), dtype=np.int64)
+        self.black_pieces = np.zeros((capacity, squares), dtype=np.int64)
+        self.players = np.zeros(capacity, dtype=np.int64)
+
+        # Finished games are not evaluated by the heuristics (winner is 0 for a draw)
+        self.finished = np.zeros(capacity, dtype=bool)
+        self.winners = np.zeros(capacity, dtype=np.int64)
+
+        self.shifts = np.arange(squares, dtype=np.uint64)
+
+        # adjacency[i][j] is 1 if squares i and j are neighbours, lines[i][k] is 1 if square i belongs to line k
+        self.adjacency = np.array([[neighbours >> sq & 1 for sq in range(squares)] for neighbours in geometry.neighbours], dtype=np.int64)
+        self.lines = np.array([[line >> sq & 1 for line in geometry.lines] for sq in range(squares)], dtype=np.int64)
+
+    def clear(self):
+        '''Removes every state from the batch'''
+        self.count = 0
+
+    def is_full(self) -> bool:
+        return self.count == self.capacity
+
+    def add(self, state: State):
+        '''Adds a state to the batch, to be evaluated for the player to move'''
+        if not isinstance(state, BitboardState):
+            state = BitboardState.from_state(state)
+
+        i = self.count
+        self.count += 1
+
+        self.masks[i] = (state.white, state.black, state.walls, state.caps)
+        self.heights[i] = state.heights
+        self.black_pieces[i] = [stack.bit_count() for stack in state.stacks]
+        self.players[i] = state.current_player
+
+        result = state.objective()
+        self.finished[i] = result != Result.NOT_FINISHED
+        self.winners[i] = Player.WHITE if result == Result.WHITE_WIN else Player.BLACK if result == Result.BLACK_WIN else 0
+
+    def evaluate(self, depth: int, level: int = 3) -> np.ndarray:
+        '''Returns the evaluation of every state in the batch (same values as State.evaluate)'''
+        n = self.count
+        adjacency = self.adjacency
+
+        bits = ((self.masks[:n, :, None] >> self.shifts) & np.uint64(1)).astype(np.int64)
+        white, black, walls, caps = bits[:, LeafBatch.WHITE], bits[:, LeafBatch.BLACK], bits[:, LeafBatch.WALLS], bits[:, LeafBatch.CAPS]
+
+        heights = self.heights[:n]
+        black_pieces = self.black_pieces[:n]
+        players = self.players[:n]
+
+        flats = 1 - walls - caps
+        empty = 1 - white - black
+        colors = white - black
+
+        num_flats = players * ((white * flats).sum(axis=1) - (black * flats).sum(axis=1))
+
+        tall = heights > 1
+        captured = players * (tall * np.where(white == 1, black_pieces, black_pieces - heights)).sum(axis=1)
+
+        influence = 0
+        for color, own, opponent in ((Player.WHITE, white, black), (Player.BLACK, black, white)):
+            influenced = empty + own
+            # Protected stacks also influence adjacent opposing flats
+            influenced_protected = influenced + opponent * flats
+
+            protected = (own @ adjacency) > 0
+            count = own * np.where(protected, influenced_protected @ adjacency, influenced @ adjacency)
+            influence = influence + color * count.sum(axis=1)
+        influence = players * influence
+
+        value = 10 * num_flats + 2 * captured + 2 * influence
+
+        if level >= 2:
+            opponent_caps = caps * np.where(players[:, None] == Player.WHITE, black, white)
+            single_walls = walls * (heights == 1)
+            value -= players * (single_walls * colors * (opponent_caps @ adjacency)).sum(axis=1)
+
+        if level == 3:
+            lines = self.lines
+            value += players * ((white @ lines).max(axis=1) - (black @ lines).max(axis=1))
+
+        # Finished games
+        winners = self.winners[:n] * players
+        terminal = np.where(winners > 0, int(1e9) + depth, np.where(winners < 0, int(-1e9) - depth, 0))
+
+        return np.where(self.finished[:n], terminal, value)
+
+def evaluate_batch(states: list, depth: int, level: int = 3) -> np.ndarray:
+    '''Evaluates a list of states of the same board size for their players to move'''
+    batch = LeafBatch(states[0].board_size, len(states))
+    for state in states:
+        batch.add(state)
+    return batch.evaluate(depth, level)
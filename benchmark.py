@@ -0,0 +1,252 @@
+from typing import Callable
+import argparse
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from tak import State, Result, flats_for_size, capstones_for_size, evaluate_hard
+from bitboard import BitboardState
+from search import Search, SearchStats
+from transposition import pack_move, unpack_move
+
+# Benchmark suite: every search configuration searches the same fixed positions (the corpus, a few positions of each
+# board size and phase of the game), so the results of different versions of the engine can be compared. The corpus
+# is stored as the moves that lead to each position (see transposition.pack_move) and was generated once by
+# build_corpus. Each position is searched by a new Search (with an empty transposition table) with iterative
+# deepening up to a fixed depth, which makes the number of nodes deterministic: a different number of nodes means
+# that the search itself changed, not only its speed.
+#
+# Results are written as JSON and can be compared with a baseline (the results of a previous version, measured on
+# the same machine), reporting the configurations that became slower (or use more memory) by more than a threshold.
+
+BENCHMARK_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+CORPUS_PATH = os.path.join(BENCHMARK_DIRECTORY, 'corpus.json')
+BASELINE_PATH = os.path.join(BENCHMARK_DIRECTORY, 'baseline.json')
+
+# Phases of the game, given by the fraction of the pieces of both players that have been placed
+PHASES = {
+    'opening': 0.1,
+    'middlegame': 0.35,
+    'endgame': 0.6
+}
+
+# Depth searched on each board size (deep enough for move ordering and the transposition table to matter)
+DEPTHS = { 3: 6, 4: 4, 5: 4, 6: 3 }
+
+# Search configurations (arguments of Search) measured by the benchmark
+CONFIGURATIONS = {
+    'default': {},
+    'no_ordering': { 'ordering': False },
+    'no_caching': { 'caching': False },
+    'canonical': { 'canonical': True },
+    'batch': { 'batch_size': 64 }
+}
+
+# Relative slowdown (or increase in memory) above which a configuration is reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+def load_corpus(path: str = CORPUS_PATH) -> list:
+    '''Returns the positions of the corpus as a list of (name, board size, phase, moves)'''
+    with open(path) as file:
+        corpus = json.load(file)
+    return [(position['name'], position['board_size'], position['phase'], [unpack_move(code) for code in position['moves']])
+        for position in corpus['positions']]
+
+def corpus_state(board_size: int, moves: list, state_class: type = BitboardState) -> State:
+    '''Returns the state reached by playing the given moves from the initial position'''
+    state = state_class(board_size)
+    for move in moves:
+        move.apply(state)
+    return state
+
+def build_corpus(sizes: list, positions_per_phase: int = 2, seed: int = 0, randomness: float = 0.5) -> list:
+    '''
+    Generates the positions of the corpus by playing games in which each move is either random (with the given
+    probability) or the best move of a shallow search, returning them in the format of load_corpus
+    '''
+    rng = random.Random(seed)
+    search = Search(evaluate_hard, caching=False)
+    positions = []
+
+    for board_size in sizes:
+        pieces = 2 * (flats_for_size[board_size] + capstones_for_size[board_size])
+
+        for phase, fraction in PHASES.items():
+            plies = max(1, round(fraction * pieces))
+            found = 0
+
+            while found < positions_per_phase:
+                state = State(board_size)
+                moves = []
+
+                while len(moves) < plies and state.objective() == Result.NOT_FINISHED:
+                    move = rng.choice(state.possible_moves()) if rng.random() < randomness else search.negamax(state, 1)
+                    moves.append(move)
+                    move.apply(state)
+
+                # Games that ended too soon are discarded
+                if state.objective() == Result.NOT_FINISHED:
+                    positions.append((f'{board_size}-{phase}-{found}', board_size, phase, moves))
+                    found += 1
+
+    return positions
+
+def write_corpus(positions: list, path: str = CORPUS_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    corpus = { 'positions': [{ 'name': name, 'board_size': board_size, 'phase': phase, 'moves': [pack_move(move) for move in moves] }
+        for name, board_size, phase, moves in positions] }
+
+    with open(path, 'w') as file:
+        json.dump(corpus, file, indent=1)
+
+def benchmark_position(state: State, depth: int, configuration: dict, evaluation_function: Callable = evaluate_hard,
+        memory: bool = True) -> dict:
+    '''
+    Searches the given state with iterative deepening up to the given depth, returning the number of nodes, the
+    time and the time at which each depth was completed. The statistics of the search (the fraction of nodes found in
+    the transposition table, the effective branching factors and the first move cutoff rate) and, optionally, the peak
+    memory allocated during the search are measured by a second search, so that the first one is uninstrumented.
+    '''
+    search = Search(evaluation_function, **configuration)
+    depth_times = []
+
+    def record_depth(search: Search):
+        # The callback is also called during the search, but the completed depth only changes after each depth
+        if search.completed_depth > len(depth_times):
+            depth_times.append(time.time() - search.start_time)
+        return False
+
+    search.callback = record_depth
+    search.iterative_deepening(state.copy(), float('inf'), depth)
+    elapsed = time.time() - search.start_time
+    nodes = search.nodes_searched()
+
+    result = {
+        'nodes': nodes,
+        'time': elapsed,
+        'nodes_per_second': nodes / elapsed if elapsed > 0 else 0,
+        'time_to_depth': depth_times
+    }
+
+    # The table is allocated before tracing starts, so only the memory allocated by the search itself is measured
+    stats = SearchStats(timing=False)
+    search = Search(evaluation_function, stats=stats, **configuration)
+    if memory:
+        tracemalloc.start()
+
+    search.iterative_deepening(state.copy(), float('inf'), depth)
+
+    if memory:
+        result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result['cache_hit_rate'] = stats.cache_hit_rate()
+    result['branching_factors'] = stats.branching_factors()
+    result['first_move_cutoff_rate'] = stats.first_move_cutoff_rate()
+    return result
+
+def run_benchmark(corpus: list, configurations: dict = CONFIGURATIONS, sizes: list = None, memory: bool = True,
+        verbose: bool = False) -> dict:
+    '''Benchmarks each configuration on every position of the corpus (optionally, only the positions of the given sizes)'''
+    results = {}
+
+    for name, configuration in configurations.items():
+        positions = {}
+
+        for position_name, board_size, phase, moves in corpus:
+            if sizes is not None and board_size not in sizes:
+                continue
+
+            state = corpus_state(board_size, moves)
+            positions[position_name] = benchmark_position(state, DEPTHS[board_size], configuration, memory=memory)
+
+            if verbose:
+                result = positions[position_name]
+                print(f'{name}, {position_name}: {result["nodes"]} nodes in {result["time"]:.2f}s ({result["nodes_per_second"]:.0f} nodes/s)')
+
+        nodes = sum(result['nodes'] for result in positions.values())
+        elapsed = sum(result['time'] for result in positions.values())
+        results[name] = {
+            'positions': positions,
+            'total': { 'nodes': nodes, 'time': elapsed, 'nodes_per_second': nodes / elapsed if elapsed > 0 else 0 }
+        }
+
+    return results
+
+def compare_results(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD):
+    '''
+    Compares the results of a benchmark with a baseline, returning the regressions (configurations that became slower
+    or use more memory by more than the threshold) and the positions whose number of nodes changed. The times of
+    single positions are too noisy to be compared, so each configuration is compared by its total time and peak
+    memory over the positions that are in both results.
+    '''
+    regressions, changes = [], []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        positions, base_positions = result['positions'], baseline[name]['positions']
+        common = [position_name for position_name in positions if position_name in base_positions]
+
+        for position_name in common:
+            if positions[position_name]['nodes'] != base_positions[position_name]['nodes']:
+                changes.append(f'{name}, {position_name}: {positions[position_name]["nodes"]} nodes (baseline {base_positions[position_name]["nodes"]})')
+
+        elapsed = sum(positions[position_name]['time'] for position_name in common)
+        base_elapsed = sum(base_positions[position_name]['time'] for position_name in common)
+        if elapsed > (1 + threshold) * base_elapsed:
+            regressions.append(f'{name}: {elapsed:.2f}s (baseline {base_elapsed:.2f}s)')
+
+        measured = [position_name for position_name in common if 'peak_memory' in positions[position_name] and 'peak_memory' in base_positions[position_name]]
+        if measured:
+            memory = max(positions[position_name]['peak_memory'] for position_name in measured)
+            base_memory = max(base_positions[position_name]['peak_memory'] for position_name in measured)
+            if memory > (1 + threshold) * base_memory:
+                regressions.append(f'{name}: {memory} bytes of peak memory (baseline {base_memory})')
+
+    return regressions, changes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the search configurations on a fixed set of positions')
+    parser.add_argument('sizes', type=int, nargs='*', default=list(DEPTHS), help='board sizes (all of the corpus by default)')
+    parser.add_argument('--configurations', nargs='*', default=list(CONFIGURATIONS), help='configurations benchmarked (see CONFIGURATIONS)')
+    parser.add_argument('--output', help='file where the results are written (as JSON)')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='results the benchmark is compared with')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file instead of comparing them')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='relative slowdown reported as a regression')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure the peak memory of the searches")
+    parser.add_argument('--build-corpus', action='store_true', help='generate the corpus again (which changes every position)')
+    args = parser.parse_args()
+
+    if args.build_corpus:
+        write_corpus(build_corpus(sorted(DEPTHS)))
+
+    configurations = { name: CONFIGURATIONS[name] for name in args.configurations }
+    results = run_benchmark(load_corpus(), configurations, args.sizes, not args.no_memory, verbose=True)
+
+    for name, result in results.items():
+        total = result['total']
+        print(f'{name}: {total["nodes"]} nodes in {total["time"]:.2f}s ({total["nodes_per_second"]:.0f} nodes/s)')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions, changes = compare_results(results, json.load(file), args.threshold)
+
+        for change in changes:
+            print(f'Different search: {change}')
+        for regression in regressions:
+            print(f'Regression: {regression}')
+
+        exit(1 if regressions else 0)
@@ -0,0 +1,672 @@
+from array import array
+from typing import List
+
+from tak import State, Piece, PieceType, Player, Result, \
+    flats_for_size, capstones_for_size, max_height, piece_variant, get_move_table, PLACEMENT_TYPES
+from utils import Position, get_geometry, NUM_SYMMETRIES
+from zobrist import get_zobrist_keys, NUM_VARIANTS
+
+# Squares are numbered in row-major order, so square (row, col) corresponds to bit row * board_size + col
+# of every mask (see utils.Geometry). Stacks are stored as two integers per square: the height and the colors of its pieces
+# (bit i is set if the i-th piece counting from the bottom is black). Only the top piece of a stack can
+# be a wall or a capstone, so piece types are kept in the top masks (walls and caps).
+
+class BitboardState(State):
+    '''
+    Alternative game state backed by integer bitboards. It exposes the same interface as State
+    (including a derived board attribute), so it can be used by the negamax search, the moves and
+    the server without any changes, while move generation, road detection and the heuristics only
+    use bitwise operations.
+    '''
+
+    def __init__(self, board_size = 5):
+        self.first_turn = True
+        self.current_player = Player.WHITE
+        self.board_size = board_size
+        self.geometry = get_geometry(board_size)
+        self.move_table = get_move_table(board_size)
+
+        self.heights = [0] * (board_size * board_size)
+        self.stacks = [0] * (board_size * board_size)
+
+        # Top masks
+        self.white = 0
+        self.black = 0
+        self.walls = 0
+        self.caps = 0
+
+        self.num_flats = {
+            Player.WHITE: flats_for_size[board_size],
+            Player.BLACK: flats_for_size[board_size]
+        }
+        self.num_caps = {
+            Player.WHITE: capstones_for_size[board_size],
+            Player.BLACK: capstones_for_size[board_size]
+        }
+
+        self.zobrist = get_zobrist_keys(board_size, max_height(board_size))
+        self.hash = self.zobrist.first_turn
+
+        self.result = Result.NOT_FINISHED
+        self.previous_results = []
+
+        # Running totals of the evaluation terms and the contribution of each square to them (see _update_terms). The
+        # contributions are from white's point of view, and penalties[player] holds the wall penalties when evaluating
+        # for the given player (which depend on the capstones of the opponent)
+        num_squares = board_size * board_size
+        self.captured = [0] * num_squares
+        self.captured_total = 0
+        self.influence = [0] * num_squares
+        self.influence_total = 0
+        self.penalties = { Player.WHITE: [0] * num_squares, Player.BLACK: [0] * num_squares }
+        self.penalty_totals = { Player.WHITE: 0, Player.BLACK: 0 }
+
+        # Number of stacks controlled by each player in each row and column (same order as Geometry.lines)
+        self.line_counts = { Player.WHITE: [0] * (2 * board_size), Player.BLACK: [0] * (2 * board_size) }
+
+        # Squares changed by the moves applied (or undone) since the totals were last updated. Moves only mark the
+        # squares they change, and the totals are brought up to date when the state is evaluated, so the interior
+        # nodes of the search (where moves are applied and undone without being evaluated) don't pay for the updates
+        self.dirty = 0
+
+    @staticmethod
+    def from_state(state: State):
+        '''Converts a list-based game state into a bitboard game state'''
+        bitboard_state = BitboardState(state.board_size)
+
+        bitboard_state.first_turn = state.first_turn
+        bitboard_state.current_player = state.current_player
+        bitboard_state.num_flats = dict(state.num_flats)
+        bitboard_state.num_caps = dict(state.num_caps)
+
+        for row in range(state.board_size):
+            for col in range(state.board_size):
+                stack = state.board[row][col]
+                if not stack:
+                    continue
+
+                sq = row * state.board_size + col
+                bitboard_state.heights[sq] = len(stack)
+                bitboard_state.stacks[sq] = sum(1 << i for i, piece in enumerate(stack) if piece.color == Player.BLACK)
+                bitboard_state._update_top(sq)
+
+                if stack[-1].type == PieceType.WALL:
+                    bitboard_state.walls |= 1 << sq
+                elif stack[-1].type == PieceType.CAPSTONE:
+                    bitboard_state.caps |= 1 << sq
+
+        bitboard_state.hash = bitboard_state.compute_hash()
+        bitboard_state.result = state.result
+        bitboard_state.dirty = bitboard_state.geometry.full
+        return bitboard_state
+
+    def copy(self):
+        '''Returns a copy of the game state. Only the two per-square lists need to be copied'''
+        state_copy = BitboardState.__new__(BitboardState)
+
+        state_copy.first_turn = self.first_turn
+        state_copy.current_player = self.current_player
+        state_copy.board_size = self.board_size
+        state_copy.geometry = self.geometry
+        state_copy.move_table = self.move_table
+
+        state_copy.heights = self.heights[:]
+        state_copy.stacks = self.stacks[:]
+
+        state_copy.white = self.white
+        state_copy.black = self.black
+        state_copy.walls = self.walls
+        state_copy.caps = self.caps
+
+        state_copy.num_flats = self.num_flats.copy()
+        state_copy.num_caps = self.num_caps.copy()
+
+        state_copy.zobrist = self.zobrist
+        state_copy.hash = self.hash
+
+        state_copy.result = self.result
+        state_copy.previous_results = []
+
+        state_copy.captured = self.captured[:]
+        state_copy.captured_total = self.captured_total
+        state_copy.influence = self.influence[:]
+        state_copy.influence_total = self.influence_total
+        state_copy.penalties = { player: penalties[:] for player, penalties in self.penalties.items() }
+        state_copy.penalty_totals = self.penalty_totals.copy()
+        state_copy.line_counts = { player: counts[:] for player, counts in self.line_counts.items() }
+        state_copy.dirty = self.dirty
+
+        return state_copy
+
+    @property
+    def board(self) -> List[List[List[Piece]]]:
+        '''List-based view of the board, with the same layout as State.board (read-only)'''
+        n = self.board_size
+        board = [[[] for _ in range(n)] for _ in range(n)]
+
+        for sq in range(n * n):
+            stack = board[sq // n][sq % n]
+            for i in range(self.heights[sq]):
+                stack.append(Piece(Player.BLACK if self.stacks[sq] >> i & 1 else Player.WHITE, PieceType.FLAT))
+
+            if self.walls >> sq & 1:
+                stack[-1] = Piece(stack[-1].color, PieceType.WALL)
+            elif self.caps >> sq & 1:
+                stack[-1] = Piece(stack[-1].color, PieceType.CAPSTONE)
+
+        return board
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state['geometry']
+        del state['move_table']
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.geometry = get_geometry(self.board_size)
+        self.move_table = get_move_table(self.board_size)
+
+    def __hash__(self):
+        return self.hash
+
+    def canonical_hash(self):
+        '''Same as State.canonical_hash, computing the hashes of every symmetric position in a single pass over the stacks'''
+        zobrist = self.zobrist
+        keys, stack_limit = zobrist.pieces, zobrist.max_height
+        symmetries = self.geometry.symmetries
+
+        value = zobrist.first_turn if self.first_turn else 0
+        if self.current_player == Player.BLACK:
+            value ^= zobrist.black_to_move
+        hashes = [value] * NUM_SYMMETRIES
+
+        occupied = self.white | self.black
+        while occupied:
+            bit = occupied & -occupied
+            occupied ^= bit
+            sq = bit.bit_length() - 1
+
+            height, stack = self.heights[sq], self.stacks[sq]
+            top = 1 if self.walls & bit else 2 if self.caps & bit else 0
+
+            for i in range(height):
+                variant = (3 if stack >> i & 1 else 0) + (top if i == height - 1 else 0)
+                for t in range(NUM_SYMMETRIES):
+                    hashes[t] ^= keys[(symmetries[t][sq] * stack_limit + i) * NUM_VARIANTS + variant]
+
+        return min((value, t) for t, value in enumerate(hashes))
+
+    def __eq__(self, other):
+        return self.heights == other.heights and self.stacks == other.stacks and self.walls == other.walls and \
+            self.caps == other.caps and self.current_player == other.current_player
+
+    def _update_top(self, sq: int):
+        '''Updates the color masks for a square after the pieces of its stack have changed'''
+        bit = 1 << sq
+        height = self.heights[sq]
+
+        self.white &= ~bit
+        self.black &= ~bit
+
+        if height:
+            if self.stacks[sq] >> (height - 1) & 1:
+                self.black |= bit
+            else:
+                self.white |= bit
+
+    def _update_terms(self, changed: int):
+        '''
+        Updates the running totals of the evaluation terms after the squares in the given mask have changed.
+        The captured pieces and the line counts only depend on the stack of each square, while the influence
+        and the wall penalty of a square also depend on its neighbours, so they are recomputed around the changed squares.
+        '''
+        n = self.board_size
+        geometry = self.geometry
+        lines = geometry.lines
+        neighbours = geometry.neighbours
+        heights = self.heights
+        white, black, walls, caps = self.white, self.black, self.walls, self.caps
+
+        captured = self.captured
+        white_lines, black_lines = self.line_counts[Player.WHITE], self.line_counts[Player.BLACK]
+
+        squares = changed
+        while squares:
+            bit = squares & -squares
+            squares ^= bit
+            sq = bit.bit_length() - 1
+
+            height = heights[sq]
+            value = 0
+            if height > 1:
+                black_pieces = self.stacks[sq].bit_count()
+                value = black_pieces if white & bit else black_pieces - height
+
+            self.captured_total += value - captured[sq]
+            captured[sq] = value
+
+            for line in (sq // n, n + sq % n):
+                white_lines[line] = (white & lines[line]).bit_count()
+                black_lines[line] = (black & lines[line]).bit_count()
+
+        empty = geometry.full & ~(white | black)
+        flats = ~(walls | caps)
+        white_caps, black_caps = white & caps, black & caps
+
+        # Squares influenced by each player's stacks (protected stacks also influence adjacent opposing flats)
+        influenced_white, influenced_black = empty | white, empty | black
+        protected_white, protected_black = influenced_white | (black & flats), influenced_black | (white & flats)
+
+        influence = self.influence
+        penalties_white, penalties_black = self.penalties[Player.WHITE], self.penalties[Player.BLACK]
+
+        squares = geometry.grow(changed)
+        while squares:
+            bit = squares & -squares
+            squares ^= bit
+            sq = bit.bit_length() - 1
+            adjacent = neighbours[sq]
+
+            if white & bit:
+                value = (adjacent & (protected_white if adjacent & white else influenced_white)).bit_count()
+            elif black & bit:
+                value = -(adjacent & (protected_black if adjacent & black else influenced_black)).bit_count()
+            else:
+                value = 0
+
+            self.influence_total += value - influence[sq]
+            influence[sq] = value
+
+            penalty_white = penalty_black = 0
+            if walls & bit and heights[sq] == 1:
+                color = Player.WHITE if white & bit else Player.BLACK
+                penalty_white = color * (adjacent & black_caps).bit_count()
+                penalty_black = color * (adjacent & white_caps).bit_count()
+
+            if penalty_white or penalties_white[sq]:
+                self.penalty_totals[Player.WHITE] += penalty_white - penalties_white[sq]
+                penalties_white[sq] = penalty_white
+
+            if penalty_black or penalties_black[sq]:
+                self.penalty_totals[Player.BLACK] += penalty_black - penalties_black[sq]
+                penalties_black[sq] = penalty_black
+
+    def top_masks(self, player: Player):
+        '''Bitboard version of State.top_masks, used by State.generate_moves'''
+        return self.white if player == Player.WHITE else self.black, self.walls, self.caps
+
+    def stack_height(self, sq: int) -> int:
+        return self.heights[sq]
+
+    def decode_move(self, code: int):
+        '''Returns the Move with the given code (see tak.MoveTable) for this game state'''
+        return self.move_table.to_move(code, self.heights[self.move_table.square(code)])
+
+    def apply_code(self, code: int):
+        '''Plays the move with the given code in place, returning the information needed to undo it (see undo_code)'''
+        table = self.move_table
+
+        if code < table.num_placements:
+            return self._place(code // 3, PLACEMENT_TYPES[code % 3])
+
+        sq, step, carry, drops = table.decode_spread(code)
+        return self._spread(sq, step, self.heights[sq] - carry, drops)
+
+    def undo_code(self, code: int, undo_info):
+        '''Reverts the move with the given code, given the information returned by apply_code'''
+        table = self.move_table
+
+        if code < table.num_placements:
+            self._unplace(code // 3, undo_info)
+        else:
+            sq, step, _, drops = table.decode_spread(code)
+            self._unspread(sq, step, drops, undo_info)
+
+    def road_mask(self, player: Player) -> int:
+        '''Returns a mask of the squares controlled by the given player which can be part of a road (flats and capstones)'''
+        return (self.white if player == Player.WHITE else self.black) & ~self.walls
+
+    def occupied_mask(self) -> int:
+        '''Returns a mask of the squares which are not empty'''
+        return self.white | self.black
+
+    def flat_count(self, player: Player) -> int:
+        '''Returns the number of stacks controlled by the given player which have a flat on top'''
+        return ((self.white if player == Player.WHITE else self.black) & ~(self.walls | self.caps)).bit_count()
+
+    def heuristic_num_flats(self, player: Player) -> int:
+        '''Bitboard version of tak.heuristic_num_flats'''
+        flats = ~(self.walls | self.caps)
+        return player * ((self.white & flats).bit_count() - (self.black & flats).bit_count())
+
+    def heuristic_penalty_walls(self, player: Player) -> int:
+        '''Bitboard version of tak.heuristic_penalty_walls'''
+        value = 0
+        opponent_caps = self.caps & (self.black if player == Player.WHITE else self.white)
+
+        walls = self.walls
+        while walls:
+            bit = walls & -walls
+            walls ^= bit
+            sq = bit.bit_length() - 1
+
+            if self.heights[sq] == 1:
+                color = Player.WHITE if self.white & bit else Player.BLACK
+                value -= player * color * (self.geometry.neighbours[sq] & opponent_caps).bit_count()
+
+        return value
+
+    def heuristic_captured_pieces(self, player: Player) -> int:
+        '''Bitboard version of tak.heuristic_captured_pieces'''
+        value = 0
+
+        for sq, height in enumerate(self.heights):
+            if height > 1:
+                black_pieces = self.stacks[sq].bit_count()
+
+                if self.white >> sq & 1:
+                    value += player * Player.WHITE * black_pieces
+                else:
+                    value += player * Player.BLACK * (height - black_pieces)
+
+        return value
+
+    def heuristic_nearness_to_optimal_road(self, player: Player) -> int:
+        '''Bitboard version of tak.heuristic_nearness_to_optimal_road'''
+        own, opponent = (self.white, self.black) if player == Player.WHITE else (self.black, self.white)
+
+        value_player = max((own & line).bit_count() for line in self.geometry.lines)
+        value_opponent = max((opponent & line).bit_count() for line in self.geometry.lines)
+
+        return value_player - value_opponent
+
+    def heuristic_influence(self, player: Player) -> int:
+        '''Bitboard version of tak.heuristic_influence'''
+        neighbours = self.geometry.neighbours
+        empty = self.geometry.full & ~(self.white | self.black)
+        flats = ~(self.walls | self.caps)
+        value = 0
+
+        for color, own, opponent in ((Player.WHITE, self.white, self.black), (Player.BLACK, self.black, self.white)):
+            influenced = empty | own
+            # Protected stacks also influence adjacent opposing flats
+            influenced_protected = influenced | (opponent & flats)
+
+            count = 0
+            stacks = own
+            while stacks:
+                bit = stacks & -stacks
+                stacks ^= bit
+                adjacent = neighbours[bit.bit_length() - 1]
+
+                if adjacent & own:
+                    count += (adjacent & influenced_protected).bit_count()
+                else:
+                    count += (adjacent & influenced).bit_count()
+
+            value += color * count
+
+        return value * player
+
+    def evaluate(self, player: Player, depth: int, level: int = 3) -> int:
+        '''Returns a number representing the value of this game state for the given player (same weights as State.evaluate)'''
+
+        result = self.objective()
+
+        if result == Result.DRAW:
+            return 0
+        elif (result == Result.WHITE_WIN and player == Player.WHITE) or (result == Result.BLACK_WIN and player == Player.BLACK):
+            return int(1e9) + depth
+        elif (result == Result.WHITE_WIN and player == Player.BLACK) or (result == Result.BLACK_WIN and player == Player.WHITE):
+            return int(-1e9) - depth
+
+        # The terms are combined from the running totals instead of being computed by the heuristic_* methods
+        if self.dirty:
+            self._update_terms(self.dirty)
+            self.dirty = 0
+
+        num_flats = player * (self.flat_count(Player.WHITE) - self.flat_count(Player.BLACK))
+        captured_pieces = player * self.captured_total
+        influence = player * self.influence_total
+        penalty_walls = -player * self.penalty_totals[player]
+        nearness_to_optimal_road = player * (max(self.line_counts[Player.WHITE]) - max(self.line_counts[Player.BLACK]))
+
+        value = 0
+
+        if level == 1:
+            value = 10 * num_flats + 2 * captured_pieces + 2 * influence
+        elif level == 2:
+            value = 10 * num_flats + 2 * captured_pieces + 2 * influence + penalty_walls
+        elif level == 3:
+            value = 10 * num_flats + penalty_walls + 2 * influence + 2 * captured_pieces + nearness_to_optimal_road
+
+        return value
+
+    def place(self, pos: Position, piece_type: PieceType) -> bool:
+        '''
+        Places a new piece of the given type on an empty square and passes the turn (the move is assumed to be valid).
+        Returns the previous value of first_turn, which is needed to undo the placement.
+        '''
+        return self._place(pos.row * self.board_size + pos.col, piece_type)
+
+    def unplace(self, pos: Position, first_turn: bool):
+        '''Reverts a placement, given the value returned by place'''
+        self._unplace(pos.row * self.board_size + pos.col, first_turn)
+
+    def spread_hash(self, pos: Position, direction: Position, split: List[int]) -> int:
+        '''
+        Returns the XOR of every Zobrist key changed by a spread, computed from the position before the spread
+        (applying it to the hash both plays and reverts the spread).
+        '''
+        n = self.board_size
+        return self._spread_hash(pos.row * n + pos.col, direction.row * n + direction.col, split[0], split[1:])
+
+    def spread(self, pos: Position, direction: Position, split: List[int]) -> bool:
+        '''
+        Picks up the stack at the given position and drops split[i] pieces (taken from the bottom)
+        i squares away in the given direction, then passes the turn (the move is assumed to be valid).
+        Returns whether a wall was flattened, which is needed to undo the spread.
+        '''
+        n = self.board_size
+        return self._spread(pos.row * n + pos.col, direction.row * n + direction.col, split[0], split[1:])
+
+    def unspread(self, pos: Position, direction: Position, split: List[int], flattened: bool):
+        '''Reverts a spread, given the value returned by spread'''
+        n = self.board_size
+        self._unspread(pos.row * n + pos.col, direction.row * n + direction.col, split[1:], flattened)
+
+    # The moves are played on squares and steps (the offset between consecutive squares in the direction of a
+    # spread), which is what move codes (see tak.MoveTable) are decoded to. A spread leaves the given number of
+    # pieces on its square and drops the rest of the stack according to drops (split[1:] of a SplitStack)
+
+    def _place(self, sq: int, piece_type: PieceType) -> bool:
+        '''Same as place, on the given square'''
+        bit = 1 << sq
+        color = self.current_player
+        first_turn = self.first_turn
+
+        if piece_type == PieceType.FLAT and self.first_turn:
+            # During the first turn, players place one of their opponent's flat pieces
+            color = -self.current_player
+            self.num_flats[color] -= 1
+
+            if self.current_player == Player.BLACK:
+                self.first_turn = False
+        elif piece_type == PieceType.CAPSTONE:
+            self.num_caps[color] -= 1
+            self.caps |= bit
+        else:
+            self.num_flats[color] -= 1
+            if piece_type == PieceType.WALL:
+                self.walls |= bit
+
+        self.heights[sq] = 1
+        if color == Player.BLACK:
+            self.stacks[sq] = 1
+            self.black |= bit
+        else:
+            self.stacks[sq] = 0
+            self.white |= bit
+
+        self.hash ^= self.zobrist.piece(sq, 0, piece_variant(color, piece_type)) ^ self.zobrist.black_to_move
+        if first_turn != self.first_turn:
+            self.hash ^= self.zobrist.first_turn
+
+        self.dirty |= bit
+        self.update_result(bit)
+
+        self.current_player = -self.current_player
+        return first_turn
+
+    def _unplace(self, sq: int, first_turn: bool):
+        '''Same as unplace, on the given square'''
+        bit = 1 << sq
+        color = Player.BLACK if self.stacks[sq] else Player.WHITE
+
+        self.current_player = -self.current_player
+
+        if self.caps & bit:
+            piece_type = PieceType.CAPSTONE
+            self.num_caps[color] += 1
+        else:
+            piece_type = PieceType.WALL if self.walls & bit else PieceType.FLAT
+            self.num_flats[color] += 1
+
+        self.hash ^= self.zobrist.piece(sq, 0, piece_variant(color, piece_type)) ^ self.zobrist.black_to_move
+        if first_turn != self.first_turn:
+            self.hash ^= self.zobrist.first_turn
+
+        self.heights[sq] = 0
+        self.stacks[sq] = 0
+        self.white &= ~bit
+        self.black &= ~bit
+        self.walls &= ~bit
+        self.caps &= ~bit
+
+        self.dirty |= bit
+        self.restore_result()
+        self.first_turn = first_turn
+
+    def _spread_hash(self, sq: int, step: int, left: int, drops: List[int]) -> int:
+        '''Same as spread_hash, for the spread of the given square'''
+        zobrist = self.zobrist
+        bit = 1 << sq
+
+        pieces = self.stacks[sq]
+        top = self.heights[sq] - 1
+        top_offset = 1 if self.walls & bit else 2 if self.caps & bit else 0
+
+        height = left
+        value = zobrist.black_to_move
+
+        sq_to = sq
+        for num_pieces in drops:
+            sq_to += step
+            height_to = self.heights[sq_to]
+
+            if self.walls >> sq_to & 1:
+                # Capstone converts a wall to a flat piece
+                variant = 3 if self.black >> sq_to & 1 else 0
+                value ^= zobrist.piece(sq_to, height_to - 1, variant + 1) ^ zobrist.piece(sq_to, height_to - 1, variant)
+
+            for j in range(num_pieces):
+                variant = 3 if pieces >> height & 1 else 0
+                if height == top:
+                    variant += top_offset
+
+                value ^= zobrist.piece(sq, height, variant) ^ zobrist.piece(sq_to, height_to + j, variant)
+                height += 1
+
+        return value
+
+    def _spread(self, sq: int, step: int, left: int, drops: List[int]) -> bool:
+        '''Same as spread, for the spread of the given square'''
+        self.hash ^= self._spread_hash(sq, step, left, drops)
+
+        bit = 1 << sq
+
+        top_is_wall = self.walls & bit
+        top_is_cap = self.caps & bit
+        pieces = self.stacks[sq]
+        flattened = False
+        changed = bit
+
+        # The pieces left behind are all flats
+        self.heights[sq] = left
+        self.stacks[sq] = pieces & ((1 << left) - 1)
+        self.walls &= ~bit
+        self.caps &= ~bit
+        self._update_top(sq)
+        pieces >>= left
+
+        sq_to = sq
+        for num_pieces in drops:
+            sq_to += step
+            bit_to = 1 << sq_to
+
+            # Either the dropped pieces are flats or a capstone is flattening a wall
+            if self.walls & bit_to:
+                self.walls &= ~bit_to
+                flattened = True
+
+            height = self.heights[sq_to]
+            self.stacks[sq_to] |= (pieces & ((1 << num_pieces) - 1)) << height
+            self.heights[sq_to] = height + num_pieces
+            self._update_top(sq_to)
+            pieces >>= num_pieces
+            changed |= bit_to
+
+        # The top piece of the original stack is the top of the last square
+        if top_is_wall:
+            self.walls |= 1 << sq_to
+        elif top_is_cap:
+            self.caps |= 1 << sq_to
+
+        self.dirty |= changed
+        self.update_result(changed)
+
+        self.current_player = -self.current_player
+        return flattened
+
+    def _unspread(self, sq: int, step: int, drops: List[int], flattened: bool):
+        '''Same as unspread, for the spread of the given square (the pieces left behind are the ones still on it)'''
+        self.current_player = -self.current_player
+
+        # Take back the pieces dropped on each square, starting from the furthest one
+        pieces = 0
+        changed = 1 << sq
+        sq_to = sq + step * len(drops)
+        last_bit = 1 << sq_to
+
+        top_is_wall = self.walls & last_bit
+        top_is_cap = self.caps & last_bit
+        self.walls &= ~last_bit
+        self.caps &= ~last_bit
+
+        for num_pieces in reversed(drops):
+            height = self.heights[sq_to] - num_pieces
+            pieces = (pieces << num_pieces) | (self.stacks[sq_to] >> height)
+
+            self.heights[sq_to] = height
+            self.stacks[sq_to] &= (1 << height) - 1
+            self._update_top(sq_to)
+            changed |= 1 << sq_to
+            sq_to -= step
+
+        if flattened:
+            self.walls |= last_bit
+
+        left = self.heights[sq]
+        self.stacks[sq] |= pieces << left
+        self.heights[sq] = left + sum(drops)
+        self._update_top(sq)
+
+        if top_is_wall:
+            self.walls |= 1 << sq
+        elif top_is_cap:
+            self.caps |= 1 << sq
+
+        self.dirty |= changed
+        self.restore_result()
+        self.hash ^= self._spread_hash(sq, step, left, drops)
@@ -0,0 +1,182 @@
+from typing import Callable
+import argparse
+import mmap
+import os
+import struct
+import time
+
+from tak import State, Result, flats_for_size, capstones_for_size, evaluate_hard
+from bitboard import BitboardState
+from search import Search
+from transposition import pack_move, unpack_move
+from utils import get_geometry
+
+# Opening book: the positions of the first plies of a game are searched offline (see build_book) and the best move
+# of each one is written to a book file, one per board size. Positions that only differ by a rotation or reflection
+# of the board share a single entry, keyed by their canonical hash (see State.canonical_hash), and the move of the
+# entry is stored for the canonical orientation of the position. Book files are sorted by key and memory-mapped,
+# so looking up a position is a binary search over the file.
+#
+# The books are built with evaluate_hard, so they should only be used by searches with that evaluation function
+# (the weaker AIs would otherwise play the openings of the strongest one). Keys are Zobrist hashes, which are
+# generated with a fixed seed, so a book must be rebuilt if the Zobrist keys change.
+
+BOOK_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'books')
+
+# File header: magic number, format version, board size, plies covered by the book and number of entries
+HEADER = struct.Struct('<4sHHHI')
+MAGIC = b'TAKB'
+VERSION = 1
+
+# Entries: canonical hash, move (see transposition.pack_move), value and depth of the search that chose the move
+ENTRY = struct.Struct('<QIiH')
+
+def book_path(board_size: int, directory: str = BOOK_DIRECTORY) -> str:
+    return os.path.join(directory, f'book_{board_size}.bin')
+
+def pieces_placed(state: State) -> int:
+    '''Returns the number of pieces placed on the board (which is the number of plies played during the opening)'''
+    pieces = 2 * (flats_for_size[state.board_size] + capstones_for_size[state.board_size])
+    return pieces - sum(state.num_flats.values()) - sum(state.num_caps.values())
+
+class BookFile:
+    '''
+    A book file mapped into memory: a header followed by entries sorted by the canonical hash of their
+    positions. Also used for the tables of solved positions (see solver.py).
+    '''
+
+    def __init__(self, path: str, board_size: int):
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, size, self.plies, self.count = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION or size != board_size or len(self.data) != HEADER.size + self.count * ENTRY.size:
+            self.data.close()
+            raise ValueError(f'Invalid book file {path}')
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, state: State):
+        '''Returns the (move, value, depth) entry for the given state, or None if the state is not in the file'''
+        key, symmetry = state.canonical_hash()
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if ENTRY.unpack_from(self.data, HEADER.size + middle * ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == self.count:
+            return None
+
+        entry_key, code, value, depth = ENTRY.unpack_from(self.data, HEADER.size + low * ENTRY.size)
+        if entry_key != key:
+            return None
+
+        # The move is stored for the canonical position, so it is transformed back to the orientation of the state
+        move = unpack_move(code).transform(state.board_size, get_geometry(state.board_size).inverse_symmetries[symmetry])
+
+        # Guards against hash collisions
+        if not move.is_valid(state):
+            return None
+
+        return move, value, depth
+
+class OpeningBook:
+    '''
+    Opening books of every board size found in a directory. The book files are memory-mapped when the
+    book is created and can be shared by every search of a process.
+    '''
+
+    def __init__(self, directory: str = BOOK_DIRECTORY):
+        self.books = {}
+
+        for board_size in flats_for_size:
+            path = book_path(board_size, directory)
+            if os.path.exists(path):
+                self.books[board_size] = BookFile(path, board_size)
+
+    def close(self):
+        '''Unmaps the book files'''
+        for book in self.books.values():
+            book.close()
+        self.books = {}
+
+    def __len__(self):
+        return sum(len(book) for book in self.books.values())
+
+    def lookup(self, state: State):
+        '''Returns the (move, value, depth) entry of the book for the given state, or None if the state is not in the book'''
+        book = self.books.get(state.board_size)
+
+        # Positions past the opening are rejected without being hashed
+        if book is None or pieces_placed(state) >= book.plies:
+            return None
+
+        return book.lookup(state)
+
+def write_book(path: str, board_size: int, plies: int, entries: dict):
+    '''Writes the entries of a book (canonical hash -> (move, value, depth), with moves for the canonical positions) to a file'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, board_size, plies, len(entries)))
+        for key in sorted(entries):
+            move, value, depth = entries[key]
+            file.write(ENTRY.pack(key, pack_move(move), value, depth))
+
+def build_book(board_size: int, plies: int, time_limit: float, max_depth: int = 64, evaluation_function: Callable = evaluate_hard,
+        table_size_mb: float = 64, verbose: bool = False) -> dict:
+    '''
+    Searches every position reachable in less than the given number of plies (one of each set of symmetric positions)
+    for time_limit seconds, returning the book entries (canonical hash -> (move, value, depth)).
+    '''
+    search = Search(evaluation_function, table_size_mb=table_size_mb)
+    entries = {}
+
+    positions = [BitboardState(board_size)]
+    seen = { positions[0].canonical_hash()[0] }
+
+    for ply in range(plies):
+        next_positions = []
+
+        for i, state in enumerate(positions):
+            key, symmetry = state.canonical_hash()
+            move = search.iterative_deepening(state, time_limit, max_depth)
+            entries[key] = (move.transform(board_size, symmetry), search.best_value, search.completed_depth)
+
+            if verbose:
+                print(f'Size {board_size}, ply {ply}: position {i + 1}/{len(positions)}, {move} (depth {search.completed_depth}, value {search.best_value})')
+
+            if ply + 1 < plies:
+                for child_move in state.possible_moves():
+                    child = child_move.play(state)
+                    child_key = child.canonical_hash()[0]
+
+                    if child_key not in seen and child.objective() == Result.NOT_FINISHED:
+                        seen.add(child_key)
+                        next_positions.append(child)
+
+        positions = next_positions
+
+    return entries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the opening books used by the server')
+    parser.add_argument('sizes', type=int, nargs='*', default=list(flats_for_size), help='board sizes (all of them by default)')
+    parser.add_argument('--plies', type=int, default=3, help='number of plies covered by each book')
+    parser.add_argument('--time', type=float, default=10, help='time spent searching each position (in seconds)')
+    parser.add_argument('--directory', default=BOOK_DIRECTORY, help='directory where the books are written')
+    args = parser.parse_args()
+
+    for board_size in args.sizes:
+        start = time.time()
+        entries = build_book(board_size, args.plies, args.time, verbose=True)
+        write_book(book_path(board_size, args.directory), board_size, args.plies, entries)
+        print(f'Size {board_size}: {len(entries)} positions in {time.time() - start:.1f}s')
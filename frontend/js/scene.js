@@ -136,6 +136,9 @@ let moveNum = 1;
 
 const playerTypes = {};
 
+// Id of the game, sent with every request after the game has started
+let gameId = null;
+
 // https://stackoverflow.com/a/5732881
 function hostAvailable(url) {
 	var req = new XMLHttpRequest();
@@ -176,6 +179,7 @@ function onGameTypeSubmitted(event) {
 
 		let response = JSON.parse(request.responseText);
 		let state = response['state'];
+		gameId = response['game_id'];
 		length = state['board'].length;
 
 		generateBoard(state['board'].length);
@@ -362,7 +366,7 @@ function getPossibleMoves() {
 
 		console.log(possibleMoves);
 	});
-	request.send(JSON.stringify({}));
+	request.send(JSON.stringify({'game_id': gameId}));
 }
 
 function arrayEquals(pos1, pos2) {
@@ -479,7 +483,7 @@ function onMoveSubmitted(event) {
 		let response = JSON.parse(request.responseText);
 		handleStateResponse(response);
 	});
-	request.send(JSON.stringify({'move_idx': moveIdx}));
+	request.send(JSON.stringify({'game_id': gameId, 'move_idx': moveIdx}));
 }
 
 function getComputerMove() {
@@ -489,11 +493,28 @@ function getComputerMove() {
 	request.open('POST', url, true);
 	request.setRequestHeader('Content-Type', 'application/json');
 	request.addEventListener('load', () => {
+		// The server is busy: the same move is requested again after the given delay (in seconds)
+		if (request.status === 503) {
+			let delay = Number.parseFloat(request.getResponseHeader('Retry-After')) || 1;
+			setTimeout(getComputerMove, delay * 1000);
+			return;
+		}
+
+		if (request.status !== 200) {
+			// A search is only cancelled when the game changes, which is handled by whoever changed it
+			let error = JSON.parse(request.responseText)['error'];
+			if (error !== 'The search was cancelled') {
+				computerMoveIndicator.classList.add('d-none');
+				alert(`Error: the computer could not move (${error})`);
+			}
+			return;
+		}
+
 		let response = JSON.parse(request.responseText);
 		addMoveToHistory(response['move']);
 		handleStateResponse(response);
 	});
-	request.send(JSON.stringify({}));
+	request.send(JSON.stringify({'game_id': gameId}));
 }
 
 moveControls.querySelector('form').addEventListener('submit', onMoveSubmitted);
@@ -516,7 +537,7 @@ function getMoveHint() {
 		hintIndicator.classList.add('d-none');
 		suggestedMoveDiv.classList.remove('d-none');
 	});
-	request.send(JSON.stringify({}));
+	request.send(JSON.stringify({'game_id': gameId}));
 }
 
 
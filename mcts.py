@@ -0,0 +1,296 @@
+from array import array
+from typing import Callable
+import math
+import random
+import time
+
+from tak import State, Player, Result, PlaceFlat, PlaceWall, MovePiece, evaluate_hard
+from utils import get_geometry
+
+# Monte Carlo Tree Search: instead of searching every move to a fixed depth, the tree is grown one node per
+# iteration towards the moves that have won the most playouts (random games played from the new node), balancing
+# the moves that look best with the moves that have been tried the least (UCT). It only needs to play moves, so it
+# copes with the branching factor of the larger boards, where negamax can't look more than a couple of plies ahead.
+#
+# Playouts are the bulk of the work: each one copies the state once and then plays the moves chosen by the playout
+# policy in place, so no state is copied per move. The default policy places flats on random empty squares (which
+# doesn't require generating every move) most of the time, and completes roads when it can. Playouts that don't end
+# within playout_limit plies are scored by the evaluation function.
+
+# Probabilities of a playout move being a flat or a wall placed on a random empty square (when possible). Otherwise, a
+# random piece is moved to an adjacent square, and only if that fails is the move chosen among every possible move
+# (which is much slower, since every move has to be generated)
+FLAT_PROBABILITY = 0.85
+WALL_PROBABILITY = 0.05
+
+# Evaluation (see State.evaluate) that gives an unfinished playout a reward of about 0.88 (a difference of 10 is a flat)
+EVALUATION_SCALE = 50
+
+def uniform_policy(state: State, rng: random.Random):
+    '''Playout policy that chooses any of the possible moves with the same probability (None if there are no moves)'''
+    moves = state.possible_moves()
+    return rng.choice(moves) if moves else None
+
+def placement_policy(state: State, rng: random.Random):
+    '''Playout policy that usually places a piece on a random empty square, otherwise chooses any of the possible moves'''
+    r = rng.random()
+
+    if r < FLAT_PROBABILITY + WALL_PROBABILITY and state.num_flats[state.current_player] > 0:
+        move_type = PlaceFlat if r < FLAT_PROBABILITY or state.first_turn else PlaceWall
+        geometry = get_geometry(state.board_size)
+        empty = geometry.full & ~state.occupied_mask()
+
+        # Random squares are tried a few times, which finds an empty square quickly unless the board is almost full
+        for _ in range(4):
+            sq = rng.randrange(len(geometry.positions))
+            if empty >> sq & 1:
+                return move_type(geometry.positions[sq])
+
+    return random_stack_move(state, rng) or uniform_policy(state, rng)
+
+def random_stack_move(state: State, rng: random.Random):
+    '''Returns a move of a random single piece of the player to move to an adjacent square (None if no valid move was found)'''
+    if state.first_turn:
+        return None
+
+    geometry = get_geometry(state.board_size)
+    own = state.road_mask(state.current_player)
+
+    for _ in range(4):
+        sq = rng.randrange(len(geometry.positions))
+        if own >> sq & 1:
+            move = MovePiece(geometry.positions[sq], rng.choice(geometry.directions))
+            if move.is_valid(state):
+                return move
+
+    return None
+
+def winning_placement(state: State):
+    '''Returns a flat placement that completes a road for the player to move, or None if there isn't one'''
+    threats = state.road_threats(state.current_player)
+    if threats and state.num_flats[state.current_player] > 0 and not state.first_turn:
+        return PlaceFlat(get_geometry(state.board_size).positions[(threats & -threats).bit_length() - 1])
+    return None
+
+def road_policy(state: State, rng: random.Random):
+    '''Same as placement_policy, but completes a road whenever a flat can be placed on a square that does so'''
+    return winning_placement(state) or placement_policy(state, rng)
+
+class NodePool:
+    '''
+    Preallocated nodes of the search tree, stored in arrays (one element per node) so that memory usage is fixed.
+    The children of a node are allocated together, in consecutive slots, when the node is expanded.
+    '''
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.size = 0
+
+        self.parents = array('i', [-1]) * capacity
+        self.first_children = array('i', [-1]) * capacity # -1 if the node hasn't been expanded
+        self.num_children = array('i', [0]) * capacity
+        self.visits = array('i', [0]) * capacity
+        # Sum of the rewards of the playouts through the node, for the player that played its move
+        self.rewards = array('d', [0]) * capacity
+        self.moves = [None] * capacity
+
+    def clear(self):
+        '''Removes every node (the slots are reinitialized as they are allocated again, but their moves are released now)'''
+        self.moves[:self.size] = [None] * self.size
+        self.size = 0
+
+    def allocate(self, parent: int, moves: list) -> int:
+        '''Allocates a node for each move (the children of parent, or the root if parent is -1), returning the index of the first one'''
+        first = self.size
+        if first + len(moves) > self.capacity:
+            return -1
+
+        for i, move in enumerate(moves, first):
+            self.parents[i] = parent
+            self.first_children[i] = -1
+            self.num_children[i] = 0
+            self.visits[i] = 0
+            self.rewards[i] = 0
+            self.moves[i] = move
+
+        self.size += len(moves)
+        if parent >= 0:
+            self.first_children[parent] = first
+            self.num_children[parent] = len(moves)
+
+        return first
+
+class MCTS:
+    '''
+    UCT search with a bounded tree. It has the same interface as Search for time-limited searches (iterative_deepening,
+    the callback and the progress attributes), so it can be used by the search pool in place of negamax. When the node
+    pool is full, the tree stops growing and the remaining iterations refine the statistics of the existing nodes.
+    '''
+
+    # Number of iterations between consecutive checks of the time limit (and calls of the callback)
+    TIME_CHECK_INTERVAL = 16
+
+    def __init__(self, evaluation_function: Callable = evaluate_hard, policy: Callable = road_policy, exploration: float = 0.7,
+            max_nodes: int = 100000, playout_limit: int = 20, seed: int = None, book = None):
+        self.evaluation_function = evaluation_function
+        self.policy = policy
+        self.exploration = exploration
+        self.playout_limit = playout_limit
+        self.rng = random.Random(seed)
+        self.nodes = NodePool(max_nodes)
+
+        # Opening book (see book.OpeningBook) consulted before searching, like in Search
+        self.book = book
+
+        # Same meaning as in Search
+        self.callback = None
+        self.start_time = 0
+        self.iterations = 0
+
+        # Result of the last search: the most visited move, its percentage of wins and the depth of the tree
+        self.best_move = None
+        self.best_value = None
+        self.completed_depth = 0
+
+    def nodes_searched(self) -> int:
+        '''Returns the number of playouts of the current search'''
+        return self.iterations
+
+    def iterative_deepening(self, state: State, time_limit: float, max_depth: int = 64):
+        '''
+        Searches the given state until the time limit runs out (max_depth is ignored), returning the best move found
+        (or the move of the opening book, without searching)
+        '''
+        entry = self.book.lookup(state) if self.book is not None else None
+        if entry is not None:
+            self.start_time = time.time()
+            self.iterations = 0
+            self.best_move, self.best_value, self.completed_depth = entry
+            return self.best_move
+
+        return self.search(state, time_limit)
+
+    def search(self, state: State, time_limit: float, max_iterations: int = None):
+        '''Runs playouts from the given state until the time limit (in seconds) or the number of iterations runs out'''
+        self.start_time = time.time()
+        deadline = self.start_time + time_limit
+        self.iterations = 0
+        self.completed_depth = 0
+
+        nodes = self.nodes
+        nodes.clear()
+        root = nodes.allocate(-1, [None])
+
+        moves = self.expansion_moves(state)
+        if len(moves) <= 1:
+            nodes.clear()
+            self.best_move = moves[0] if moves else None
+            self.best_value = 0
+            return self.best_move
+
+        nodes.allocate(root, moves)
+
+        while max_iterations is None or self.iterations < max_iterations:
+            self.iterate(state, root)
+            self.iterations += 1
+
+            if self.iterations % MCTS.TIME_CHECK_INTERVAL == 0:
+                self.update_result(root)
+                if time.time() >= deadline or (self.callback is not None and self.callback(self)):
+                    break
+
+        self.update_result(root)
+
+        # The tree isn't reused by the next search, so the moves of its nodes don't need to be kept until then
+        nodes.clear()
+        return self.best_move
+
+    def expansion_moves(self, state: State) -> list:
+        '''Returns the moves of a new node: a single move if the player can win by placing a flat, otherwise every move'''
+        move = winning_placement(state)
+        return [move] if move is not None else state.possible_moves()
+
+    def update_result(self, root: int):
+        '''Records the most visited move of the root'''
+        nodes = self.nodes
+        first = nodes.first_children[root]
+        best = max(range(first, first + nodes.num_children[root]), key=lambda child: nodes.visits[child])
+
+        self.best_move = nodes.moves[best]
+        self.best_value = round(100 * nodes.rewards[best] / nodes.visits[best]) if nodes.visits[best] else 0
+
+    def select_child(self, node: int) -> int:
+        '''Returns the child with the highest upper confidence bound (unvisited children first)'''
+        nodes = self.nodes
+        visits, rewards = nodes.visits, nodes.rewards
+        first = nodes.first_children[node]
+
+        log_visits = math.log(visits[node] or 1)
+        best, best_score = first, -1
+
+        for child in range(first, first + nodes.num_children[node]):
+            child_visits = visits[child]
+            if child_visits == 0:
+                return child
+
+            score = rewards[child] / child_visits + self.exploration * math.sqrt(log_visits / child_visits)
+            if score > best_score:
+                best, best_score = child, score
+
+        return best
+
+    def iterate(self, root_state: State, root: int):
+        '''Selects a leaf, expands it, plays out a game from it and updates the statistics of the nodes on the path'''
+        nodes = self.nodes
+        state = root_state.copy()
+        node = root
+        depth = 0
+
+        # Selection
+        while nodes.first_children[node] >= 0 and state.objective() == Result.NOT_FINISHED:
+            node = self.select_child(node)
+            nodes.moves[node].apply(state)
+            depth += 1
+
+        # Expansion (nodes are expanded on their second visit, since most leaves are only visited once)
+        if nodes.visits[node] > 0 and state.objective() == Result.NOT_FINISHED:
+            first = nodes.allocate(node, self.expansion_moves(state))
+            if first >= 0:
+                node = first
+                nodes.moves[node].apply(state)
+                depth += 1
+
+        self.completed_depth = max(self.completed_depth, depth)
+
+        # The player that played the move of the leaf (the rewards of each node are for the player that played its move)
+        reward = self.playout(state, -state.current_player)
+
+        # Backpropagation
+        while node >= 0:
+            nodes.visits[node] += 1
+            nodes.rewards[node] += reward
+            reward = 1 - reward
+            node = nodes.parents[node]
+
+    def playout(self, state: State, player: Player) -> float:
+        '''
+        Plays random moves (chosen by the policy) on the state until the game ends, returning the reward of the
+        given player: 1 for a win, 0 for a loss and 0.5 for a draw
+        '''
+        policy, rng = self.policy, self.rng
+
+        for _ in range(self.playout_limit):
+            result = state.objective()
+            if result != Result.NOT_FINISHED:
+                winner = Player.WHITE if result == Result.WHITE_WIN else Player.BLACK if result == Result.BLACK_WIN else 0
+                return 1 if winner == player else 0 if winner == -player else 0.5
+
+            move = policy(state, rng)
+            if move is None:
+                break
+            move.apply(state)
+
+        # Unfinished playouts are scored by the evaluation function, scaled so that an advantage of a few flats is
+        # worth most of a win (the rewards of clear advantages would otherwise be indistinguishable)
+        value = self.evaluation_function(state, player, 0)
+        return 0.5 + 0.5 * math.tanh(value / EVALUATION_SCALE)
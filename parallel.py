@@ -0,0 +1,173 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+import multiprocessing
+import os
+import time
+
+from tak import State, evaluate_hard, get_move_table, NO_MOVE
+from search import Search, WIN_THRESHOLD
+from transposition import SharedTranspositionTable
+
+# Root splitting: the moves of the root are searched in parallel by a pool of worker processes, each with
+# its own Search. The best value found so far (and the index of its move) is shared between the workers,
+# so every root move starts its search with the tightest alpha known at that moment. The first move is
+# searched on its own before the others are distributed, since it is usually the best one and gives a
+# good alpha to the rest of the moves. By default, the workers share a single transposition table (see
+# transposition.SharedTranspositionTable), so that no worker repeats the subtrees already searched by another.
+
+# Value and index of the best root move found so far (shared by the main process and every worker)
+BEST_VALUE, BEST_INDEX = 0, 1
+
+# Initial values of the shared best move
+NO_VALUE = int(-1e10)
+NO_INDEX = 2**62
+
+# Worker process state (see init_worker)
+worker_search = None
+worker_search_id = None
+shared_best = None
+
+def init_worker(evaluation_function: Callable, table_size_mb: float, table_name: str, best):
+    '''Creates the search object of a worker process, attached to the shared transposition table if there is one'''
+    global worker_search, shared_best
+    table = SharedTranspositionTable(name=table_name) if table_name else None
+    worker_search = Search(evaluation_function, table_size_mb=table_size_mb, table=table)
+    shared_best = best
+
+def search_root_move(state: State, move: int, index: int, depth: int, deadline: float, search_id: int):
+    '''
+    Searches one of the root moves (given by its code, see tak.MoveTable) in a worker process and returns its
+    index and value (None if the search was stopped by the time limit), along with whether the value is exact.
+    '''
+    global worker_search_id
+    search = worker_search
+
+    # Consecutive tasks of the same search share the killer moves, history and transposition table generation
+    if search_id != worker_search_id:
+        worker_search_id = search_id
+        search.new_search()
+        if search.caching:
+            search.table.new_search()
+
+    search.deadline = deadline
+    search.stopped = False
+    search.nodes = 0
+
+    with shared_best.get_lock():
+        best_value, best_index = shared_best[BEST_VALUE], shared_best[BEST_INDEX]
+
+    # Moves searched before the current best one by the serial search win ties, so they must prove they
+    # are at least as good (instead of strictly better) to replace it
+    alpha = best_value - 1 if index < best_index else best_value
+    beta = int(1e10)
+
+    state.apply_code(move)
+    value = -search.negamax_recursive(state, depth - 1, -beta, -alpha, 1)[0]
+
+    if search.stopped:
+        return index, None, False
+
+    # With an infinite beta, any value above alpha is exact
+    exact = value > alpha
+    if exact:
+        with shared_best.get_lock():
+            if value > shared_best[BEST_VALUE] or (value == shared_best[BEST_VALUE] and index < shared_best[BEST_INDEX]):
+                shared_best[BEST_VALUE] = value
+                shared_best[BEST_INDEX] = index
+
+    return index, value, exact
+
+class ParallelSearch:
+    '''
+    Negamax search that splits the moves of the root between a pool of worker processes. At a fixed depth
+    it returns the same best move as Search.negamax (ties are broken in favour of the move the serial search
+    would have tried first), with the same interface for fixed depth and time-limited searches.
+    '''
+
+    def __init__(self, evaluation_function: Callable = evaluate_hard, workers: int = None, table_size_mb: float = 16, shared_table: bool = True):
+        self.workers = workers or os.cpu_count()
+
+        # With a shared table, the workers attach to the table created here. Otherwise each one has a private table
+        self.table = SharedTranspositionTable(table_size_mb) if shared_table else None
+        table_name = self.table.name if shared_table else None
+
+        # Orders the root moves (with the same criteria as the workers)
+        self.search = Search(evaluation_function, table_size_mb=table_size_mb, table=self.table)
+
+        self.shared_best = multiprocessing.Array('q', 2)
+        self.pool = ProcessPoolExecutor(self.workers, initializer=init_worker,
+            initargs=(evaluation_function, table_size_mb, table_name, self.shared_best))
+        self.search_id = 0
+
+        # Result of the last completed search
+        self.best_value = None
+        self.completed_depth = 0
+        self.total_time = 0
+
+    def close(self):
+        '''Stops the worker processes and removes the shared table'''
+        self.pool.shutdown()
+        if self.table is not None:
+            self.table.close()
+
+    def negamax(self, state: State, depth: int):
+        '''Returns the best move found for the given state when searching to the given depth (see Search.negamax)'''
+        start = time.time()
+        self.search.new_search()
+        move = self.search_depth(state, depth, None)
+        self.total_time = time.time() - start
+        return move
+
+    def iterative_deepening(self, state: State, time_limit: float, max_depth: int = 64):
+        '''Searches with increasing depths until the time limit runs out (see Search.iterative_deepening)'''
+        start = time.time()
+        best_move = None
+        self.completed_depth = 0
+        self.search.new_search()
+
+        for depth in range(1, max_depth + 1):
+            # The first search is always completed, so that a move is returned even with a tiny time limit
+            deadline = start + time_limit if depth > 1 else None
+
+            move = self.search_depth(state, depth, deadline, get_move_table(state.board_size).encode(best_move))
+            if move is None:
+                break
+
+            best_move = move
+            self.completed_depth = depth
+
+            if abs(self.best_value) >= WIN_THRESHOLD or time.time() >= start + time_limit:
+                break
+
+        self.total_time = time.time() - start
+        return best_move
+
+    def search_depth(self, state: State, depth: int, deadline: float, hash_move: int = NO_MOVE):
+        '''Searches every root move to the given depth, returning the best one (or None if the search was stopped)'''
+        moves = []
+        state.generate_moves(moves)
+        if depth <= 0 or not moves:
+            return None
+
+        self.search.order_moves(state, moves, hash_move, 0)
+
+        self.search_id += 1
+        if self.table is not None:
+            self.table.new_search()
+
+        with self.shared_best.get_lock():
+            self.shared_best[BEST_VALUE] = NO_VALUE
+            self.shared_best[BEST_INDEX] = NO_INDEX
+
+        # The first move is searched before the others, to give them a good alpha
+        first = self.pool.submit(search_root_move, state, moves[0], 0, depth, deadline, self.search_id)
+        if first.result()[1] is None:
+            return None
+
+        results = [self.pool.submit(search_root_move, state, move, i, depth, deadline, self.search_id) for i, move in enumerate(moves[1:], 1)]
+        if any(result.result()[1] is None for result in results):
+            return None
+
+        with self.shared_best.get_lock():
+            self.best_value = self.shared_best[BEST_VALUE]
+            return state.decode_move(moves[self.shared_best[BEST_INDEX]])
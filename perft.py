@@ -0,0 +1,175 @@
+from array import array
+import argparse
+import time
+
+from tak import State, Result, PlaceFlat, PlaceWall, PlaceCap, MovePiece, SplitStack
+from bitboard import BitboardState
+from persistent import PersistentState
+from utils import Position, directions
+
+# Perft: counts the positions reachable from a position in a number of plies by playing every move returned by
+# State.possible_moves (the moves of State.generate_moves, decoded), which checks move generation and playing moves. The counts
+# of the reference positions below were obtained by both the list-based State and BitboardState, so any change to
+# move generation or to the representation of the board must keep them unchanged.
+#
+# Moves are played in place and undone (like in the search), or, with copying, played on copies of the state (like
+# in Move.play), and both must give the same counts. Finished games have no moves, so they aren't expanded. With
+# codes, moves are generated as integers (see tak.MoveTable) in a buffer per ply, which is how the search plays them.
+
+DOWN, LEFT = directions['DOWN'], directions['LEFT']
+
+# Moves leading to the reference positions: a few placements followed by moves and spreads that build stacks
+# (valid on every board size) and, on the boards with capstones, a capstone that flattens a wall
+STACKS_OPENING = [
+    PlaceFlat(Position(0, 0)), PlaceFlat(Position(2, 2)), PlaceFlat(Position(1, 1)), PlaceFlat(Position(1, 2)),
+    PlaceWall(Position(0, 1)), MovePiece(Position(1, 2), LEFT), PlaceFlat(Position(1, 2)),
+    SplitStack(Position(1, 1), DOWN, (0, 2))
+]
+
+CAPSTONE_OPENING = STACKS_OPENING + [
+    PlaceCap(Position(0, 2)), PlaceWall(Position(2, 0)), MovePiece(Position(0, 2), LEFT), PlaceFlat(Position(3, 3))
+]
+
+# Board size -> (name, moves from the initial position, number of positions reachable in 1, 2, ... plies)
+REFERENCE_POSITIONS = {
+    3: [
+        ('initial', [], [9, 72, 1200, 17792, 271812]),
+        ('stacks', STACKS_OPENING, [16, 209, 3267, 41375, 636719]),
+    ],
+    4: [
+        ('initial', [], [16, 240, 7440, 216464]),
+        ('stacks', STACKS_OPENING, [33, 1004, 32485, 925744]),
+    ],
+    5: [
+        ('initial', [], [25, 600, 43320]),
+        ('stacks', STACKS_OPENING, [71, 4844, 308224]),
+        ('capstone', CAPSTONE_OPENING, [52, 3509, 179412]),
+    ],
+    6: [
+        ('initial', [], [36, 1260, 132720]),
+        ('capstone', CAPSTONE_OPENING, [74, 7425]),
+    ],
+    7: [
+        ('initial', [], [49, 2352, 339696]),
+        ('capstone', CAPSTONE_OPENING, [100, 13925]),
+    ],
+    8: [
+        ('initial', [], [64, 4032, 764064]),
+        ('capstone', CAPSTONE_OPENING, [187, 34419]),
+    ],
+}
+
+def load_position(board_size: int, moves: list, state_class: type = State) -> State:
+    '''Returns the state reached by playing the given moves from the initial position (raises ValueError if one of them is invalid)'''
+    state = state_class(board_size)
+    for move in moves:
+        if state.objective() != Result.NOT_FINISHED or not move.is_valid(state):
+            raise ValueError(f'Invalid move in a {board_size}x{board_size} position: {move}')
+        move.apply(state)
+    return state
+
+def perft(state: State, depth: int, copying: bool = False) -> int:
+    '''Returns the number of positions reachable from the given state in exactly depth plies'''
+    if depth == 0:
+        return 1
+
+    total = 0
+
+    if copying:
+        for move in state.possible_moves():
+            total += perft(move.play(state), depth - 1, True)
+    else:
+        for move in state.possible_moves():
+            undo_info = move.apply(state)
+            total += perft(state, depth - 1)
+            move.undo(state, undo_info)
+
+    return total
+
+def perft_codes(state: State, depth: int, buffers: list = None) -> int:
+    '''Same as perft, generating the moves as codes (see State.generate_moves) in a buffer reused by every node of each ply'''
+    if depth == 0:
+        return 1
+
+    if buffers is None:
+        buffers = [array('i') for _ in range(depth)]
+
+    moves = buffers[depth - 1]
+    del moves[:]
+    state.generate_moves(moves)
+
+    total = 0
+    for code in moves:
+        undo_info = state.apply_code(code)
+        total += perft_codes(state, depth - 1, buffers)
+        state.undo_code(code, undo_info)
+
+    return total
+
+def count(state: State, depth: int, copying: bool = False, codes: bool = False) -> int:
+    '''Runs perft in the given mode (codes takes precedence over copying)'''
+    return perft_codes(state, depth) if codes else perft(state, depth, copying)
+
+def divide(state: State, depth: int, copying: bool = False) -> list:
+    '''Returns the number of positions reachable through each move of the given state, in the order the moves are generated'''
+    return [(move, perft(move.play(state), depth - 1, copying)) for move in state.possible_moves()]
+
+def check_references(state_class: type = State, copying: bool = False, max_depth: int = None, verbose: bool = False,
+        codes: bool = False) -> list:
+    '''Runs perft on the reference positions, returning a list of (board size, name, depth, expected, obtained) of the wrong counts'''
+    errors = []
+
+    for board_size, positions in REFERENCE_POSITIONS.items():
+        for name, moves, counts in positions:
+            state = load_position(board_size, moves, state_class)
+
+            for depth, expected in enumerate(counts[:max_depth], 1):
+                start = time.time()
+                obtained = count(state, depth, copying, codes)
+
+                if verbose:
+                    status = 'ok' if obtained == expected else f'expected {expected}'
+                    print(f'{board_size}x{board_size} {name}, depth {depth}: {obtained} ({time.time() - start:.2f}s, {status})')
+
+                if obtained != expected:
+                    errors.append((board_size, name, depth, expected, obtained))
+
+    return errors
+
+def benchmark(state: State, depth: int, copying: bool = False, codes: bool = False):
+    '''Runs perft on the given state, returning the number of positions and the number of positions per second'''
+    start = time.time()
+    nodes = count(state, depth, copying, codes)
+    elapsed = time.time() - start
+    return nodes, nodes / elapsed if elapsed > 0 else float('inf')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Counts the positions reachable from a reference position (perft)')
+    parser.add_argument('size', type=int, nargs='?', default=5, help='board size')
+    parser.add_argument('depth', type=int, nargs='?', default=2, help='number of plies')
+    parser.add_argument('--position', default='initial', help='name of the reference position (see REFERENCE_POSITIONS)')
+    parser.add_argument('--bitboard', action='store_true', help='use the bitboard representation of the board')
+    parser.add_argument('--persistent', action='store_true', help='use the persistent representation of the board (see persistent.py)')
+    parser.add_argument('--copying', action='store_true', help='play moves on copies of the state instead of undoing them')
+    parser.add_argument('--codes', action='store_true', help='generate and play moves as integer codes, like the search')
+    parser.add_argument('--divide', action='store_true', help='print the number of positions reachable through each move')
+    parser.add_argument('--check', type=int, nargs='?', const=0, metavar='DEPTH',
+        help='check the counts of every reference position, up to the given depth (every count by default)')
+    args = parser.parse_args()
+
+    state_class = BitboardState if args.bitboard else PersistentState if args.persistent else State
+
+    if args.check is not None:
+        errors = check_references(state_class, args.copying, args.check or None, verbose=True, codes=args.codes)
+        print(f'{len(errors)} wrong counts')
+        exit(1 if errors else 0)
+
+    positions = { name: moves for name, moves, _ in REFERENCE_POSITIONS[args.size] }
+    state = load_position(args.size, positions[args.position], state_class)
+
+    if args.divide:
+        for move, count in divide(state, args.depth, args.copying):
+            print(f'{move}: {count}')
+
+    nodes, speed = benchmark(state, args.depth, args.copying, args.codes)
+    print(f'{args.size}x{args.size} {args.position}, depth {args.depth}: {nodes} positions ({speed:.0f} positions/s)')
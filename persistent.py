@@ -0,0 +1,172 @@
+from typing import List
+
+from tak import State, Piece, PieceType, Player
+from utils import Position
+
+# The board of a persistent state is a tuple of rows, each a tuple of stacks, and each stack a tuple of pieces (which
+# are immutable and shared, see tak.Piece). Changing a square replaces its stack, its row and the tuple of rows, so the
+# state after a move shares every other row and stack with the state before it, and copying a state only copies the
+# few attributes that are changed in place (the masks and the results of the moves applied to it).
+
+class PersistentState(State):
+    '''
+    Game state whose board and reserves are never modified, only replaced. Move.play returns a new state that shares
+    every untouched stack (and the reserve counts, unless the move is a placement) with its parent, so the states of a
+    whole game (or of a search tree) can be kept in memory for the cost of the squares changed by each move. Moves can
+    also be applied and undone in place, like in State.
+    '''
+
+    def __init__(self, board_size = 5):
+        super().__init__(board_size)
+        self.board = tuple(tuple(() for _ in range(board_size)) for _ in range(board_size))
+
+    @staticmethod
+    def from_state(state: State):
+        '''Converts any game state into a persistent game state'''
+        persistent_state = PersistentState(state.board_size)
+
+        persistent_state.first_turn = state.first_turn
+        persistent_state.current_player = state.current_player
+        persistent_state.num_flats = dict(state.num_flats)
+        persistent_state.num_caps = dict(state.num_caps)
+        persistent_state.board = tuple(tuple(tuple(stack) for stack in row) for row in state.board)
+
+        for row in range(state.board_size):
+            for col in range(state.board_size):
+                persistent_state.update_masks(row, col)
+
+        persistent_state.hash = persistent_state.compute_hash()
+        persistent_state.result = state.result
+        return persistent_state
+
+    def copy(self):
+        '''Returns a copy of the game state, which shares the board and the reserves with this one'''
+        state_copy = PersistentState.__new__(PersistentState)
+        state_copy.__dict__.update(self.__dict__)
+
+        state_copy.road_masks = self.road_masks.copy()
+        state_copy.flat_masks = self.flat_masks.copy()
+        state_copy.wall_masks = self.wall_masks.copy()
+        state_copy.previous_results = []
+
+        return state_copy
+
+    def set_stack(self, row: int, col: int, stack: tuple):
+        '''Replaces the stack at the given position (along with its row and the tuple of rows)'''
+        board_row = self.board[row]
+        board_row = board_row[:col] + (stack, ) + board_row[col + 1:]
+        self.board = self.board[:row] + (board_row, ) + self.board[row + 1:]
+
+    def place(self, pos: Position, piece_type: PieceType) -> bool:
+        '''
+        Places a new piece of the given type on an empty square and passes the turn (the move is assumed to be valid).
+        Returns the previous value of first_turn, which is needed to undo the placement.
+        '''
+        first_turn = self.first_turn
+        color = self.current_player
+
+        if piece_type == PieceType.FLAT and self.first_turn:
+            # During the first turn, players place one of their opponent's flat pieces
+            color = -self.current_player
+
+            if self.current_player == Player.BLACK:
+                self.first_turn = False
+                self.hash ^= self.zobrist.first_turn
+
+        # The reserves are replaced instead of modified, since they may be shared with other states
+        if piece_type == PieceType.CAPSTONE:
+            self.num_caps = { **self.num_caps, color: self.num_caps[color] - 1 }
+        else:
+            self.num_flats = { **self.num_flats, color: self.num_flats[color] - 1 }
+
+        piece = Piece(color, piece_type)
+        self.set_stack(pos.row, pos.col, (piece, ))
+        self.hash ^= self.zobrist.piece(pos.row * self.board_size + pos.col, 0, piece.variant) ^ self.zobrist.black_to_move
+
+        self.update_masks(pos.row, pos.col)
+        self.update_result(1 << (pos.row * self.board_size + pos.col))
+
+        self.current_player = -self.current_player
+        return first_turn
+
+    def unplace(self, pos: Position, first_turn: bool):
+        '''Reverts a placement, given the value returned by place'''
+        self.current_player = -self.current_player
+
+        piece = self.board[pos.row][pos.col][-1]
+        if piece.type == PieceType.CAPSTONE:
+            self.num_caps = { **self.num_caps, piece.color: self.num_caps[piece.color] + 1 }
+        else:
+            self.num_flats = { **self.num_flats, piece.color: self.num_flats[piece.color] + 1 }
+
+        self.set_stack(pos.row, pos.col, ())
+        self.hash ^= self.zobrist.piece(pos.row * self.board_size + pos.col, 0, piece.variant) ^ self.zobrist.black_to_move
+        if first_turn != self.first_turn:
+            self.hash ^= self.zobrist.first_turn
+
+        self.update_masks(pos.row, pos.col)
+        self.restore_result()
+
+        self.first_turn = first_turn
+
+    def spread(self, pos: Position, direction: Position, split: List[int]) -> bool:
+        '''
+        Picks up the stack at the given position and drops split[i] pieces (taken from the bottom)
+        i squares away in the given direction, then passes the turn (the move is assumed to be valid).
+        Returns whether a wall was flattened, which is needed to undo the spread.
+        '''
+        self.hash ^= self.spread_hash(pos, direction, split)
+
+        flattened = False
+        stack = self.board[pos.row][pos.col]
+
+        # The pieces left behind
+        self.set_stack(pos.row, pos.col, stack[:split[0]])
+        self.update_masks(pos.row, pos.col)
+        changed = 1 << (pos.row * self.board_size + pos.col)
+        stack = stack[split[0]:]
+
+        for i in range(1, len(split)):
+            pos_to = pos + direction.scalar_mult(i)
+            stack_to = self.board[pos_to.row][pos_to.col]
+            stack_slice, stack = stack[:split[i]], stack[split[i]:]
+
+            if stack_to and stack_slice[0].type == PieceType.CAPSTONE and stack_to[-1].type == PieceType.WALL:
+                # Capstone converts a wall to a flat piece
+                stack_to = stack_to[:-1] + (Piece(stack_to[-1].color, PieceType.FLAT), )
+                flattened = True
+
+            self.set_stack(pos_to.row, pos_to.col, stack_to + stack_slice)
+            self.update_masks(pos_to.row, pos_to.col)
+            changed |= 1 << (pos_to.row * self.board_size + pos_to.col)
+
+        self.update_result(changed)
+
+        self.current_player = -self.current_player
+        return flattened
+
+    def unspread(self, pos: Position, direction: Position, split: List[int], flattened: bool):
+        '''Reverts a spread, given the value returned by spread'''
+        self.current_player = -self.current_player
+        stack = self.board[pos.row][pos.col]
+
+        # The pieces dropped on each square are on top of its stack, and are given back in order
+        for i in range(1, len(split)):
+            pos_to = pos + direction.scalar_mult(i)
+            stack_to = self.board[pos_to.row][pos_to.col]
+            height = len(stack_to) - split[i]
+
+            stack += stack_to[height:]
+            stack_to = stack_to[:height]
+
+            if flattened and i == len(split) - 1:
+                stack_to = stack_to[:-1] + (Piece(stack_to[-1].color, PieceType.WALL), )
+
+            self.set_stack(pos_to.row, pos_to.col, stack_to)
+            self.update_masks(pos_to.row, pos_to.col)
+
+        self.set_stack(pos.row, pos.col, stack)
+        self.update_masks(pos.row, pos.col)
+        self.restore_result()
+
+        self.hash ^= self.spread_hash(pos, direction, split)
@@ -0,0 +1,728 @@
+from array import array
+from typing import Callable
+import time
+
+from tak import State, CachingFlag, evaluate_hard, get_move_table, NO_MOVE
+from transposition import TranspositionTable
+from utils import get_geometry
+
+# Values above this threshold can only be obtained from a finished game (see evaluate) or from a position proven by
+# the solver, whose game ends a number of plies later (see solution_value)
+WIN_THRESHOLD = int(1e9) - 1000
+
+# Move ordering priorities (moves with the same priority are ordered by their history score)
+HASH_MOVE = 4
+WINNING_MOVE = 3
+BLOCKING_MOVE = 2
+KILLER_MOVE = 1
+OTHER_MOVE = 0
+
+# Maximum distance from the root for which killer moves are kept
+MAX_PLY = 64
+
+# Moves are searched as integer codes (see tak.MoveTable): the moves of each node are generated in a buffer that is
+# reused by every node at the same distance from the root, and the killer and history tables and the transposition
+# table hold codes. Codes are only converted to Move objects for the best move of the root (or from them, for the
+# moves of the opening book and the solver), so the public interface of the search is unchanged.
+
+def solution_value(outcome: int, distance: int, depth: int) -> int:
+    '''
+    Returns the value of a position proven by the solver (see solver.py) at the given depth, which is the value
+    of the finished game reached distance plies later (the distance is an upper bound, so a proven win may be
+    valued below its shortest line)
+    '''
+    if outcome == 0:
+        return 0
+    return outcome * (int(1e9) + depth - distance)
+
+class SearchStats:
+    '''
+    Instrumentation of the searches it is given to (see Search.stats), accumulated over every search until it is
+    reset: the nodes and cutoffs at each distance from the root, the nodes of each depth of iterative deepening,
+    the transposition table probes, hits and stores and, optionally, the time spent generating, ordering and
+    playing moves and evaluating positions. Searches without statistics only check that they have none.
+    '''
+
+    def __init__(self, timing: bool = True):
+        self.timing = timing
+        self.reset()
+
+    def reset(self):
+        self.searches = 0
+
+        # Counters for each distance from the root (ply)
+        self.nodes = array('q', [0]) * (MAX_PLY + 1)
+        self.cutoffs = array('q', [0]) * (MAX_PLY + 1)
+        self.first_move_cutoffs = array('q', [0]) * (MAX_PLY + 1)
+
+        # Nodes of the iterations of iterative deepening that completed each depth, and of the previous iteration of
+        # the same searches, so that the effective branching factor of each depth compares the same searches
+        self.depth_nodes = array('q', [0]) * (MAX_PLY + 1)
+        self.previous_depth_nodes = array('q', [0]) * (MAX_PLY + 1)
+
+        self.probes = 0
+        self.hits = 0
+        self.cache_hits = 0 # Hits deep enough for their values to be used
+        self.table_cutoffs = 0
+        self.stores = 0
+
+        self.time_possible_moves = 0
+        self.time_ordering = 0
+        self.time_playing_moves = 0
+        self.time_evaluating = 0
+        self.total_time = 0
+
+    def merge(self, other):
+        '''Adds the statistics of other to these'''
+        self.searches += other.searches
+
+        for counters, other_counters in ((self.nodes, other.nodes), (self.cutoffs, other.cutoffs),
+                (self.first_move_cutoffs, other.first_move_cutoffs), (self.depth_nodes, other.depth_nodes),
+                (self.previous_depth_nodes, other.previous_depth_nodes)):
+            for i, value in enumerate(other_counters):
+                counters[i] += value
+
+        for name in ('probes', 'hits', 'cache_hits', 'table_cutoffs', 'stores', 'time_possible_moves', 'time_ordering',
+                'time_playing_moves', 'time_evaluating', 'total_time'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def nodes_searched(self) -> int:
+        return sum(self.nodes)
+
+    def cache_hit_rate(self) -> float:
+        '''Returns the fraction of nodes whose value (or bounds) were taken from the transposition table'''
+        nodes = self.nodes_searched()
+        return self.cache_hits / nodes if nodes else 0
+
+    def first_move_cutoff_rate(self) -> float:
+        '''Returns the fraction of cutoffs caused by the first move searched (a measure of the quality of the move ordering)'''
+        cutoffs = sum(self.cutoffs)
+        return sum(self.first_move_cutoffs) / cutoffs if cutoffs else 0
+
+    def branching_factors(self) -> list:
+        '''Returns the effective branching factor of each depth (the ratio between its nodes and the nodes of the previous depth)'''
+        return [self.depth_nodes[depth] / self.previous_depth_nodes[depth] for depth in range(2, MAX_PLY + 1) if self.previous_depth_nodes[depth]]
+
+    def to_dict(self) -> dict:
+        '''Returns the statistics in a JSON-compatible format'''
+        # Counters are reported up to the deepest ply reached
+        plies = max((ply + 1 for ply, nodes in enumerate(self.nodes) if nodes), default=0)
+        depths = max((depth + 1 for depth, nodes in enumerate(self.depth_nodes) if nodes), default=1)
+
+        return {
+            'searches': self.searches,
+            'nodes': self.nodes_searched(),
+            'nodes_per_ply': list(self.nodes[:plies]),
+            'cutoffs_per_ply': list(self.cutoffs[:plies]),
+            'nodes_per_depth': list(self.depth_nodes[1:depths]),
+            'branching_factors': self.branching_factors(),
+            'first_move_cutoff_rate': self.first_move_cutoff_rate(),
+            'table': {
+                'probes': self.probes,
+                'hits': self.hits,
+                'cache_hits': self.cache_hits,
+                'cutoffs': self.table_cutoffs,
+                'stores': self.stores,
+                'cache_hit_rate': self.cache_hit_rate()
+            },
+            'time': {
+                'possible_moves': self.time_possible_moves,
+                'ordering': self.time_ordering,
+                'playing_moves': self.time_playing_moves,
+                'evaluating': self.time_evaluating,
+                'total': self.total_time
+            }
+        }
+
+class Search:
+    '''
+    Negamax search that owns its transposition table. The same search object can be used for every
+    move of a player during a game, so that each search starts with the knowledge obtained by the
+    previous ones while the memory used by the table stays fixed.
+    '''
+
+    # Number of nodes searched between consecutive checks of the time limit
+    TIME_CHECK_INTERVAL = 1024
+
+    def __init__(self, evaluation_function: Callable = evaluate_hard, pruning: bool = True, caching: bool = True, table_size_mb: float = 16,
+            ordering: bool = True, batch_size: int = 0, table = None, book = None, canonical: bool = False,
+            solutions = None, stats: SearchStats = None):
+        self.evaluation_function = evaluation_function
+        self.pruning = pruning
+        self.caching = caching
+
+        # A table can be given instead of creating a new one (such as a table shared with other processes)
+        self.table = None
+        if caching:
+            self.table = table if table is not None else TranspositionTable(table_size_mb)
+        self.ordering = ordering
+
+        # Instrumentation (see SearchStats), which can be given or removed between searches
+        self.stats = stats
+
+        # Canonical mode: positions are stored in the table under the hash of their canonical representative among
+        # the symmetric positions (see State.canonical_hash), so a position also finds the entries of its rotations
+        # and reflections. Moves are stored for the canonical orientation and transformed back when probing
+        self.canonical = canonical
+
+        # Opening book (see book.OpeningBook) consulted before searching, so that opening moves only cost a lookup
+        self.book = book
+
+        # Table of positions proven by the solver (see solver.SolutionTable), which are not searched
+        self.solutions = solutions
+
+        # Batched leaf evaluation (see batch.py): the children of nodes at depth 1 are evaluated together, in groups of
+        # up to batch_size states (see search_leaves). NumPy is only needed when this mode is used. It is off by default:
+        # BitboardState updates its evaluation incrementally, which costs a few microseconds per leaf against about ten
+        # for a row of a full batch. Batching can only pay off for states that are evaluated from scratch (with the
+        # list-based State, whose evaluation takes about 100 microseconds, it currently breaks even)
+        self.batch_size = batch_size
+        self.batches = {}
+        if batch_size:
+            from batch import evaluation_level
+            self.level = evaluation_level(evaluation_function)
+
+        # Move ordering: the last two moves that caused a cutoff at each distance from the root (killer moves,
+        # killers[2 * ply] and killers[2 * ply + 1]) and how often each move caused a cutoff, weighted by the depth
+        # of the search (history heuristic)
+        self.killers = array('i', [NO_MOVE]) * (2 * MAX_PLY)
+        self.history = {}
+
+        # Buffers where the moves of the nodes at each distance from the root are generated and ordered. They are
+        # lists rather than arrays, which can't be sorted in place
+        self.move_buffers = []
+
+        # Time limit of the current search (None if the search is only limited by depth)
+        self.deadline = None
+        self.stopped = False
+        self.nodes = 0
+
+        # Optional function called with the search as argument every TIME_CHECK_INTERVAL nodes and after each depth
+        # completed by iterative deepening (so that the progress of the search can be reported). The search is
+        # cancelled if the function returns True
+        self.callback = None
+
+        # Progress of the current search: when it started and the nodes searched by the previous depths
+        self.start_time = 0
+        self.total_nodes = 0
+
+        # Result of the last completed search (or depth, during iterative deepening)
+        self.best_value = None
+        self.best_move = None
+        self.completed_depth = 0
+        self.total_time = 0
+
+    def new_search(self):
+        '''Prepares the move ordering tables for a new search from a different root'''
+        self.killers = array('i', [NO_MOVE]) * (2 * MAX_PLY)
+
+        # Older history scores are less relevant to the new position
+        for move in self.history:
+            self.history[move] //= 2
+
+    def order_moves(self, state: State, moves: list, hash_move: int, ply: int):
+        '''
+        Sorts the given list of move codes in place so that the ones most likely to cause a cutoff are searched first: the best
+        move stored in the transposition table, placements that complete a road, placements that block one of
+        the opponent's roads, the killer moves for this ply and then the remaining moves by history score.
+        '''
+        num_placements = get_move_table(state.board_size).num_placements
+        own_threats = state.road_threats(state.current_player)
+        opponent_threats = state.road_threats(-state.current_player)
+        killer, second_killer = (self.killers[2 * ply], self.killers[2 * ply + 1]) if ply < MAX_PLY else (NO_MOVE, NO_MOVE)
+        history = self.history
+
+        def priority(move):
+            if move == hash_move:
+                return HASH_MOVE, 0
+
+            # Placements are encoded as 3 * square + 0 (flat), 1 (wall) or 2 (capstone)
+            if move < num_placements:
+                bit = 1 << (move // 3)
+
+                if own_threats & bit and move % 3 != 1:
+                    return WINNING_MOVE, 0
+                if opponent_threats & bit:
+                    return BLOCKING_MOVE, 0
+
+            if move == killer or move == second_killer:
+                return KILLER_MOVE, 0
+
+            return OTHER_MOVE, history.get(move, 0)
+
+        moves.sort(key=priority, reverse=True)
+
+    def update_ordering(self, move: int, depth: int, ply: int):
+        '''Records a move that caused a cutoff in the killer and history tables'''
+        if ply < MAX_PLY:
+            killers = self.killers
+            if move != killers[2 * ply]:
+                killers[2 * ply + 1] = killers[2 * ply]
+                killers[2 * ply] = move
+
+        self.history[move] = self.history.get(move, 0) + depth * depth
+
+    def check_stop(self) -> bool:
+        '''Returns whether the current search must stop, because the time is up or it was cancelled'''
+        if self.deadline is not None and time.time() >= self.deadline:
+            return True
+        return self.callback is not None and self.callback(self)
+
+    def nodes_searched(self) -> int:
+        '''Returns the number of nodes searched so far by the current search (including every depth of iterative deepening)'''
+        return self.total_nodes + self.nodes
+
+    def get_batch(self, board_size: int):
+        '''Returns the (reusable) leaf batch for the given board size'''
+        if board_size not in self.batches:
+            from batch import LeafBatch
+            self.batches[board_size] = LeafBatch(board_size, self.batch_size)
+        return self.batches[board_size]
+
+    def leaf_table_value(self, state: State, alpha: int, beta: int):
+        '''
+        Returns the value of a leaf found in the table of proven positions or the transposition table, which
+        negamax_recursive would return for it with the window alpha, beta (None if the leaf has to be evaluated)
+        '''
+        if self.solutions is not None:
+            solution = self.solutions.lookup(state)
+            if solution is not None:
+                return solution_value(solution[1], solution[2], 0)
+
+        if not self.caching:
+            return None
+
+        key = state.canonical_hash()[0] if self.canonical else state.hash
+        entry = self.table.probe(key)
+
+        stats = self.stats
+        if stats is not None:
+            stats.probes += 1
+            if entry:
+                stats.hits += 1
+
+        if not entry:
+            return None
+
+        # Every entry is at least as deep as a leaf
+        _, flag, value, _ = entry
+        if stats is not None:
+            stats.cache_hits += 1
+
+        if flag == CachingFlag.EXACT:
+            return value
+        elif flag == CachingFlag.LOWERBOUND:
+            alpha = max(alpha, value)
+        elif flag == CachingFlag.UPPERBOUND:
+            beta = min(beta, value)
+
+        if alpha >= beta:
+            if stats is not None:
+                stats.table_cutoffs += 1
+            return value
+        return None
+
+    def search_leaves(self, state: State, moves: list, alpha: int, beta: int, ply: int):
+        '''
+        Searches the moves of a node at depth 1 by evaluating the resulting states in batches. The moves are applied
+        and undone one at a time while the batch is filled: leaves found in the transposition table (see
+        leaf_table_value) are not evaluated, and the cutoff test is done after each of them and after each batch.
+        Since the moves are ordered, the first one (the most likely to cause a cutoff) is evaluated alone and the
+        batches then double in size up to batch_size, so a cutoff skips most of the evaluations it would skip
+        without batching. Returns the best value and move, like negamax_recursive.
+        '''
+        stats = self.stats
+        timing = stats is not None and stats.timing
+        batch = self.get_batch(state.board_size)
+        evaluation_function = self.evaluation_function
+
+        best_move = NO_MOVE
+        max_value = int(-1e10)
+
+        group = []
+        group_size = 1
+        index = 0
+
+        while index < len(moves):
+            # The stop condition is checked whenever the leaves of the group reach a multiple of TIME_CHECK_INTERVAL nodes
+            if self.nodes // Search.TIME_CHECK_INTERVAL != (self.nodes + group_size) // Search.TIME_CHECK_INTERVAL and self.check_stop():
+                self.stopped = True
+                return 0, NO_MOVE
+
+            batch.clear()
+            del group[:]
+            first = index
+
+            # Values of the leaves of the group (None until they are evaluated)
+            values = [None] * min(group_size, len(moves) - first)
+
+            for i in range(len(values)):
+                move = moves[index]
+                index += 1
+
+                if timing:
+                    start = time.time()
+
+                undo_info = state.apply_code(move)
+
+                if timing:
+                    end = time.time()
+                    stats.time_playing_moves += end - start
+
+                value = self.leaf_table_value(state, -beta, -alpha)
+                if value is None:
+                    if group_size == 1:
+                        value = evaluation_function(state, state.current_player, 0)
+                    else:
+                        batch.add(state)
+                        group.append(i)
+
+                if timing:
+                    start = time.time()
+                    stats.time_evaluating += start - end
+
+                state.undo_code(move, undo_info)
+
+                if timing:
+                    stats.time_playing_moves += time.time() - start
+
+                values[i] = value
+
+                # A leaf found in the table can cause a cutoff before the batch is evaluated
+                if self.pruning and value is not None and -value >= beta:
+                    break
+
+            if group:
+                if timing:
+                    start = time.time()
+
+                evaluations = batch.evaluate(0, self.level)
+                for j, i in enumerate(group):
+                    values[i] = int(evaluations[j])
+
+                if timing:
+                    stats.time_evaluating += time.time() - start
+
+            self.nodes += index - first
+            if stats is not None:
+                stats.nodes[min(ply + 1, MAX_PLY)] += index - first
+
+            for i, value in enumerate(values):
+                if value is None:
+                    break
+
+                value = -value
+                move = moves[first + i]
+
+                if value > max_value:
+                    max_value = value
+                    best_move = move
+
+                if self.pruning:
+                    alpha = max(alpha, max_value)
+                    if alpha >= beta:
+                        if stats is not None:
+                            stats.cutoffs[min(ply, MAX_PLY)] += 1
+                            if first + i == 0:
+                                stats.first_move_cutoffs[min(ply, MAX_PLY)] += 1
+
+                        if self.ordering:
+                            self.update_ordering(move, 1, ply)
+                        return max_value, best_move
+
+            group_size = min(2 * group_size, self.batch_size)
+
+        return max_value, best_move
+
+    def negamax(self, state: State, depth: int):
+        '''
+        Implementation of the negamax algorithm, a variant of minimax that takes advantage of the
+        zero-sum property of two-player adversarial games. Returns the best move found for the given
+        state when searching to the given depth.
+        '''
+
+        if depth <= 0:
+            return None
+
+        self.deadline = None
+        self.new_search()
+
+        start = time.time()
+        self.start_time = start
+        self.total_nodes = 0
+
+        move = self.book_move(state)
+        if move is not None:
+            return move
+
+        move = self.search_depth(state, depth)
+        self.total_time = time.time() - start
+
+        self.best_move = move
+        if move is not None:
+            self.completed_depth = depth
+
+        if self.stats is not None:
+            self.stats.searches += 1
+            self.stats.total_time += self.total_time
+
+        return move
+
+    def iterative_deepening(self, state: State, time_limit: float, max_depth: int = 64):
+        '''
+        Searches the given state with increasing depths until the time limit (in seconds) runs out or
+        max_depth is reached, returning the best move of the deepest search that was completed. Each
+        search tries the best moves found by the previous one first (they are kept in the transposition
+        table), which makes the shallower searches pay for themselves through better pruning.
+        '''
+
+        start = time.time()
+        best_move = None
+        self.start_time = start
+        self.total_nodes = 0
+        self.best_move = None
+        self.completed_depth = 0
+        self.new_search()
+
+        best_move = self.book_move(state)
+        if best_move is not None:
+            return best_move
+
+        stats = self.stats
+        previous_nodes = 0
+
+        for depth in range(1, max_depth + 1):
+            # The first search is always completed, so that a move is returned even with a tiny time limit
+            self.deadline = start + time_limit if depth > 1 else None
+
+            total_nodes = self.total_nodes
+            move = self.search_depth(state, depth)
+            if self.stopped or move is None:
+                break
+
+            if stats is not None and depth <= MAX_PLY:
+                nodes = self.total_nodes - total_nodes
+                stats.depth_nodes[depth] += nodes
+                stats.previous_depth_nodes[depth] += previous_nodes
+                previous_nodes = nodes
+
+            best_move = move
+            self.best_move = move
+            self.completed_depth = depth
+
+            if self.callback is not None and self.callback(self):
+                break
+
+            # Searching deeper won't change the outcome of a finished game
+            if abs(self.best_value) >= WIN_THRESHOLD or time.time() >= start + time_limit:
+                break
+
+        self.total_time = time.time() - start
+        if stats is not None:
+            stats.searches += 1
+            stats.total_time += self.total_time
+
+        return best_move
+
+    def book_move(self, state: State):
+        '''
+        Returns the move of the opening book or of the table of proven positions for the given state (None if
+        the state is in neither of them)
+        '''
+        entry = self.book.lookup(state) if self.book is not None else None
+
+        if entry is None and self.solutions is not None:
+            solution = self.solutions.lookup(state)
+            if solution is not None:
+                move, outcome, distance = solution
+                entry = move, solution_value(outcome, distance, distance), distance
+
+        if entry is None:
+            return None
+
+        self.best_move, self.best_value, self.completed_depth = entry
+        return self.best_move
+
+    def search_depth(self, state: State, depth: int):
+        '''
+        Runs a single negamax search to the given depth, returning the best move (or None if the search was stopped
+        or the game is finished)
+        '''
+
+        alpha, beta = 0, 0
+        if self.pruning:
+            alpha, beta = int(-1e10), int(1e10)
+
+        if self.caching:
+            self.table.new_search()
+
+        self.stopped = False
+        self.nodes = 0
+
+        value, move = self.negamax_recursive(state, depth, alpha, beta)
+        self.total_nodes += self.nodes
+        self.nodes = 0
+
+        if self.stopped:
+            return None
+
+        self.best_value = value
+        return state.decode_move(move) if move != NO_MOVE else None
+
+    def negamax_recursive(self, state: State, depth: int, alpha: int, beta: int, ply: int = 0):
+        '''Searches the given state to the given depth, returning its value and the code of its best move (or NO_MOVE)'''
+        original_alpha = alpha
+        stats = self.stats
+        timing = stats is not None and stats.timing
+
+        if stats is not None:
+            stats.nodes[min(ply, MAX_PLY)] += 1
+
+        self.nodes += 1
+        if self.nodes % Search.TIME_CHECK_INTERVAL == 0 and self.check_stop():
+            self.stopped = True
+            return 0, NO_MOVE
+
+        if self.solutions is not None:
+            solution = self.solutions.lookup(state)
+            if solution is not None:
+                move, outcome, distance = solution
+                return solution_value(outcome, distance, depth), get_move_table(state.board_size).encode(move)
+
+        # The table is indexed by the Zobrist hash, which is kept up to date as moves are applied and undone
+        key, symmetry = state.hash, 0
+        if self.caching and self.canonical:
+            key, symmetry = state.canonical_hash()
+
+        entry = self.table.probe(key) if self.caching else None
+        if stats is not None and self.caching:
+            stats.probes += 1
+            if entry:
+                stats.hits += 1
+
+        hash_move = NO_MOVE
+        if entry:
+            cache_depth, flag, value, hash_move = entry
+            if symmetry and hash_move != NO_MOVE:
+                hash_move = get_move_table(state.board_size).transform(hash_move, get_geometry(state.board_size).inverse_symmetries[symmetry])
+            if cache_depth >= depth:
+                if stats is not None:
+                    stats.cache_hits += 1
+
+                if flag == CachingFlag.EXACT:
+                    return value, hash_move
+                elif flag == CachingFlag.LOWERBOUND:
+                    alpha = max(alpha, value)
+                elif flag == CachingFlag.UPPERBOUND:
+                    beta = min(beta, value)
+
+                if alpha >= beta:
+                    if stats is not None:
+                        stats.table_cutoffs += 1
+                    return value, hash_move
+
+        buffers = self.move_buffers
+        while len(buffers) <= ply:
+            buffers.append([])
+        moves = buffers[ply]
+        del moves[:]
+
+        # Moves aren't needed at the maximum depth, where the node is evaluated whether the game has ended or not
+        if depth > 0:
+            if timing:
+                start = time.time()
+
+            state.generate_moves(moves)
+
+            if timing:
+                stats.time_possible_moves += time.time() - start
+
+        # Maximum depth has been reached or no possible moves (game has ended): run evaluation function
+        if not moves:
+            if timing:
+                start = time.time()
+
+            evaluation = self.evaluation_function(state, state.current_player, depth)
+
+            if timing:
+                stats.time_evaluating += time.time() - start
+
+            return evaluation, NO_MOVE
+
+        if timing:
+            start = time.time()
+
+        if self.ordering:
+            self.order_moves(state, moves, hash_move, ply)
+        elif hash_move in moves:
+            # The best move found by a previous (shallower) search of this position is tried first
+            moves.remove(hash_move)
+            moves.insert(0, hash_move)
+
+        if timing:
+            stats.time_ordering += time.time() - start
+
+        best_move = NO_MOVE
+        max_value = int(-1e10)
+
+        if depth == 1 and self.batch_size:
+            max_value, best_move = self.search_leaves(state, moves, alpha, beta, ply)
+            # The result of an interrupted search is incomplete and must not be used or stored
+            if self.stopped:
+                return 0, NO_MOVE
+        else:
+            for i, move in enumerate(moves):
+                if timing:
+                    start = time.time()
+
+                undo_info = state.apply_code(move)
+
+                if timing:
+                    stats.time_playing_moves += time.time() - start
+
+                value = -self.negamax_recursive(state, depth - 1, -beta, -alpha, ply + 1)[0]
+
+                if timing:
+                    start = time.time()
+
+                state.undo_code(move, undo_info)
+
+                if timing:
+                    stats.time_playing_moves += time.time() - start
+
+                # The result of an interrupted search is incomplete and must not be used or stored
+                if self.stopped:
+                    return 0, NO_MOVE
+
+                if value > max_value:
+                    max_value = value
+                    best_move = move
+
+                if self.pruning:
+                    alpha = max(alpha, max_value)
+                    if alpha >= beta:
+                        if stats is not None:
+                            stats.cutoffs[min(ply, MAX_PLY)] += 1
+                            if i == 0:
+                                stats.first_move_cutoffs[min(ply, MAX_PLY)] += 1
+
+                        if self.ordering:
+                            self.update_ordering(move, depth, ply)
+                        break
+
+        if self.caching:
+            flag = CachingFlag.EXACT
+            if max_value <= original_alpha:
+                flag = CachingFlag.UPPERBOUND
+            elif max_value >= beta:
+                flag = CachingFlag.LOWERBOUND
+
+            stored_move = best_move
+            if symmetry and best_move != NO_MOVE:
+                stored_move = get_move_table(state.board_size).transform(best_move, symmetry)
+            self.table.store(key, depth, flag, max_value, stored_move)
+
+            if stats is not None:
+                stats.stores += 1
+
+        return max_value, best_move
@@ -0,0 +1,278 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable
+import itertools
+import multiprocessing
+import threading
+import time
+
+from tak import State, evaluate_hard
+from search import Search, SearchStats
+from mcts import MCTS
+from book import OpeningBook
+from solver import load_solutions
+from transposition import pack_move, unpack_move
+
+# The searches of every game are run by a fixed number of worker processes. Each game is assigned to one
+# worker when it starts, and its searches always run in that worker, so the transposition tables (and move
+# ordering tables) of a game are kept between its moves. Every worker keeps a bounded number of searches,
+# discarding the least recently used ones, so memory usage doesn't grow with the number of games.
+#
+# Every search is a job that can be followed and cancelled while it runs. Since a worker only runs one search
+# at a time, each worker has a shared progress array, where its search periodically writes its progress, and
+# a shared cancellation value, where the server writes the id of the job to cancel (which the search checks).
+
+# Fields of the progress arrays
+PROGRESS_JOB, PROGRESS_DEPTH, PROGRESS_NODES, PROGRESS_ELAPSED_MS, PROGRESS_VALUE, PROGRESS_MOVE = range(6)
+PROGRESS_FIELDS = 6
+
+class PoolFull(Exception):
+    '''Raised when a search can't be queued because too many searches are already waiting'''
+    pass
+
+# Worker process state (see init_worker)
+worker_searches = None
+worker_table_size_mb = None
+worker_max_searches = None
+worker_progress = None
+worker_cancel = None
+worker_book = None
+worker_solutions = None
+worker_job = 0
+
+def init_worker(table_size_mb: float, max_searches: int, progress, cancel):
+    global worker_searches, worker_table_size_mb, worker_max_searches, worker_progress, worker_cancel, worker_book, worker_solutions
+    worker_searches = OrderedDict()
+    worker_table_size_mb = table_size_mb
+    worker_max_searches = max_searches
+    worker_progress = progress
+    worker_cancel = cancel
+
+    # The opening books and the table of proven 3x3 positions are mapped once by each worker. They are only used by
+    # the strongest AI (the books were built with evaluate_hard, and the weaker AIs shouldn't play perfectly)
+    worker_book = OpeningBook()
+    worker_solutions = load_solutions(3)
+
+def get_worker_search(game_id: str, name: str, evaluation_function: Callable, mcts: bool) -> Search:
+    '''Returns the search with the given name for a game, creating it (and discarding the least recently used search) if needed'''
+    key = (game_id, name)
+
+    if key in worker_searches:
+        worker_searches.move_to_end(key)
+    elif mcts:
+        worker_searches[key] = MCTS(evaluation_function, book=worker_book if evaluation_function is evaluate_hard else None)
+    else:
+        strongest = evaluation_function is evaluate_hard
+        worker_searches[key] = Search(evaluation_function, table_size_mb=worker_table_size_mb, book=worker_book if strongest else None,
+            solutions=worker_solutions if strongest else None)
+
+    # Both kinds of search count towards the limit (an MCTS keeps a preallocated node pool)
+    if len(worker_searches) > worker_max_searches:
+        worker_searches.popitem(last=False)
+
+    return worker_searches[key]
+
+def report_progress(search: Search) -> bool:
+    '''Writes the progress of the current search to the progress array of the worker, returning whether the search was cancelled'''
+    progress = {
+        PROGRESS_JOB: worker_job,
+        PROGRESS_DEPTH: search.completed_depth,
+        PROGRESS_NODES: search.nodes_searched(),
+        PROGRESS_ELAPSED_MS: int((time.time() - search.start_time) * 1000),
+        PROGRESS_VALUE: search.best_value if search.completed_depth else 0,
+        PROGRESS_MOVE: pack_move(search.best_move)
+    }
+
+    with worker_progress.get_lock():
+        for field, value in progress.items():
+            worker_progress[field] = value
+
+    return worker_cancel.value == worker_job
+
+def run_search(job_id: int, game_id: str, name: str, evaluation_function: Callable, state: State, time_limit: float, max_depth: int,
+        mcts: bool = False, stats: bool = False):
+    '''
+    Searches a state of a game in a worker process, returning the best move, the final progress of the search, whether
+    it was cancelled and, if requested, its statistics (see SearchStats, which are only recorded by negamax searches)
+    '''
+    global worker_job
+    worker_job = job_id
+
+    search = get_worker_search(game_id, name, evaluation_function, mcts)
+    search_stats = SearchStats() if stats and not mcts else None
+    if not mcts:
+        search.stats = search_stats
+
+    search.callback = report_progress
+    move = search.iterative_deepening(state, time_limit, max_depth)
+    search.callback = None
+
+    if not mcts:
+        search.stats = None
+
+    cancelled = report_progress(search)
+    return move, list(worker_progress), cancelled, search_stats
+
+def forget_game(game_id: str):
+    '''Discards the searches of a game that has finished'''
+    for key in [key for key in worker_searches if key[0] == game_id]:
+        del worker_searches[key]
+
+def progress_dict(progress: list) -> dict:
+    '''Returns the contents of a progress array in a JSON-compatible format'''
+    elapsed = progress[PROGRESS_ELAPSED_MS] / 1000
+    move = unpack_move(progress[PROGRESS_MOVE])
+
+    return {
+        'depth': progress[PROGRESS_DEPTH],
+        'move': move.to_dict() if move else None,
+        'value': progress[PROGRESS_VALUE],
+        'nodes': progress[PROGRESS_NODES],
+        'elapsed': elapsed,
+        'nps': int(progress[PROGRESS_NODES] / elapsed) if elapsed else 0
+    }
+
+class SearchJob:
+    '''A search submitted to the pool, which can be followed (see progress) and cancelled'''
+
+    def __init__(self, job_id: int, future: Future, progress, cancel):
+        self.job_id = job_id
+        self.future = future
+        self.progress_array = progress
+        self.cancel_value = cancel
+        self.cancelled = False
+
+    def cancel(self):
+        '''Cancels the search: searches that are still queued are removed, while running searches stop at their next check'''
+        self.cancelled = True
+        if not self.future.cancel():
+            self.cancel_value.value = self.job_id
+
+    def status(self) -> str:
+        '''Returns the status of the job: queued, running, done, cancelled or failed'''
+        if self.future.cancelled():
+            return 'cancelled'
+        if self.future.done():
+            if self.future.exception() is not None:
+                return 'failed'
+            return 'cancelled' if self.future.result()[2] else 'done'
+        return 'running' if self.future.running() else 'queued'
+
+    def move(self):
+        '''Returns the best move found by a finished search (None if it was cancelled before completing a depth)'''
+        return self.future.result()[0]
+
+    def stats(self):
+        '''Returns the statistics of a finished search (None if they weren't requested or the search didn't run)'''
+        if self.future.done() and not self.future.cancelled() and self.future.exception() is None:
+            return self.future.result()[3]
+        return None
+
+    def progress(self) -> dict:
+        '''Returns the status and progress of the search in a JSON-compatible format'''
+        status = self.status()
+
+        if status in ('done', 'cancelled') and not self.future.cancelled():
+            progress = self.future.result()[1]
+        else:
+            with self.progress_array.get_lock():
+                progress = list(self.progress_array)
+
+            # The progress array belongs to the search running in the worker, which may be a different one
+            if progress[PROGRESS_JOB] != self.job_id:
+                progress = [0] * PROGRESS_FIELDS
+
+        return dict(status=status, **progress_dict(progress))
+
+class SearchPool:
+    '''
+    Bounded pool of worker processes that runs the searches of every game. At most max_pending searches
+    can be queued or running at the same time: when the pool is full, new searches are rejected (with
+    PoolFull) instead of being queued, so that the response time of the accepted requests stays bounded.
+
+    Background searches (such as pondering) are only started by idle workers and don't count towards the
+    limit, since they are cancelled as soon as another search is submitted to their worker.
+    '''
+
+    def __init__(self, num_workers: int, max_pending: int, table_size_mb: float = 16, max_searches: int = 32):
+        # Worker processes are started (not forked) because the pool is used from the threads of the server
+        context = multiprocessing.get_context('spawn')
+        self.progress = [context.Array('q', PROGRESS_FIELDS) for _ in range(num_workers)]
+        self.cancel = [context.Value('q', 0) for _ in range(num_workers)]
+        self.workers = [ProcessPoolExecutor(1, context, init_worker, (table_size_mb, max_searches, self.progress[i], self.cancel[i]))
+            for i in range(num_workers)]
+        self.job_ids = itertools.count(1)
+
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        # Searches queued or running in each worker, and the background searches among them
+        self.worker_pending = [0] * num_workers
+        self.background = [set() for _ in range(num_workers)]
+
+        self.games = {}
+        self.next_worker = itertools.cycle(range(num_workers))
+
+    def shutdown(self):
+        '''Stops the worker processes'''
+        for worker in self.workers:
+            worker.shutdown(cancel_futures=True)
+
+    def add_game(self, game_id: str):
+        '''Assigns a new game to one of the workers'''
+        with self.lock:
+            self.games[game_id] = next(self.next_worker)
+
+    def remove_game(self, game_id: str):
+        '''Discards the searches of a game (they are removed by its worker once its queued searches are done)'''
+        with self.lock:
+            worker = self.games.pop(game_id, None)
+
+        if worker is not None:
+            self.workers[worker].submit(forget_game, game_id)
+
+    def submit(self, game_id: str, name: str, evaluation_function: Callable, state: State, time_limit: float, max_depth: int = 64,
+            background: bool = False, mcts: bool = False, stats: bool = False) -> SearchJob:
+        '''
+        Queues a search for the given game (each game can have several independent searches, identified by
+        their name), returning its job. The search uses MCTS instead of negamax if mcts is true, and records
+        its statistics (see SearchJob.stats) if stats is true. Raises PoolFull
+        if too many searches are pending (or, for background searches, if the worker of the game is busy).
+        '''
+        with self.lock:
+            worker = self.games[game_id]
+            interrupted = []
+
+            if background:
+                # Cancelled background searches that haven't stopped yet don't keep the worker busy
+                if self.worker_pending[worker] > sum(1 for job in self.background[worker] if job.cancelled):
+                    raise PoolFull()
+            else:
+                if self.pending >= self.max_pending:
+                    raise PoolFull()
+                self.pending += 1
+                interrupted = list(self.background[worker])
+
+            self.worker_pending[worker] += 1
+            job_id = next(self.job_ids)
+
+            future = self.workers[worker].submit(run_search, job_id, game_id, name, evaluation_function, state, time_limit, max_depth, mcts, stats)
+            job = SearchJob(job_id, future, self.progress[worker], self.cancel[worker])
+            if background:
+                self.background[worker].add(job)
+
+        # Background searches give way to the searches that clients are waiting for
+        for background_job in interrupted:
+            background_job.cancel()
+
+        future.add_done_callback(lambda future: self.search_done(worker, job, background))
+        return job
+
+    def search_done(self, worker: int, job: SearchJob, background: bool):
+        with self.lock:
+            self.worker_pending[worker] -= 1
+            if background:
+                self.background[worker].discard(job)
+            else:
+                self.pending -= 1
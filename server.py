@@ -1,43 +1,335 @@
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from http import HTTPStatus
+from urllib.parse import urlparse, parse_qs
 
 import json
+import os
+import threading
+import time
+import uuid
 
-from tak import State, Player, evaluate_easy, evaluate_medium
+from tak import Player, Result, evaluate_easy, evaluate_medium, evaluate_hard
+from bitboard import BitboardState
+from persistent import PersistentState
+from search import SearchStats
+from search_pool import SearchPool, PoolFull
 
-state = None
-player_types = {}
-possible_moves = []
+# Memory used by each transposition table
+TABLE_SIZE_MB = 32
+
+# Searches of every game are run by a pool of worker processes (one per core). When too many searches are
+# waiting, new ones are rejected so that clients can retry later instead of waiting for an unbounded queue
+SEARCH_WORKERS = os.cpu_count() or 1
+MAX_PENDING_SEARCHES = 4 * SEARCH_WORKERS
+RETRY_AFTER = 1
+
+# Error message of a computer search that was cancelled because the game changed, which clients can ignore
+SEARCH_CANCELLED = 'The search was cancelled'
+
+# Searches kept by each worker (the least recently used ones are discarded, along with their transposition tables)
+MAX_SEARCHES_PER_WORKER = 32
+
+# Games that receive no requests for this long (in seconds) are discarded
+GAME_TIMEOUT = 3600
+
+# Finished search jobs are kept for this long (in seconds), so that clients can obtain their results
+JOB_TIMEOUT = 60
+
+# Interval between the progress updates sent to clients that stream the progress of a search (in seconds)
+PROGRESS_INTERVAL = 0.25
+
+# Pondering: while a human player is thinking, the AI that plays next keeps searching the current position in the
+# background with its own search, filling its transposition table. When the human moves, the pondering search is
+# cancelled and the AI's search of the new position (a child of the pondered one) starts from the entries already
+# stored for its subtree, while the entries of the other branches are replaced over time.
+PONDERING = True
+PONDER_TIME_LIMIT = 120
+
+# Statistics of the negamax searches (see search.SearchStats), reported by the /stats endpoint. They are disabled by
+# default, since timing the parts of the search slows it down, and can be enabled while the server runs
+SEARCH_STATS = False
+
+search_pool = None
+
+evaluation_functions = {
+    'ai1': evaluate_easy,
+    'ai2': evaluate_medium,
+    'ai3': evaluate_hard
+}
+
+class RequestError(Exception):
+    '''Error caused by a request, answered with the given HTTP status'''
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class Game:
+    '''
+    A game hosted by the server. Requests for the same game are handled one at a time (using its lock),
+    while requests for different games are handled concurrently. Every state of the game is kept, so that
+    moves can be undone: states are persistent (see persistent.PersistentState), so each one only takes
+    the memory of the squares changed by its move, and searches are given a bitboard copy of the state.
+    '''
+
+    def __init__(self, game_id: str, board_size: int, white_type: str, black_type: str):
+        self.game_id = game_id
+        self.state = PersistentState(board_size)
+        self.history = [] # Previous states and the moves played from them
+        self.player_types = { Player.WHITE: white_type, Player.BLACK: black_type }
+        self.possible_moves = []
+
+        # Search jobs of the game that haven't finished yet
+        self.jobs = set()
+
+        # Reentrant, since cancelling a queued job finishes it (see finish_job) in the thread that cancels it
+        self.lock = threading.RLock()
+        self.last_access = time.time()
+
+    def cancel_jobs(self):
+        '''Cancels the searches of the game, whose results are no longer needed'''
+        for job in list(self.jobs):
+            job.search_job.cancel()
+
+    def play(self, move):
+        '''Plays a move, keeping the previous state in the history'''
+        self.history.append((self.state, move))
+        self.state = move.play(self.state)
+        self.possible_moves = []
+
+class Job:
+    '''
+    A search requested by a client: either a computer move, which is played as soon as the search finishes
+    (unless the game has changed in the meantime), or a hint.
+    '''
+
+    def __init__(self, game: Game, kind: str, search_job):
+        # Kind of search: computer, hint or ponder
+        self.game = game
+        self.kind = kind
+        self.search_job = search_job
+        self.state = game.state
+
+        # Response of the finished job (the same as the get_computer_move or get_move_hint endpoints), or the error
+        # (a RequestError) of a computer search whose move wasn't played, whose response is the error message
+        self.response = None
+        self.error = None
+        self.finished = threading.Event()
+        self.finished_at = None
+
+    def progress(self) -> dict:
+        '''Returns the progress of the search and, if it has finished, the response of the job'''
+        progress = self.search_job.progress()
+        if self.finished.is_set():
+            progress['response'] = self.response
+        return progress
+
+# Games in progress, by game id
+games = {}
+games_lock = threading.Lock()
+
+# Search jobs (running and recently finished), by job id
+jobs = {}
+jobs_lock = threading.Lock()
+
+# Statistics of the finished searches, by kind of search, and of the last one
+stats_enabled = SEARCH_STATS
+search_stats = {}
+last_search_stats = None
+stats_lock = threading.Lock()
+
+def get_game(params: dict) -> Game:
+    '''Returns the game identified by the game_id of a request'''
+    with games_lock:
+        game = games.get(params.get('game_id'))
+
+    if game is None:
+        raise RequestError(HTTPStatus.NOT_FOUND, 'Unknown game')
+
+    game.last_access = time.time()
+    return game
+
+def remove_idle_games():
+    '''Discards the games that have not received requests for a while'''
+    now = time.time()
+
+    with games_lock:
+        idle = [game for game in games.values() if now - game.last_access > GAME_TIMEOUT]
+        for game in idle:
+            del games[game.game_id]
+
+    for game in idle:
+        with game.lock:
+            game.cancel_jobs()
+        search_pool.remove_game(game.game_id)
+
+def get_job(params: dict) -> Job:
+    '''Returns the search job identified by the job_id of a request'''
+    with jobs_lock:
+        job = jobs.get(params.get('job_id'))
+
+    if job is None:
+        raise RequestError(HTTPStatus.NOT_FOUND, 'Unknown search')
+
+    return job
+
+def remove_finished_jobs():
+    '''Discards the jobs that finished a while ago'''
+    now = time.time()
+
+    with jobs_lock:
+        for job_id in [job_id for job_id, job in jobs.items() if job.finished_at is not None and now - job.finished_at > JOB_TIMEOUT]:
+            del jobs[job_id]
+
+def start_job(game: Game, kind: str) -> Job:
+    '''Submits a search for the current state of a game (a computer move or a hint) to the search pool'''
+    remove_finished_jobs()
+
+    with game.lock:
+        if kind == 'computer':
+            player = game.state.current_player
+            player_type = game.player_types[player]
+
+            if player_type not in evaluation_functions:
+                raise RequestError(HTTPStatus.CONFLICT, 'It is not the computer\'s turn')
+            if any(job.kind == 'computer' for job in game.jobs):
+                raise RequestError(HTTPStatus.CONFLICT, 'The computer is already searching for a move')
+
+            # Each AI player keeps its own search (and transposition table) for the whole game
+            name, evaluation_function = str(player), evaluation_functions[player_type]
+            time_limit, max_depth = time_limits[player_type], get_max_depth(player_type, game.state.board_size)
+        elif kind == 'hint':
+            name, evaluation_function, time_limit, max_depth = 'hint', evaluate_hard, HINT_TIME_LIMIT, 64
+        elif kind == 'ponder':
+            # The search of the AI that plays after the current player, one ply deeper than its own searches
+            player = -game.state.current_player
+            player_type = game.player_types[player]
+
+            if player_type not in evaluation_functions:
+                raise RequestError(HTTPStatus.CONFLICT, 'The next player is not the computer')
+
+            name, evaluation_function = str(player), evaluation_functions[player_type]
+            time_limit, max_depth = PONDER_TIME_LIMIT, get_max_depth(player_type, game.state.board_size) + 1
+        else:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f'Unknown search type {kind}')
+
+        try:
+            search_job = search_pool.submit(game.game_id, name, evaluation_function, BitboardState.from_state(game.state), time_limit, max_depth,
+                background=kind == 'ponder', mcts=game.state.board_size >= MCTS_BOARD_SIZE, stats=stats_enabled)
+        except PoolFull:
+            raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, 'Server is busy, try again later')
+
+        job = Job(game, kind, search_job)
+        game.jobs.add(job)
+
+    with jobs_lock:
+        jobs[search_job.job_id] = job
+
+    search_job.future.add_done_callback(lambda future: finish_job_async(job))
+    return job
+
+def finish_job_async(job: Job):
+    '''
+    Runs finish_job in a new thread. Cancelling a queued search runs its callbacks in the cancelling thread, and
+    searches are submitted (which cancels the background searches of other games) while holding the lock of a
+    game, so finishing a job synchronously could wait for the lock of another game that is waiting for this one.
+    '''
+    threading.Thread(target=finish_job, args=(job, ), daemon=True).start()
+
+def finish_job(job: Job):
+    '''Records the result of a finished (or cancelled) search, playing the computer's move if the game hasn't changed'''
+    game = job.game
+
+    with game.lock:
+        game.jobs.discard(job)
+        response = {}
+
+        if job.search_job.status() == 'done':
+            move = job.search_job.move()
+
+            if job.kind == 'hint':
+                response = move.to_dict() if move else {}
+            elif job.kind == 'computer' and move and game.state is job.state:
+                game.play(move)
+                response = {'state': game.state.to_dict(), 'result': game.state.objective().value, 'move': move.to_dict()}
+                start_pondering(game)
+            elif job.kind == 'computer':
+                message = 'No move was found' if game.state is job.state else 'The game changed during the search'
+                job.error = RequestError(HTTPStatus.CONFLICT, message)
+        elif job.kind == 'computer':
+            status = job.search_job.status()
+            message = 'The search failed' if status == 'failed' else SEARCH_CANCELLED
+            job.error = RequestError(HTTPStatus.INTERNAL_SERVER_ERROR if status == 'failed' else HTTPStatus.CONFLICT, message)
+
+        if job.error is not None:
+            response = {'error': job.error.message}
+
+        job.response = response
+        job.finished_at = time.time()
+        job.finished.set()
+
+    record_stats(job)
+
+def record_stats(job: Job):
+    '''Adds the statistics of a finished search (if it recorded them) to the statistics of its kind of search'''
+    global last_search_stats
+    stats = job.search_job.stats()
+    if stats is None:
+        return
+
+    with stats_lock:
+        search_stats.setdefault(job.kind, SearchStats()).merge(stats)
+        last_search_stats = stats
+
+def start_pondering(game: Game):
+    '''Starts pondering if a human player is to move and an AI plays next (unless the server is too busy)'''
+    player = game.state.current_player
+
+    # MCTS searches start from an empty tree, so they wouldn't benefit from pondering
+    if PONDERING and game.state.board_size < MCTS_BOARD_SIZE and game.player_types[player] not in evaluation_functions and game.player_types[-player] in evaluation_functions \
+            and game.state.objective() == Result.NOT_FINISHED:
+        try:
+            start_job(game, 'ponder')
+        except RequestError:
+            pass
 
 def start_game(params: dict) -> dict:
     '''
     Start a new game with the specified parameters (board size and the type of each player).
-    Returns the starting state in a JSON-compatible format.
+    Returns the id of the new game (which must be sent with every other request for the game) and the starting state in a JSON-compatible format.
     '''
-    global state, player_types
+    remove_idle_games()
+
+    game = Game(uuid.uuid4().hex, params['size'], params['white_type'], params['black_type'])
 
-    state = State(params['size'])
-    player_types[Player.WHITE] = params['white_type']
-    player_types[Player.BLACK] = params['black_type']
+    with games_lock:
+        games[game.game_id] = game
+    search_pool.add_game(game.game_id)
 
-    return {'state': state.to_dict(), 'result': state.objective().value}
+    start_pondering(game)
+
+    return {'game_id': game.game_id, 'state': game.state.to_dict(), 'result': game.state.objective().value}
 
 def get_possible_moves(params: dict) -> dict:
     '''Returns a list of all possible moves in a JSON-compatible format.'''
-    global state, possible_moves
+    game = get_game(params)
 
-    possible_moves = state.possible_moves()
-    return {'possible_moves': [move.to_dict() for move in possible_moves]}
+    with game.lock:
+        game.possible_moves = game.state.possible_moves()
+        return {'possible_moves': [move.to_dict() for move in game.possible_moves]}
 
 def make_move(params: dict) -> dict:
     '''Makes a move and returns the resulting state in a JSON-compatible format.'''
-    global state, possible_moves
-    
-    if possible_moves:
-        move = possible_moves[params['move_idx']]
-        state = move.play(state)
-    
-    return {'state': state.to_dict(), 'result': state.objective().value}
+    game = get_game(params)
+
+    with game.lock:
+        if game.possible_moves:
+            game.play(game.possible_moves[params['move_idx']])
+
+            # Searches for the previous state are no longer useful
+            game.cancel_jobs()
+
+        return {'state': game.state.to_dict(), 'result': game.state.objective().value}
 
 
 # Search depths for each board size (for level 3 AI)
@@ -47,33 +339,120 @@ depths = {
     5: 3
 }
 
+# Larger boards have too many moves for negamax, so they are searched with MCTS (see mcts.py), which is only limited by time
+MCTS_BOARD_SIZE = 6
+
+# Search time limits in seconds for each AI level (and for hints), so that response times don't depend on the position.
+# Searches are iteratively deepened until the time runs out, so the level 3 AI searches as deep as the time allows,
+# while the lower levels are also limited to a maximum depth.
+time_limits = {
+    'ai1': 0.5,
+    'ai2': 1,
+    'ai3': 2
+}
+HINT_TIME_LIMIT = 2
+
+depth_offsets = {
+    'ai1': -2,
+    'ai2': -1
+}
+
+def get_max_depth(player_type: str, board_size: int) -> int:
+    '''Returns the maximum search depth for an AI level (level 3 is only limited by time)'''
+    if player_type in depth_offsets and board_size in depths:
+        return max(1, depths[board_size] + depth_offsets[player_type])
+    return 64
+
+def undo_move(params: dict) -> dict:
+    '''
+    Undoes the last moves of the game (plies, one by default, limited to the moves played) and returns the resulting
+    state and the moves that are still part of the game in a JSON-compatible format.
+    '''
+    game = get_game(params)
+
+    with game.lock:
+        plies = min(int(params.get('plies', 1)), len(game.history))
+
+        if plies > 0:
+            game.state = game.history[-plies][0]
+            del game.history[-plies:]
+            game.possible_moves = []
+
+            # Searches for the current state are no longer useful
+            game.cancel_jobs()
+            start_pondering(game)
+
+        return {
+            'state': game.state.to_dict(),
+            'result': game.state.objective().value,
+            'moves': [move.to_dict() for _, move in game.history]
+        }
+
 def get_move_hint(params: dict) -> dict:
     '''Returns the computer's best move for the current game state in a JSON-compatible format.'''
-    depth = depths[state.board_size]
-    return state.negamax(depth, pruning=True, caching=True).to_dict()
+    job = start_job(get_game(params), 'hint')
+    job.finished.wait()
+    return job.response
 
 def get_computer_move(params: dict) -> dict:
     '''
     Obtains the computer move and corresponding game state in a JSON-compatible format.
-    The evaluation function used and the negamax depth are decided by the level of the AI chosen previously.
+    The evaluation function used and the search limits are decided by the level of the AI chosen previously.
+    Answers with a conflict if the search was cancelled, the game changed during the search or no move was found.
     '''
-    global state, player_types
+    job = start_job(get_game(params), 'computer')
+    job.finished.wait()
 
-    player_type = player_types[state.current_player]
-    depth = depths[state.board_size]
+    # The move of the search is only played if the game didn't change in the meantime
+    if job.error is not None:
+        raise job.error
+    return job.response
+
+def start_search(params: dict) -> dict:
+    '''
+    Starts a search for a computer move or a hint (the type of the search) without waiting for it to finish.
+    Returns the id of the search job, used to follow its progress and to cancel it.
+    '''
+    # Pondering is started by the server itself
+    kind = params.get('type', 'computer')
+    if kind not in ('computer', 'hint'):
+        raise RequestError(HTTPStatus.BAD_REQUEST, f'Unknown search type {kind}')
 
-    if player_type == 'ai1':
-        move = state.negamax(depth - 2, evaluate_easy, True, True)
-    elif player_type == 'ai2':
-        move = state.negamax(depth - 1, evaluate_medium, True, True)
-    elif player_type == 'ai3':
-        move = state.negamax(depth, pruning=True, caching=True)
+    job = start_job(get_game(params), kind)
+    return {'job_id': job.search_job.job_id}
+
+def get_search(params: dict) -> dict:
+    '''
+    Returns the progress of a search job (its status, the depth completed, the best move so far, the number of nodes searched
+    and nodes per second) and, when it has finished, its response (the same as get_computer_move or get_move_hint).
+    '''
+    return get_job(params).progress()
+
+def cancel_search(params: dict) -> dict:
+    '''Cancels a search job, returning its progress'''
+    job = get_job(params)
+    job.search_job.cancel()
+    return job.progress()
+
+def get_stats(params: dict) -> dict:
+    '''
+    Returns the statistics of the searches finished since they were enabled (or reset), by kind of search, and of the
+    last one. Optionally, enables or disables them (enabled) for the searches started afterwards, or resets them (reset).
+    '''
+    global stats_enabled, last_search_stats
 
-    if move:
-        state = move.play(state)
-        return {'state': state.to_dict(), 'result': state.objective().value, 'move': move.to_dict()}
+    with stats_lock:
+        if 'enabled' in params:
+            stats_enabled = bool(params['enabled'])
+        if params.get('reset'):
+            search_stats.clear()
+            last_search_stats = None
 
-    return {}
+        return {
+            'enabled': stats_enabled,
+            'searches': { kind: stats.to_dict() for kind, stats in search_stats.items() },
+            'last': last_search_stats.to_dict() if last_search_stats is not None else None
+        }
 
 # Each URL (request) is mapped to a different function
 # These functions take in a dictionary and return a dictionary
@@ -81,37 +460,79 @@ endpoints = {
     '/start_game': start_game,
     '/get_possible_moves': get_possible_moves,
     '/make_move': make_move,
+    '/undo_move': undo_move,
     '/get_move_hint': get_move_hint,
-    '/get_computer_move': get_computer_move
+    '/get_computer_move': get_computer_move,
+    '/start_search': start_search,
+    '/get_search': get_search,
+    '/cancel_search': cancel_search,
+    '/stats': get_stats
 }
 
 
 class _RequestHandler(BaseHTTPRequestHandler):
     # Server code adapted from https://gist.github.com/nitaku/10d0662536f37a087e1b
-    def _set_headers(self):
-        self.send_response(HTTPStatus.OK.value)
+    def _set_headers(self, status: HTTPStatus = HTTPStatus.OK):
+        self.send_response(status.value)
         self.send_header('Content-type', 'application/json')
+        if status == HTTPStatus.SERVICE_UNAVAILABLE:
+            self.send_header('Retry-After', str(RETRY_AFTER))
         # Allow requests from any origin, so CORS policies don't
-        # prevent local development.
+        # prevent local development (or reading the retry delay).
         self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'Retry-After')
         self.end_headers()
 
     def do_GET(self):
         '''Handle GET requests'''
+        url = urlparse(self.path)
+        if url.path == '/search_events':
+            self._stream_search(parse_qs(url.query))
+            return
+
         self._set_headers()
         self.wfile.write(json.dumps([{"Hello" : "There"}]).encode('utf-8'))
 
+    def _stream_search(self, query: dict):
+        '''Streams the progress of a search job as server-sent events, until it finishes (the job is cancelled if the client disconnects)'''
+        try:
+            job = get_job({'job_id': int(query['job_id'][0])})
+        except (KeyError, ValueError, RequestError):
+            self._set_headers(HTTPStatus.NOT_FOUND)
+            self.wfile.write(json.dumps({'error': 'Unknown search'}).encode('utf-8'))
+            return
+
+        self.send_response(HTTPStatus.OK.value)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+        try:
+            while True:
+                finished = job.finished.wait(PROGRESS_INTERVAL)
+                self.wfile.write(f'data: {json.dumps(job.progress())}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+                if finished:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            # Nobody will read the result of the search
+            job.search_job.cancel()
+
     def do_POST(self):
         '''Handle POST requests (using one of the endpoints defined previously)'''
         length = int(self.headers.get('content-length'))
         message = json.loads(self.rfile.read(length))
-        if self.path in endpoints:
+        status = HTTPStatus.OK
+        try:
+            if self.path not in endpoints:
+                raise RequestError(HTTPStatus.NOT_FOUND, f'Path {self.path} was not expected')
             res = endpoints[self.path](message)
-        else:
-            print("Path {self.path} was not expected")
-            res = {}
+        except RequestError as error:
+            status = error.status
+            res = {'error': error.message}
 
-        self._set_headers()
+        self._set_headers(status)
         self.wfile.write(json.dumps(res).encode('utf-8'))
 
     def do_OPTIONS(self):
@@ -124,10 +545,18 @@ class _RequestHandler(BaseHTTPRequestHandler):
 
 
 def run_server():
+    global search_pool
+    search_pool = SearchPool(SEARCH_WORKERS, MAX_PENDING_SEARCHES, TABLE_SIZE_MB, MAX_SEARCHES_PER_WORKER)
+
+    # Each request is handled by its own thread
     server_address = ('', 8001)
-    httpd = HTTPServer(server_address, _RequestHandler)
+    httpd = ThreadingHTTPServer(server_address, _RequestHandler)
     print('Serving at %s:%d' % server_address)
-    httpd.serve_forever()
+
+    try:
+        httpd.serve_forever()
+    finally:
+        search_pool.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,204 @@
+import argparse
+import os
+import time
+
+from tak import State, Player, Result
+from bitboard import BitboardState
+from book import BookFile, BOOK_DIRECTORY, write_book
+from utils import get_geometry
+
+# Solver: proves the outcome of positions (a win, loss or draw for the player to move) by searching every line up to
+# a number of plies (the horizon), without evaluation functions. The bound is increased one ply at a time, which
+# favours short wins. Every position proven along the way is kept (under its canonical hash, see
+# State.canonical_hash), along with a number of plies until the game ends and the move that achieves it: the winning
+# move of a win, a drawing move of a draw or the move that resists the longest in a loss. Following the moves of
+# proven positions ends the game with the proven outcome within that many plies.
+#
+# These distances are upper bounds, not necessarily the shortest ones: a position is proven by the first line that
+# reaches it (possibly with a larger remaining bound than another line would have) and is never searched again, and
+# a win stops at the first winning move found. The values of solution_value (see search.py) inherit these bounds.
+#
+# Even on 3x3 boards, the game is too long to be solved outright in Python (the number of positions grows about 3.5
+# times with each ply), so positions are proven within the horizon and with a budget of nodes. The proven positions
+# of the openings (see build_solutions) are written to a table with the same format as the opening books, which
+# Search consults at every node (see Search.solutions).
+
+# Outcomes of a proven position, for the player to move
+LOSS, DRAW, WIN = -1, 0, 1
+
+def solutions_path(board_size: int, directory: str = BOOK_DIRECTORY) -> str:
+    return os.path.join(directory, f'solutions_{board_size}.bin')
+
+class Solver:
+    '''
+    Bounded solver that keeps every position it proves (and the largest bound each unproven position was
+    searched with), so that positions reached by several lines or in later calls are only searched once.
+    '''
+
+    def __init__(self, horizon: int = 12, max_nodes: int = 10**6):
+        self.horizon = horizon
+        self.max_nodes = max_nodes
+
+        # Canonical hash -> (outcome, distance, move for the canonical orientation)
+        self.solved = {}
+        # Canonical hash -> largest bound searched without proving the position
+        self.unsolved = {}
+
+        self.nodes = 0
+        self.stopped = False
+
+    def solve(self, state: State):
+        '''
+        Returns the (outcome, distance, move) of the given state, or None if the outcome could not be
+        proven within the horizon (or with the budget of nodes, which is reset by every call).
+        '''
+        state = state.copy()
+        self.nodes = 0
+        self.stopped = False
+
+        for bound in range(1, self.horizon + 1):
+            solution = self.solve_recursive(state, bound)
+            if self.stopped:
+                return None
+            if solution is not None:
+                return solution
+
+        return None
+
+    def solve_recursive(self, state: State, bound: int):
+        '''Returns the (outcome, distance, move) of the state if the game ends within bound plies whatever is played, otherwise None'''
+        self.nodes += 1
+        if self.nodes > self.max_nodes:
+            self.stopped = True
+            return None
+
+        result = state.objective()
+        if result != Result.NOT_FINISHED:
+            if result == Result.DRAW:
+                return DRAW, 0, None
+            winner = Player.WHITE if result == Result.WHITE_WIN else Player.BLACK
+            return (WIN if winner == state.current_player else LOSS), 0, None
+
+        if bound == 0:
+            return None
+
+        key, symmetry = state.canonical_hash()
+
+        if key in self.solved:
+            outcome, distance, move = self.solved[key]
+            if distance > bound:
+                return None
+            return outcome, distance, move.transform(state.board_size, get_geometry(state.board_size).inverse_symmetries[symmetry])
+
+        if self.unsolved.get(key, 0) >= bound:
+            return None
+
+        solution = None
+        draw, loss = None, None
+        proven = True
+
+        for move in state.possible_moves():
+            undo_info = move.apply(state)
+            child = self.solve_recursive(state, bound - 1)
+            move.undo(state, undo_info)
+
+            if self.stopped:
+                return None
+
+            if child is None:
+                proven = False
+                continue
+
+            outcome, distance = child[0], child[1] + 1
+            if outcome == LOSS:
+                solution = (WIN, distance, move)
+                break
+            elif outcome == DRAW:
+                if draw is None or distance > draw[1]:
+                    draw = (DRAW, distance, move)
+            elif loss is None or distance > loss[1]:
+                loss = (LOSS, distance, move)
+
+        # Without a winning move, the position is only proven if every move was (and a draw is better than a loss)
+        if solution is None and proven:
+            solution = draw or loss
+
+        if solution is None:
+            self.unsolved[key] = bound
+            return None
+
+        outcome, distance, move = solution
+        self.solved[key] = (outcome, distance, move.transform(state.board_size, symmetry))
+        return solution
+
+class SolutionTable:
+    '''Memory-mapped table of the positions proven by the solver for a board size (see build_solutions)'''
+
+    def __init__(self, board_size: int = 3, directory: str = BOOK_DIRECTORY):
+        self.board_size = board_size
+        self.file = BookFile(solutions_path(board_size, directory), board_size)
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return len(self.file)
+
+    def lookup(self, state: State):
+        '''Returns the (move, outcome, distance) of the given state, or None if the state is not in the table'''
+        if state.board_size != self.board_size:
+            return None
+        return self.file.lookup(state)
+
+def load_solutions(board_size: int = 3, directory: str = BOOK_DIRECTORY):
+    '''Returns the table of solved positions for the given board size, or None if it hasn't been built'''
+    if not os.path.exists(solutions_path(board_size, directory)):
+        return None
+    return SolutionTable(board_size, directory)
+
+def build_solutions(board_size: int, plies: int, horizon: int, max_nodes: int, verbose: bool = False) -> dict:
+    '''
+    Solves every position reachable in less than the given number of plies (one of each set of symmetric positions),
+    returning the entries of the table (canonical hash -> (move, outcome, distance)) of every position proven.
+    '''
+    solver = Solver(horizon, max_nodes)
+
+    positions = [BitboardState(board_size)]
+    seen = { positions[0].canonical_hash()[0] }
+
+    for ply in range(plies):
+        next_positions = []
+
+        for i, state in enumerate(positions):
+            solution = solver.solve(state)
+
+            if verbose:
+                print(f'Size {board_size}, ply {ply}: position {i + 1}/{len(positions)}, {solution} ({solver.nodes} nodes, {len(solver.solved)} proven)')
+
+            if ply + 1 < plies:
+                for move in state.possible_moves():
+                    child = move.play(state)
+                    child_key = child.canonical_hash()[0]
+
+                    if child_key not in seen and child.objective() == Result.NOT_FINISHED:
+                        seen.add(child_key)
+                        next_positions.append(child)
+
+        positions = next_positions
+
+    return { key: (move, outcome, distance) for key, (outcome, distance, move) in solver.solved.items() }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the table of solved positions used by the server')
+    parser.add_argument('size', type=int, nargs='?', default=3, help='board size')
+    parser.add_argument('--plies', type=int, default=4, help='number of plies of the openings whose positions are solved')
+    parser.add_argument('--horizon', type=int, default=9, help='maximum number of plies searched to prove each position')
+    parser.add_argument('--nodes', type=int, default=10**6, help='maximum number of nodes searched for each position')
+    parser.add_argument('--directory', default=BOOK_DIRECTORY, help='directory where the table is written')
+    args = parser.parse_args()
+
+    start = time.time()
+    entries = build_solutions(args.size, args.plies, args.horizon, args.nodes, verbose=True)
+    # The table covers every position, not only the openings (so the plies field of the file is not used)
+    write_book(solutions_path(args.size, args.directory), args.size, 0, entries)
+    print(f'Size {args.size}: {len(entries)} positions proven in {time.time() - start:.1f}s')
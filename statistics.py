@@ -1,10 +1,20 @@
-from tak import State, Result, evaluate_easy, evaluate_medium, evaluate_hard
+from tak import State, evaluate_easy, evaluate_medium, evaluate_hard
+from search import Search, SearchStats
+from benchmark import load_corpus, corpus_state
 import csv, time
 
+# The statistics are measured on the positions of the benchmark corpus (see benchmark.py) instead of the positions of
+# a game played by the AI, so that every run searches the same positions and the results of different runs can be compared
+
 def test_negamax(state, depth, pruning, caching, evaluation_function):
     '''Obtains the total time needed by negamax algorithm to find a solution.'''
-    move = state.negamax(depth, evaluation_function, pruning, caching, True)
-    return (State.total_time, move)
+    search = Search(evaluation_function, pruning, caching)
+    move = search.negamax(state, depth)
+    return (search.total_time, move)
+
+def corpus_states(board_size):
+    '''Returns the positions of the benchmark corpus for the given board size.'''
+    return [corpus_state(size, moves, State) for _, size, _, moves in load_corpus() if size == board_size]
 
 def write_csv(filename, statistics):
     '''Writes the statistics to csv file.'''
@@ -13,27 +23,23 @@ def write_csv(filename, statistics):
     csv_file.writerow(statistics)
     file.close()
 
-def test_totals(board_size, n):
-    '''Obtains the total time and branching factor for each of the first n iterations of the negamax algorithm (or until the game ends).'''
+
+def test_totals(board_size):
+    '''Obtains the total time and branching factor of the negamax algorithm for each position of the given board size.'''
 
     details = str(board_size) + "TThard3"
     times = [details]
     choices = [details]
     
-    state = State(board_size)
-    for _ in range(n):
+    for state in corpus_states(board_size):
         (time, move) = test_negamax(state, 3, True, True, evaluate_hard)
         times.append(time)
-        moves = len(state.possible_moves())
-        choices.append(moves)
-        if moves == 0:
-            break
-        state = move.play(state)
+        choices.append(len(state.possible_moves()))
     
     write_csv("times.csv", times)
     write_csv("moves.csv", choices)
 
-def test_heuristics(evaluation, n):
+def test_heuristics(evaluation):
     '''Measures the impact of the evaluation function used on the totla time taken.'''
 
     details = "4TT" + evaluation + "3"
@@ -46,17 +52,13 @@ def test_heuristics(evaluation, n):
     
     times = [details]
     
-    state = State(4)
-    for _ in range(n):
+    for state in corpus_states(4):
         (time, move) = test_negamax(state, 3, True, True, evaluation_function)
         times.append(time)
-        if state.objective() != Result.NOT_FINISHED:
-            break
-        state = move.play(state)
     
     write_csv("heuristics.csv", times)
 
-def test_parameters(cuts, caching, n):
+def test_parameters(cuts, caching):
     '''Measures the impact of the optimizations to the negamax algorithm on the total time taken.'''
 
     details = "4"
@@ -72,89 +74,138 @@ def test_parameters(cuts, caching, n):
 
     times = [details]
     
-    state = State(4)
-    for _ in range(n):
+    for state in corpus_states(4):
         (time, move) = test_negamax(state, 3, cuts, caching, evaluate_hard)
         times.append(time)
-        if state.objective() != Result.NOT_FINISHED:
-            break
-        state = move.play(state)
     
     write_csv("parameters.csv", times)
 
-def test_time_percentage(n):
-    '''Measures the percentage of the total time spent calculating possible moves, evaluating positions or playing moves.'''
+def test_time_percentage():
+    '''Measures the percentage of the total time spent calculating possible moves, ordering them, evaluating positions or playing moves.'''
 
-    state = State(4)
+    stats = SearchStats()
 
-    time_possible_moves = 0
-    time_evaluating = 0
-    time_playing_moves = 0
-    total_time = 0
+    for state in corpus_states(4):
+        search = Search(evaluate_hard, True, True, stats=stats)
+        move = search.negamax(state, 3)
 
-    for _ in range(n):
-        move = state.negamax(3, evaluate_hard, True, True, True)
+    total_time = stats.total_time
+    time_other = total_time - stats.time_possible_moves - stats.time_ordering - stats.time_evaluating - stats.time_playing_moves
 
-        time_possible_moves += State.nm_time_possible_moves
-        time_evaluating += State.nm_time_evaluating
-        time_playing_moves += State.nm_time_playing_moves
-        total_time += State.total_time
+    # Calculate percentages
+    time_possible_moves = stats.time_possible_moves / total_time
+    time_ordering = stats.time_ordering / total_time
+    time_evaluating = stats.time_evaluating / total_time
+    time_playing_moves = stats.time_playing_moves / total_time
+    time_other /= total_time
 
-        if state.objective() != Result.NOT_FINISHED:
-            break
+    write_csv('time_percentage.csv', ['Time calculating possible moves (%)', 'Time ordering moves (%)', 'Time evaluating positions (%)', 'Time playing moves (%)', 'Time performing other operations (%)'])
+    write_csv('time_percentage.csv', [time_possible_moves, time_ordering, time_evaluating, time_playing_moves, time_other])
 
-        state = move.play(state)
-    
-    time_other = total_time - time_possible_moves - time_evaluating - time_playing_moves
+def test_move_ordering(ordering):
+    '''Measures the impact of move ordering on the number of positions analysed and on the fraction of cuts caused by the first move.'''
 
-    # Calculate percentages
-    time_possible_moves /= total_time
-    time_evaluating /= total_time
-    time_playing_moves /= total_time
-    time_other /= total_time
+    details = "4TThard3"
+    if ordering:
+        details += "ordered"
+
+    calls = [details]
+    cutoff_rates = [details]
+
+    for state in corpus_states(4):
+        stats = SearchStats(timing=False)
+        search = Search(evaluate_hard, True, True, ordering=ordering, stats=stats)
+        move = search.negamax(state, 3)
+        calls.append(stats.nodes_searched())
+        cutoff_rates.append(stats.first_move_cutoff_rate())
+
+    write_csv("move_ordering_calls.csv", calls)
+    write_csv("move_ordering_cutoffs.csv", cutoff_rates)
+
+def test_batch_evaluation(batch_size):
+    '''Measures the time spent evaluating positions and the total time when the leaves are evaluated in batches of the given size (0 evaluates them one by one).'''
+
+    details = "4TFhard3batch" + str(batch_size)
 
-    write_csv('time_percentage.csv', ['Time calculating possible moves (%)', 'Time evaluating positions (%)', 'Time playing moves (%)', 'Time performing other operations (%)'])
-    write_csv('time_percentage.csv', [time_possible_moves, time_evaluating, time_playing_moves, time_other])
+    evaluating_times = [details]
+    times = [details]
+
+    for state in corpus_states(4):
+        stats = SearchStats()
+        search = Search(evaluate_hard, True, False, batch_size=batch_size, stats=stats)
+        move = search.negamax(state, 3)
+        evaluating_times.append(stats.time_evaluating)
+        times.append(stats.total_time)
+
+    write_csv("batch_evaluation_times.csv", evaluating_times)
+    write_csv("batch_total_times.csv", times)
+
+def test_symmetric_caching(canonical, board_size):
+    '''Measures the fraction of positions found in the transposition table and the number of positions analysed when positions are stored under their canonical symmetric representative.'''
+
+    details = str(board_size) + "TThard3"
+    if canonical:
+        details += "canonical"
+
+    hit_rates = [details]
+    calls = [details]
 
-def test_depth(depth, n):
+    for state in corpus_states(board_size):
+        stats = SearchStats(timing=False)
+        search = Search(evaluate_hard, True, True, canonical=canonical, stats=stats)
+        move = search.negamax(state, 3)
+        hit_rates.append(stats.cache_hit_rate())
+        calls.append(stats.nodes_searched())
+
+    write_csv("symmetric_caching_hits.csv", hit_rates)
+    write_csv("symmetric_caching_calls.csv", calls)
+
+def test_depth(depth):
     details = '3TThard' + str(depth)
 
     times = [details]
 
-    state = State(3)
-    for _ in range(n):
+    for state in corpus_states(3):
         time, move = test_negamax(state, depth, True, True, evaluate_hard)
-        if state.objective() != Result.NOT_FINISHED:
-            break
         times.append(time)
-        state = move.play(state)
     
     write_csv('depth.csv', times)
 
 def statistics():
     '''Obtains statistics for the negamax algorithm.'''
     
-    iterations = 25
-    
     # Branching Factor and Total Times depending on Board Size
     for board_size in range(3, 6):
-        test_totals(board_size, iterations)
+        test_totals(board_size)
     
     # Parameters
     for cuts in [True, False]:
         for caching in [True, False]:
-            test_parameters(cuts, caching, iterations)
+            test_parameters(cuts, caching)
     
     # Depth
     for depth in range(3, 6):
-        test_depth(depth, iterations)
+        test_depth(depth)
 
     # Heuristics
     for difficulty in ["easy", "medium", "hard"]:
-        test_heuristics(difficulty, iterations)
+        test_heuristics(difficulty)
+
+    # Move ordering
+    for ordering in [False, True]:
+        test_move_ordering(ordering)
     
+    # Batched leaf evaluation
+    for batch_size in [0, 16, 64]:
+        test_batch_evaluation(batch_size)
+
+    # Symmetric positions in the transposition table
+    for board_size in [3, 4]:
+        for canonical in [False, True]:
+            test_symmetric_caching(canonical, board_size)
+
     # Time Percentage
-    test_time_percentage(iterations)
+    test_time_percentage()
 
 if __name__ == "__main__":
     start = time.time()
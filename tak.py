@@ -1,11 +1,12 @@
 
-from typing import List, Callable
+from array import array
+from typing import List
 from enum import Enum, auto
 import copy
 from pprint import pprint
-import time
 
-from utils import Position, get_partitions_with_leading_zero
+from utils import Position, directions, get_position, get_geometry, get_spread_table, get_partitions, transform, NUM_SYMMETRIES
+from zobrist import get_zobrist_keys
 
 class PieceType(Enum):
     FLAT = auto()
@@ -17,10 +18,34 @@ class Player:
     WHITE = 1
 
 class Piece:
-    def __init__(self, color: Player, type: PieceType):
-        self.color = color
-        self.type = type
-    
+    '''
+    Immutable piece. There are only six different pieces (see piece_variant) and Piece(color, type) returns the shared
+    object of the variant, so placing a piece doesn't allocate one and pieces can be shared between states: a wall is
+    flattened by replacing the top piece of its stack with the flat of the same color, never by changing the piece.
+    '''
+
+    # The variant of a piece is its index in the Zobrist tables (see piece_variant)
+    __slots__ = ('color', 'type', 'variant')
+
+    def __new__(cls, color: Player, type: PieceType):
+        return pieces[piece_variant(color, type)]
+
+    @staticmethod
+    def create(color: Player, type: PieceType):
+        '''Returns a new piece (only used to create the shared pieces)'''
+        piece = object.__new__(Piece)
+        object.__setattr__(piece, 'color', color)
+        object.__setattr__(piece, 'type', type)
+        object.__setattr__(piece, 'variant', piece_variant(color, type))
+        return piece
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Pieces are immutable')
+
+    def __reduce__(self):
+        # Unpickled (and copied) pieces are the shared ones
+        return Piece, (self.color, self.type)
+
     def __repr__(self):
         colors = { Player.WHITE: 'w', Player.BLACK: 'b' }
         types = { PieceType.FLAT: 'f', PieceType.WALL: 'w', PieceType.CAPSTONE: 'c' }
@@ -31,7 +56,7 @@ class Piece:
         return hash((self.color, self.type))
 
     def __eq__(self, other):
-        return self.color == other.color and self.type == other.type
+        return self is other or (self.color == other.color and self.type == other.type)
 
 # State.board[row][col]
 # O-----col----->
@@ -59,10 +84,21 @@ capstones_for_size = {
     6: 1, 7: 1, 8: 2
 }
 
+def max_height(board_size: int) -> int:
+    '''Returns the maximum height of a stack (every piece of both players in the same square)'''
+    return 2 * (flats_for_size[board_size] + capstones_for_size[board_size])
+
+def piece_variant(color: Player, piece_type: PieceType) -> int:
+    '''Returns the index of a piece in the Zobrist tables (white flat, wall and capstone, then black flat, wall and capstone)'''
+    return (3 if color == Player.BLACK else 0) + piece_type.value - 1
+
+# The shared pieces, in the order of their variants
+pieces = [Piece.create(color, piece_type) for color in (Player.WHITE, Player.BLACK) for piece_type in PieceType]
+
 class CachingFlag:
-    EXACT = auto()
-    LOWERBOUND = auto()
-    UPPERBOUND = auto()
+    EXACT = 0
+    LOWERBOUND = 1
+    UPPERBOUND = 2
 
 def heuristic_num_flats(state, player) -> int:
     '''Calculates the number of flats each player controls (useful for obtaining a flat win)'''
@@ -85,7 +121,7 @@ def heuristic_penalty_walls(state, player) -> int:
         for col in range(state.board_size):
             stack = state.board[row][col]
             if len(stack) == 1 and stack[0].type == PieceType.WALL:
-                adjacent = [Position(row, col) + direction for direction in directions.values()]
+                adjacent = [get_position(row, col) + direction for direction in directions.values()]
                 adjacent = filter(lambda x: x.is_within_bounds(0, state.board_size - 1), adjacent)
 
                 # Obtain adjacent stacks which are not empty
@@ -164,7 +200,7 @@ def heuristic_influence(state, player) -> int:
             stack = state.board[row][col]
 
             if stack:
-                pos = Position(row, col)
+                pos = get_position(row, col)
                 adjacent = [pos.up(), pos.down(), pos.left(), pos.right()]
                 adjacent = list(filter(lambda pos: pos.is_within_bounds(0, state.board_size - 1), adjacent))
 
@@ -186,28 +222,7 @@ def heuristic_influence(state, player) -> int:
 
 def evaluate(state, player: Player, depth: int, level: int = 3) -> int:
     '''Returns a number representing the value of this game state for the given player'''
-
-    result = state.objective()
-
-    if result == Result.DRAW:
-        return 0
-    elif (result == Result.WHITE_WIN and player == Player.WHITE) or (result == Result.BLACK_WIN and player == Player.BLACK):
-        return int(1e9) + depth
-    elif (result == Result.WHITE_WIN and player == Player.BLACK) or (result == Result.BLACK_WIN and player == Player.WHITE):
-        return int(-1e9) - depth
-
-    value = 0
-
-    # The overall evaluation can be fine-tuned by adjusting each heuristic's multiplier
-    if level == 1:
-        value = 10 * heuristic_num_flats(state, player) + 2 * heuristic_captured_pieces(state, player) + 2 * heuristic_influence(state, player)
-    elif level == 2:
-        value = 10 * heuristic_num_flats(state, player) + 2 * heuristic_captured_pieces(state, player) + 2 * heuristic_influence(state, player) + heuristic_penalty_walls(state, player)
-    elif level == 3:
-        value = 10 * heuristic_num_flats(state, player) + heuristic_penalty_walls(state, player) + 2 * heuristic_influence(state, player) + \
-            2 * heuristic_captured_pieces(state, player) + heuristic_nearness_to_optimal_road(state, player)
-
-    return value
+    return state.evaluate(player, depth, level)
 
 def evaluate_easy(state, player: Player, depth: int) -> int:
     '''Returns the game state evaluation for the easy (level 1) AI'''
@@ -237,6 +252,20 @@ class State:
             Player.WHITE: capstones_for_size[board_size],
             Player.BLACK: capstones_for_size[board_size]
         }
+
+        self.zobrist = get_zobrist_keys(board_size, max_height(board_size))
+        self.hash = self.zobrist.first_turn
+
+        # Masks (see utils.Geometry) of the occupied squares and of the squares controlled by each player
+        # that can be part of a road, that are flats or that are walls, kept up to date by each move
+        self.occupied = 0
+        self.road_masks = { Player.WHITE: 0, Player.BLACK: 0 }
+        self.flat_masks = { Player.WHITE: 0, Player.BLACK: 0 }
+        self.wall_masks = { Player.WHITE: 0, Player.BLACK: 0 }
+
+        # Cached result of the game (None if unknown) and the results before each move applied in place
+        self.result = Result.NOT_FINISHED
+        self.previous_results = []
     
     def copy(self):
         '''Returns a copy of the game state. This custom copy function is more efficient than deepcopy'''
@@ -246,238 +275,435 @@ class State:
         state_copy.current_player = self.current_player
         state_copy.num_flats = copy.copy(self.num_flats)
         state_copy.num_caps = copy.copy(self.num_caps)
+        state_copy.hash = self.hash
+
+        state_copy.occupied = self.occupied
+        state_copy.road_masks = copy.copy(self.road_masks)
+        state_copy.flat_masks = copy.copy(self.flat_masks)
+        state_copy.wall_masks = copy.copy(self.wall_masks)
+        state_copy.result = self.result
 
         for row in range(self.board_size):
             for col in range(self.board_size):
                 state_copy.board[row][col] = copy.copy(self.board[row][col])
         
         return state_copy
+
+    def __getstate__(self):
+        '''Tables shared by every state of the same size are not pickled (they are restored from the caches when unpickling)'''
+        state = self.__dict__.copy()
+        del state['zobrist']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.zobrist = get_zobrist_keys(self.board_size, max_height(self.board_size))
     
+    def compute_hash(self, symmetry: int = 0) -> int:
+        '''
+        Calculates the Zobrist hash of the position from scratch (it is otherwise updated incrementally by each move).
+        Optionally, calculates the hash of the position obtained by applying one of the symmetries of the board (see utils.Geometry).
+        '''
+        value = self.zobrist.first_turn if self.first_turn else 0
+
+        if self.current_player == Player.BLACK:
+            value ^= self.zobrist.black_to_move
+
+        board = self.board
+        squares = get_geometry(self.board_size).symmetries[symmetry]
+        for row in range(self.board_size):
+            for col in range(self.board_size):
+                for height, piece in enumerate(board[row][col]):
+                    value ^= self.zobrist.piece(squares[row * self.board_size + col], height, piece.variant)
+
+        return value
+
+    def canonical_hash(self):
+        '''
+        Returns the smallest hash among the positions symmetric to this one (which is the same for all of them),
+        along with the symmetry that transforms this position into the one with that hash
+        '''
+        return min((self.compute_hash(symmetry), symmetry) for symmetry in range(NUM_SYMMETRIES))
+
     def __hash__(self):
-        board_tuple = tuple(tuple(tuple(self.board[row][col]) for col in range(self.board_size) for row in range(self.board_size)))
-        return hash((board_tuple, self.current_player))
+        return self.hash
     
     def __eq__(self, other):
         return self.board == other.board and self.current_player == other.current_player
     
     def possible_moves(self) -> List:
-        '''Returns a list of all valid moves for this game state.'''
+        '''
+        Returns a list of all valid moves for this game state, in the order of their codes in generate_moves (which
+        is the only move generator, so that every representation of the board follows the same rules).
+        '''
+        codes = []
+        self.generate_moves(codes)
+        decode_move = self.decode_move
+        return [decode_move(code) for code in codes]
 
-        moves = []
+    def generate_moves(self, buffer: array):
+        '''
+        Appends the codes (see MoveTable) of every valid move for this game state to the given buffer. Only valid moves
+        are generated: stacks are spread using the precomputed drop patterns for the number of pieces carried (at most
+        the board size) and the number of squares available before the edge of the board or an obstacle. The buffer
+        (an array or a list) can be reused between calls, so that no list of moves is allocated.
+        '''
+        if self.objective() != Result.NOT_FINISHED:
+            return
+
+        table = get_move_table(self.board_size)
+        rays = table.geometry.rays
+        player = self.current_player
+        occupied = self.occupied_mask()
+        own, walls, caps = self.top_masks(player)
+        obstacles = walls | caps
+
+        # Offsets of the placements available on an empty square, in the order of PLACEMENT_TYPES
+        placements = []
+        if self.num_flats[player] > 0:
+            placements.append(0)
+            if not self.first_turn:
+                placements.append(1)
+        if self.num_caps[player] > 0 and not self.first_turn:
+            placements.append(2)
+
+        for sq in range(self.board_size * self.board_size):
+            bit = 1 << sq
+
+            if not occupied & bit:
+                for kind in placements:
+                    buffer.append(3 * sq + kind)
+            elif own & bit and not self.first_turn:
+                max_carry = min(self.stack_height(sq), self.board_size)
+                is_cap = caps & bit
+
+                for d in range(4):
+                    # Number of squares the stack can spread over before reaching an obstacle
+                    distance = 0
+                    flatten = False
+                    for sq_to in rays[d][sq]:
+                        if obstacles >> sq_to & 1:
+                            flatten = is_cap and walls >> sq_to & 1
+                            break
+                        distance += 1
+
+                    if distance or flatten:
+                        buffer.extend(table.spread_codes(sq, d, max_carry, distance, flatten))
+
+    def top_masks(self, player: Player):
+        '''
+        Returns the masks of the stacks controlled by the given player, of the walls and of the capstones (on top
+        of their stacks), which is all generate_moves needs from the board besides the heights of the stacks
+        '''
+        walls = self.wall_masks[Player.WHITE] | self.wall_masks[Player.BLACK]
+        caps = (self.road_masks[Player.WHITE] | self.road_masks[Player.BLACK]) & ~(self.flat_masks[Player.WHITE] | self.flat_masks[Player.BLACK])
+        return self.road_masks[player] | self.wall_masks[player], walls, caps
 
-        if self.objective() == Result.NOT_FINISHED:
-            positions = []
+    def stack_height(self, sq: int) -> int:
+        '''Returns the number of pieces on the given square (see utils.Geometry)'''
+        return len(self.board[sq // self.board_size][sq % self.board_size])
 
-            for row in range(self.board_size):
-                for col in range(self.board_size):
-                    positions.append(Position(row, col))
+    def decode_move(self, code: int):
+        '''Returns the Move with the given code (see MoveTable) for this game state'''
+        table = get_move_table(self.board_size)
+        sq = table.square(code)
+        return table.to_move(code, len(self.board[sq // self.board_size][sq % self.board_size]))
 
-            for position in positions:
-                stack_size = len(self.board[position.row][position.col])
+    def apply_code(self, code: int):
+        '''
+        Plays the move with the given code in place (without creating a Move), returning the information needed
+        to undo it (see undo_code)
+        '''
+        table = get_move_table(self.board_size)
 
-                if stack_size == 0:
-                    moves += [PlaceFlat(position), PlaceWall(position), PlaceCap(position)]
-                else:
-                    for direction in directions.values():
-                        moves.append(MovePiece(position, direction))
+        if code < table.num_placements:
+            return self.place(table.geometry.positions[code // 3], PLACEMENT_TYPES[code % 3])
+
+        pos, direction, carry, drops = table.decode_spread_move(code)
+        return self.spread(pos, direction, (len(self.board[pos.row][pos.col]) - carry, ) + drops)
 
-                        if stack_size > 1:
-                            for partition in get_partitions_with_leading_zero(stack_size):
-                                moves.append(SplitStack(position, direction, partition))
+    def undo_code(self, code: int, undo_info):
+        '''Reverts the move with the given code, given the information returned by apply_code'''
+        table = get_move_table(self.board_size)
 
-        return list(filter(lambda move: move.is_valid(self), moves))
+        if code < table.num_placements:
+            self.unplace(table.geometry.positions[code // 3], undo_info)
+        else:
+            # The pieces left behind are the whole stack of the square until the spread is reverted
+            pos, direction, _, drops = table.decode_spread_move(code)
+            self.unspread(pos, direction, (len(self.board[pos.row][pos.col]), ) + drops, undo_info)
     
+    def road_mask(self, player: Player) -> int:
+        '''Returns a mask of the squares controlled by the given player which can be part of a road (flats and capstones)'''
+        return self.road_masks[player]
+
+    def occupied_mask(self) -> int:
+        '''Returns a mask of the squares which are not empty'''
+        return self.occupied
+
+    def flat_count(self, player: Player) -> int:
+        '''Returns the number of stacks controlled by the given player which have a flat on top'''
+        return self.flat_masks[player].bit_count()
+
+    def update_masks(self, row: int, col: int):
+        '''Updates the masks after the stack at the given position has changed'''
+        bit = 1 << (row * self.board_size + col)
+        stack = self.board[row][col]
+
+        self.occupied &= ~bit
+        for player in (Player.WHITE, Player.BLACK):
+            self.road_masks[player] &= ~bit
+            self.flat_masks[player] &= ~bit
+            self.wall_masks[player] &= ~bit
+
+        if stack:
+            top = stack[-1]
+            self.occupied |= bit
+
+            if top.type != PieceType.WALL:
+                self.road_masks[top.color] |= bit
+            if top.type == PieceType.FLAT:
+                self.flat_masks[top.color] |= bit
+            elif top.type == PieceType.WALL:
+                self.wall_masks[top.color] |= bit
+
     def objective(self) -> Result:
-        '''Checks if the game is finished, returning the game's result (WHITE_WIN, DRAW or BLACK_WIN) or NOT_FINISHED otherwise.'''
-
-        def part_of_road(pos: Position, player: Player) -> bool:
-            return self.board[pos.row][pos.col] and self.board[pos.row][pos.col][-1].color == player and self.board[pos.row][pos.col][-1].type != PieceType.WALL
-
-        # Depth first search (to search for road)
-        def dfs(stack: List[Position], player: Player):
-            visited = set()
-
-            while stack:
-                pos = stack.pop()
-                if pos not in visited:
-                    visited.add(pos)
-                    adjacent = [pos.up(), pos.down(), pos.left(), pos.right()]
-                    
-                    for adj_pos in adjacent:
-                        if adj_pos not in visited and adj_pos.is_within_bounds(0, self.board_size - 1) and part_of_road(adj_pos, player):
-                            stack.append(adj_pos)
-            
-            return visited
-        
-        end_rows = set(Position(row, self.board_size - 1) for row in range(self.board_size))
-        end_cols = set(Position(self.board_size - 1, col) for col in range(self.board_size))
-        
-        # Search for white road (horizontal or vertical)
-        start_rows = [Position(row, 0) for row in range(self.board_size) if part_of_road(Position(row, 0), Player.WHITE)]
-        start_cols = [Position(0, col) for col in range(self.board_size) if part_of_road(Position(0, col), Player.WHITE)]
+        '''
+        Checks if the game is finished, returning the game's result (WHITE_WIN, DRAW or BLACK_WIN) or NOT_FINISHED otherwise.
+        The result is cached and updated after each move (see update_result), so it's only calculated from scratch when unknown.
+        '''
+        if self.result is None:
+            self.result = self.find_result()
+        return self.result
+
+    def find_result(self) -> Result:
+        '''Calculates the result of the game from scratch'''
+        geometry = get_geometry(self.board_size)
 
-        if end_rows.intersection(dfs(start_rows, Player.WHITE)) or end_cols.intersection(dfs(start_cols, Player.WHITE)):
+        # Search for white road, then for black road (horizontal or vertical)
+        if geometry.has_road(self.road_mask(Player.WHITE)):
             return Result.WHITE_WIN
 
-        # Search for black road (horizontal or vertical)
-        start_rows = [Position(row, 0) for row in range(self.board_size) if part_of_road(Position(row, 0), Player.BLACK)]
-        start_cols = [Position(0, col) for col in range(self.board_size) if part_of_road(Position(0, col), Player.BLACK)]
+        if geometry.has_road(self.road_mask(Player.BLACK)):
+            return Result.BLACK_WIN
+
+        return self.flat_result()
+
+    def flat_result(self) -> Result:
+        '''Tests for a flat win, which happens when the board is full'''
+        if self.occupied_mask() != get_geometry(self.board_size).full:
+            return Result.NOT_FINISHED
+
+        white_flats = self.flat_count(Player.WHITE)
+        black_flats = self.flat_count(Player.BLACK)
 
-        if end_rows.intersection(dfs(start_rows, Player.BLACK)) or end_cols.intersection(dfs(start_cols, Player.BLACK)):
+        if white_flats > black_flats:
+            return Result.WHITE_WIN
+        elif black_flats > white_flats:
             return Result.BLACK_WIN
+        return Result.DRAW
 
-        # Test for flat win
-        controlled_flats = { Player.BLACK: 0, Player.WHITE: 0 }
-        board_full = True
-        for row in range(self.board_size):
-            for col in range(self.board_size):
-                if not self.board[row][col]:
-                    board_full = False
-                    break
-                
-                top = self.board[row][col][-1]
-                if top.type == PieceType.FLAT:
-                    controlled_flats[top.color] += 1
-            
-            if not board_full:
-                break
+    def new_road(self, changed: int) -> Result:
+        '''
+        Checks if the last move, which changed the squares in the given mask, completed a road (returning the
+        winner or None). The game wasn't finished before the move, so a new road must go through one of the
+        changed squares and only the road squares connected to them need to be searched.
+        '''
+        geometry = get_geometry(self.board_size)
+
+        for player, result in ((Player.WHITE, Result.WHITE_WIN), (Player.BLACK, Result.BLACK_WIN)):
+            road = self.road_mask(player)
+            if changed & road and geometry.has_road(geometry.flood(changed, road)):
+                return result
+
+        return None
+
+    def update_result(self, changed: int):
+        '''Updates the cached result after a move which changed the squares in the given mask'''
+        self.previous_results.append(self.result)
+
+        if self.result == Result.NOT_FINISHED:
+            self.result = self.new_road(changed) or self.flat_result()
         else:
-            if controlled_flats[Player.WHITE] > controlled_flats[Player.BLACK]:
-                return Result.WHITE_WIN
-            elif controlled_flats[Player.BLACK] > controlled_flats[Player.WHITE]:
-                return Result.BLACK_WIN
-            return Result.DRAW
+            self.result = None
 
-        return Result.NOT_FINISHED
-    
-    # Statistics for the negamax algorithm
-    total_time = 0
-    nm_calls = 0
-    nm_prunings = 0
-    nm_cache_hits = 0
-    nm_time_possible_moves = 0
-    nm_time_evaluating = 0
-    nm_time_playing_moves = 0
-
-    transposition_cache = {}
-    def negamax(self, depth: int, evaluation_function: Callable = evaluate_hard, pruning: bool = False, caching: bool = False, statistics: bool = False):
+    def restore_result(self):
+        '''Restores the cached result after a move is undone'''
+        self.result = self.previous_results.pop()
+
+    def road_threats(self, player: Player) -> int:
+        '''Returns a mask (see utils.Geometry) of the empty squares where a flat of the given player would complete a road'''
+        geometry = get_geometry(self.board_size)
+        return geometry.road_threats(self.road_mask(player), geometry.full & ~self.occupied_mask())
+
+    def evaluate(self, player: Player, depth: int, level: int = 3) -> int:
+        '''Returns a number representing the value of this game state for the given player'''
+
+        result = self.objective()
+
+        if result == Result.DRAW:
+            return 0
+        elif (result == Result.WHITE_WIN and player == Player.WHITE) or (result == Result.BLACK_WIN and player == Player.BLACK):
+            return int(1e9) + depth
+        elif (result == Result.WHITE_WIN and player == Player.BLACK) or (result == Result.BLACK_WIN and player == Player.WHITE):
+            return int(-1e9) - depth
+
+        value = 0
+
+        # The overall evaluation can be fine-tuned by adjusting each heuristic's multiplier
+        if level == 1:
+            value = 10 * heuristic_num_flats(self, player) + 2 * heuristic_captured_pieces(self, player) + 2 * heuristic_influence(self, player)
+        elif level == 2:
+            value = 10 * heuristic_num_flats(self, player) + 2 * heuristic_captured_pieces(self, player) + 2 * heuristic_influence(self, player) + heuristic_penalty_walls(self, player)
+        elif level == 3:
+            value = 10 * heuristic_num_flats(self, player) + heuristic_penalty_walls(self, player) + 2 * heuristic_influence(self, player) + \
+                2 * heuristic_captured_pieces(self, player) + heuristic_nearness_to_optimal_road(self, player)
+
+        return value
+
+    def place(self, pos: Position, piece_type: PieceType) -> bool:
         '''
-        Implementation of the negamax algorithm, a variant of minimax that takes advantage of the
-        zero-sum property of two-player adversarial games. Includes parameters for specifying the
-        maximum depth, whether alpha-beta pruning is used, whether a transposition cache is used to
-        avoid exploring the same positions more than once and whether statistics about the algorithm
-        are printed to the console.
+        Places a new piece of the given type on an empty square and passes the turn (the move is assumed to be valid).
+        Returns the previous value of first_turn, which is needed to undo the placement.
         '''
 
-        if depth <= 0:
-            return None
-        
-        alpha, beta = 0, 0
-        if pruning:
-            alpha, beta = int(-1e10), int(1e10)
-
-        if caching:
-            State.transposition_cache = {}
-
-        if statistics:
-            State.nm_calls = 0
-            State.nm_prunings = 0
-            State.nm_cache_hits = 0
-            State.nm_time_possible_moves = 0
-            State.nm_time_evaluating = 0
-            State.nm_time_playing_moves = 0
-
-        start = time.time()
-        _, move = self.negamax_recursive(depth, evaluation_function, pruning, caching, statistics, alpha, beta)
-        end = time.time()
-
-        if statistics:
-            State.total_time = end - start
-            #print("Total execution time:", end - start)
-            #print("Number of positions analysed:", State.nm_calls)
-            #print("Number of cuts:", State.nm_prunings)
-            #print("Number of cache hits:", State.nm_cache_hits)
-            #print("Time spent calculting possible moves:", State.nm_time_possible_moves)
-            #print("Time spent evaluating:", State.nm_time_evaluating)
-
-        return move
-    
-    def negamax_recursive(self, depth: int, evaluation_function: Callable, pruning: bool, caching: bool, statistics: bool, alpha: int, beta: int):
-        original_alpha = alpha
-        
-        if statistics:
-            State.nm_calls += 1
-        
-        if caching and self in State.transposition_cache:
-            cache_depth, flag, ret = State.transposition_cache[self]
-            if cache_depth >= depth:
-                State.nm_cache_hits += 1
-
-                if flag == CachingFlag.EXACT:
-                    return ret
-                elif flag == CachingFlag.LOWERBOUND:
-                    alpha = max(alpha, ret[0])
-                elif flag == CachingFlag.UPPERBOUND:
-                    beta = min(beta, ret[0])
-
-                if alpha >= beta:
-                    if statistics:
-                        State.nm_prunings += 1
-                    return ret
-
-        start = time.time()
-        moves = self.possible_moves()
-        end = time.time()
-
-        if statistics:
-            State.nm_time_possible_moves += end - start
-
-        # Maximum depth has been reached or no possible moves (game has ended): run evaluation function
-        if depth == 0 or not moves:
-            start = time.time()
-            evaluation = evaluation_function(self, self.current_player, depth)
-            end = time.time()
-
-            if statistics:
-                State.nm_time_evaluating += end - start
-            
-            return evaluation, None
+        first_turn = self.first_turn
+        color = self.current_player
 
-        best_move = None
-        max_value = int(-1e10)
+        if piece_type == PieceType.FLAT and self.first_turn:
+            # During the first turn, players place one of their opponent's flat pieces
+            color = -self.current_player
+            self.num_flats[color] -= 1
+
+            if self.current_player == Player.BLACK:
+                self.first_turn = False
+                self.hash ^= self.zobrist.first_turn
+        elif piece_type == PieceType.CAPSTONE:
+            self.num_caps[color] -= 1
+        else:
+            self.num_flats[color] -= 1
 
-        for move in moves:
-            start = time.time()
-            new_state = move.play(self)
-            end = time.time()
+        piece = Piece(color, piece_type)
+        self.board[pos.row][pos.col].append(piece)
+        self.hash ^= self.zobrist.piece(pos.row * self.board_size + pos.col, 0, piece.variant) ^ self.zobrist.black_to_move
 
-            if statistics:
-                State.nm_time_playing_moves += end - start
-            
-            value = -new_state.negamax_recursive(depth - 1, evaluation_function, pruning, caching, statistics, -beta, -alpha)[0]
+        self.update_masks(pos.row, pos.col)
+        self.update_result(1 << (pos.row * self.board_size + pos.col))
+
+        self.current_player = -self.current_player
+        return first_turn
+
+    def unplace(self, pos: Position, first_turn: bool):
+        '''Reverts a placement, given the value returned by place'''
+
+        self.current_player = -self.current_player
+
+        piece = self.board[pos.row][pos.col].pop()
+        if piece.type == PieceType.CAPSTONE:
+            self.num_caps[piece.color] += 1
+        else:
+            self.num_flats[piece.color] += 1
+
+        self.hash ^= self.zobrist.piece(pos.row * self.board_size + pos.col, 0, piece.variant) ^ self.zobrist.black_to_move
+        if first_turn != self.first_turn:
+            self.hash ^= self.zobrist.first_turn
+
+        self.update_masks(pos.row, pos.col)
+        self.restore_result()
+
+        self.first_turn = first_turn
+
+    def spread_hash(self, pos: Position, direction: Position, split: List[int]) -> int:
+        '''
+        Returns the XOR of every Zobrist key changed by a spread, computed from the position before the spread
+        (applying it to the hash both plays and reverts the spread).
+        '''
+
+        zobrist = self.zobrist
+        stack = self.board[pos.row][pos.col]
+        sq = pos.row * self.board_size + pos.col
+        height = split[0]
+        value = zobrist.black_to_move
+
+        for i, num_pieces in enumerate(split):
+            if i != 0:
+                pos_to = pos + direction.scalar_mult(i)
+                stack_to = self.board[pos_to.row][pos_to.col]
+                sq_to = pos_to.row * self.board_size + pos_to.col
+
+                if stack_to and stack_to[-1].type == PieceType.WALL:
+                    # Capstone converts a wall to a flat piece
+                    wall = stack_to[-1]
+                    value ^= zobrist.piece(sq_to, len(stack_to) - 1, wall.variant) ^ \
+                        zobrist.piece(sq_to, len(stack_to) - 1, Piece(wall.color, PieceType.FLAT).variant)
+
+                for j in range(num_pieces):
+                    variant = stack[height].variant
+                    value ^= zobrist.piece(sq, height, variant) ^ zobrist.piece(sq_to, len(stack_to) + j, variant)
+                    height += 1
+
+        return value
+
+    def spread(self, pos: Position, direction: Position, split: List[int]) -> bool:
+        '''
+        Picks up the stack at the given position and drops split[i] pieces (taken from the bottom)
+        i squares away in the given direction, then passes the turn (the move is assumed to be valid).
+        Returns whether a wall was flattened, which is needed to undo the spread.
+        '''
+
+        self.hash ^= self.spread_hash(pos, direction, split)
+
+        flattened = False
+        changed = 0
+        stack = self.board[pos.row][pos.col]
+        self.board[pos.row][pos.col] = []
+
+        for i, num_pieces in enumerate(split):
+            pos_to = pos + direction.scalar_mult(i)
+            stack_to = self.board[pos_to.row][pos_to.col]
+
+            stack_slice, stack = stack[:num_pieces], stack[num_pieces:]
+
+            if stack_slice and stack_to and stack_slice[0].type == PieceType.CAPSTONE and stack_to[-1].type == PieceType.WALL:
+                # Capstone converts a wall to a flat piece
+                stack_to[-1] = Piece(stack_to[-1].color, PieceType.FLAT)
+                flattened = True
+
+            stack_to += stack_slice
+
+            self.update_masks(pos_to.row, pos_to.col)
+            changed |= 1 << (pos_to.row * self.board_size + pos_to.col)
+
+        self.update_result(changed)
+
+        self.current_player = -self.current_player
+        return flattened
+
+    def unspread(self, pos: Position, direction: Position, split: List[int], flattened: bool):
+        '''Reverts a spread, given the value returned by spread'''
+
+        self.current_player = -self.current_player
+        stack = self.board[pos.row][pos.col]
+
+        # The pieces dropped on each square are on top of its stack, and are given back in order
+        for i, num_pieces in enumerate(split):
+            if i != 0:
+                pos_to = pos + direction.scalar_mult(i)
+                stack_to = self.board[pos_to.row][pos_to.col]
+
+                stack += stack_to[len(stack_to) - num_pieces:]
+                del stack_to[len(stack_to) - num_pieces:]
+                self.update_masks(pos_to.row, pos_to.col)
+
+        if flattened:
+            stack_to[-1] = Piece(stack_to[-1].color, PieceType.WALL)
+            self.update_masks(pos_to.row, pos_to.col)
+
+        self.update_masks(pos.row, pos.col)
+        self.restore_result()
+
+        self.hash ^= self.spread_hash(pos, direction, split)
 
-            if value > max_value:
-                max_value = value
-                best_move = move
-            
-            if pruning:
-                alpha = max(alpha, max_value)
-                if alpha >= beta:
-                    if statistics:
-                        State.nm_prunings += 1
-                    break
-
-        if caching:
-            flag = CachingFlag.EXACT
-            if max_value <= original_alpha:
-                flag = CachingFlag.UPPERBOUND
-            elif max_value >= beta:
-                flag = CachingFlag.LOWERBOUND
-
-            State.transposition_cache[self] = depth, flag, (max_value, best_move)
-        
-        return max_value, best_move
-    
     def to_dict(self) -> dict:
         '''Returns a dictionary representation of State (used for communicating with front-end through JSON messages)'''
         board_json = [[[repr(piece) for piece in stack] for stack in row] for row in self.board]
@@ -499,11 +725,29 @@ class Move:
     def play(self, state: State) -> State:
         '''Returns the game state after this move has been played'''
         raise NotImplementedError()
+
+    def apply(self, state: State):
+        '''Plays this move on the specified game state in place, returning the information needed to undo it'''
+        raise NotImplementedError()
+
+    def undo(self, state: State, undo_info):
+        '''Reverts this move on the specified game state, given the information returned by apply'''
+        raise NotImplementedError()
+
+    def transform(self, board_size: int, symmetry: int):
+        '''Returns the image of this move under one of the symmetries of the board (see utils.Geometry)'''
+        raise NotImplementedError()
     
     def to_dict(self) -> dict:
         '''Returns a dictionary representation of Move (used for communicating with front-end through JSON messages)'''
         raise NotImplementedError()
 
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __hash__(self):
+        return hash((type(self), ) + tuple(self.__dict__.values()))
+
 class PlaceFlat(Move):
     def __init__(self, pos: Position):
         self.pos = pos
@@ -513,21 +757,18 @@ class PlaceFlat(Move):
     
     def play(self, state: State) -> State:
         state_copy = state.copy()
+        state_copy.place(self.pos, PieceType.FLAT)
+        return state_copy
 
-        if state_copy.first_turn:
-            # During the first turn, players place one of their opponent's flat pieces
-            state_copy.board[self.pos.row][self.pos.col].append(Piece(-state_copy.current_player, PieceType.FLAT))
-            state_copy.num_flats[-state_copy.current_player] -= 1
+    def apply(self, state: State) -> bool:
+        return state.place(self.pos, PieceType.FLAT)
 
-            if state_copy.current_player == Player.BLACK:
-                state_copy.first_turn = False
-        else:
-            state_copy.board[self.pos.row][self.pos.col].append(Piece(state_copy.current_player, PieceType.FLAT))
-            state_copy.num_flats[state_copy.current_player] -= 1
-        
-        state_copy.current_player = -state_copy.current_player
-        return state_copy
+    def undo(self, state: State, undo_info: bool):
+        state.unplace(self.pos, undo_info)
     
+    def transform(self, board_size: int, symmetry: int):
+        return PlaceFlat(transform(self.pos, board_size - 1, symmetry))
+
     def to_dict(self) -> dict:
         return {
             'type': self.__class__.__name__,
@@ -546,13 +787,18 @@ class PlaceWall(Move):
     
     def play(self, state: State) -> State:
         state_copy = state.copy()
+        state_copy.place(self.pos, PieceType.WALL)
+        return state_copy
 
-        state_copy.board[self.pos.row][self.pos.col].append(Piece(state_copy.current_player, PieceType.WALL))
-        state_copy.num_flats[state_copy.current_player] -= 1
+    def apply(self, state: State) -> bool:
+        return state.place(self.pos, PieceType.WALL)
 
-        state_copy.current_player = -state_copy.current_player
-        return state_copy
+    def undo(self, state: State, undo_info: bool):
+        state.unplace(self.pos, undo_info)
     
+    def transform(self, board_size: int, symmetry: int):
+        return PlaceWall(transform(self.pos, board_size - 1, symmetry))
+
     def to_dict(self) -> dict:
         return {
             'type': self.__class__.__name__,
@@ -571,13 +817,18 @@ class PlaceCap(Move):
     
     def play(self, state: State) -> State:
         state_copy = state.copy()
+        state_copy.place(self.pos, PieceType.CAPSTONE)
+        return state_copy
 
-        state_copy.board[self.pos.row][self.pos.col].append(Piece(state_copy.current_player, PieceType.CAPSTONE))
-        state_copy.num_caps[state_copy.current_player] -= 1
+    def apply(self, state: State) -> bool:
+        return state.place(self.pos, PieceType.CAPSTONE)
 
-        state_copy.current_player = -state_copy.current_player
-        return state_copy
+    def undo(self, state: State, undo_info: bool):
+        state.unplace(self.pos, undo_info)
     
+    def transform(self, board_size: int, symmetry: int):
+        return PlaceCap(transform(self.pos, board_size - 1, symmetry))
+
     def to_dict(self) -> dict:
         return {
             'type': self.__class__.__name__,
@@ -587,13 +838,6 @@ class PlaceCap(Move):
     def __repr__(self):
         return 'PlaceCap ' + str(self.pos)
 
-directions = {
-    'UP': Position(-1, 0),
-    'DOWN': Position(1, 0),
-    'LEFT': Position(0, -1),
-    'RIGHT': Position(0, 1)
-}
-
 class MovePiece(Move):
     def __init__(self, pos: Position, direction: Position):
         self.pos = pos
@@ -626,21 +870,20 @@ class MovePiece(Move):
     
     def play(self, state: State) -> State:
         state_copy = state.copy()
+        # Moving a single piece is equivalent to spreading a stack of height one
+        state_copy.spread(self.pos, self.direction, (0, 1))
+        return state_copy
 
-        stack = state_copy.board[self.pos.row][self.pos.col]
-        piece = stack[-1]
-        stack_to = state_copy.board[self.pos_to.row][self.pos_to.col]
-
-        if piece.type == PieceType.CAPSTONE and stack_to and stack_to[-1].type == PieceType.WALL:
-            # Capstone converts a wall to a flat piece
-            stack_to[-1].type = PieceType.FLAT
-        
-        stack_to.append(piece)
-        stack.pop()
+    def apply(self, state: State) -> bool:
+        return state.spread(self.pos, self.direction, (0, 1))
 
-        state_copy.current_player = -state_copy.current_player
-        return state_copy
+    def undo(self, state: State, undo_info: bool):
+        state.unspread(self.pos, self.direction, (0, 1), undo_info)
     
+    def transform(self, board_size: int, symmetry: int):
+        # Directions are only rotated or reflected
+        return MovePiece(transform(self.pos, board_size - 1, symmetry), transform(self.direction, 0, symmetry))
+
     def to_dict(self) -> dict:
         return {
             'type': self.__class__.__name__,
@@ -662,14 +905,18 @@ class SplitStack(Move):
 
         if len(stack) <= 1 or len(self.split) <= 1 or stack[-1].color != state.current_player or len(stack) != sum(self.split):
             return False
+
+        # Players can't carry more pieces than the board size
+        if len(stack) - self.split[0] > state.board_size:
+            return False
         
         stack_copy = copy.copy(stack)
         for i, num_pieces in enumerate(self.split):
+            stack_slice, stack_copy = stack_copy[:num_pieces], stack_copy[num_pieces:]
+
             if i != 0:
                 if num_pieces == 0:
                     return False
-                
-                stack_slice, stack_copy = stack_copy[:num_pieces], stack_copy[num_pieces:]
 
                 pos_to = self.pos + self.direction.scalar_mult(i)
                 if not pos_to.is_within_bounds(0, state.board_size - 1):
@@ -684,25 +931,19 @@ class SplitStack(Move):
 
     def play(self, state: State) -> State:
         state_copy = state.copy()
+        state_copy.spread(self.pos, self.direction, self.split)
+        return state_copy
 
-        stack = state_copy.board[self.pos.row][self.pos.col]
-        state_copy.board[self.pos.row][self.pos.col] = []
-
-        for i, num_pieces in enumerate(self.split):
-            pos_to = self.pos + self.direction.scalar_mult(i)
-            stack_to = state_copy.board[pos_to.row][pos_to.col]
-
-            stack_slice, stack = stack[:num_pieces], stack[num_pieces:]
-
-            if stack_slice and stack_to and stack_slice[0].type == PieceType.CAPSTONE and stack_to[-1].type == PieceType.WALL:
-                # Capstone converts a wall to a flat piece
-                stack_to[-1].type = PieceType.FLAT
-            
-            stack_to += stack_slice
+    def apply(self, state: State) -> bool:
+        return state.spread(self.pos, self.direction, self.split)
 
-        state_copy.current_player = -state_copy.current_player
-        return state_copy
+    def undo(self, state: State, undo_info: bool):
+        state.unspread(self.pos, self.direction, self.split, undo_info)
     
+    def transform(self, board_size: int, symmetry: int):
+        # Directions are only rotated or reflected
+        return SplitStack(transform(self.pos, board_size - 1, symmetry), transform(self.direction, 0, symmetry), self.split)
+
     def to_dict(self) -> dict:
         return {
             'type': self.__class__.__name__,
@@ -713,3 +954,132 @@ class SplitStack(Move):
 
     def __repr__(self):
         return "SplitStack " + str(self.pos) + " | " + str(self.direction) + " | " + str(self.split)
+
+# Moves encoded as integers (see MoveTable): NO_MOVE stands for the absence of a move, and placements are
+# encoded with the index of their piece type (and Move class) in these lists
+NO_MOVE = -1
+PLACEMENT_TYPES = [PieceType.FLAT, PieceType.WALL, PieceType.CAPSTONE]
+PLACEMENT_MOVES = [PlaceFlat, PlaceWall, PlaceCap]
+
+class MoveTable:
+    '''
+    Encoding of the moves of a board size as small integers (move codes), which the search generates, stores and
+    compares instead of Move objects. A placement is encoded as 3 * square + the index of its piece type, and spreads
+    (including moves of a single piece) are numbered after the placements by their square, direction and drop pattern
+    (the pieces dropped on each square, see utils.SpreadTable). The pieces left behind aren't part of a code, since
+    they are the rest of the stack, so a code only becomes a Move given the height of its stack (see to_move).
+    '''
+
+    def __init__(self, board_size: int):
+        n = board_size
+        self.board_size = n
+        self.geometry = get_geometry(n)
+        self.spread_table = get_spread_table(n)
+        self.num_placements = 3 * n * n
+
+        # Every drop pattern: at most board_size pieces carried over at most board_size - 1 squares
+        self.patterns = [drops for carry in range(1, n + 1) for drops in sorted(get_partitions(carry)) if len(drops) < n]
+        self.pattern_indices = { drops: i for i, drops in enumerate(self.patterns) }
+        self.carries = [sum(drops) for drops in self.patterns]
+        self.num_patterns = len(self.patterns)
+        self.num_codes = self.num_placements + n * n * len(self.geometry.directions) * self.num_patterns
+
+        # Offset between consecutive squares in each direction (see utils.Geometry.directions) and the index
+        # of the image of each direction under each symmetry
+        self.steps = [direction.row * n + direction.col for direction in self.geometry.directions]
+        self.direction_images = [[self.geometry.directions.index(transform(direction, 0, t)) for direction in self.geometry.directions]
+            for t in range(NUM_SYMMETRIES)]
+
+        # Patterns and codes of the spreads of a stack (see spread_codes), computed the first time they are needed
+        self.spread_patterns = {}
+        self.spread_code_cache = {}
+
+    def square(self, code: int) -> int:
+        '''Returns the square of the move with the given code'''
+        if code < self.num_placements:
+            return code // 3
+        return (code - self.num_placements) // self.num_patterns >> 2
+
+    def decode_spread(self, code: int):
+        '''Returns the square, the step (see steps), the number of pieces carried and the drops of a spread'''
+        index, pattern = divmod(code - self.num_placements, self.num_patterns)
+        return index >> 2, self.steps[index & 3], self.carries[pattern], self.patterns[pattern]
+
+    def decode_spread_move(self, code: int):
+        '''Same as decode_spread, with the position of the square and the direction of the spread (see utils.directions)'''
+        index, pattern = divmod(code - self.num_placements, self.num_patterns)
+        return self.geometry.positions[index >> 2], self.geometry.directions[index & 3], self.carries[pattern], self.patterns[pattern]
+
+    def spread_codes(self, sq: int, d: int, max_carry: int, distance: int, flatten: bool) -> array:
+        '''
+        Returns the codes of the spreads of a stack in the given direction (see State.generate_moves), carrying at most max_carry pieces over distance free squares, optionally followed by
+        a wall that can be flattened. The returned array is shared and must not be modified.
+        '''
+        n = self.board_size
+        key = (((sq * 4 + d) * (n + 1) + max_carry) * n + distance) * 2 + (1 if flatten else 0)
+
+        codes = self.spread_code_cache.get(key)
+        if codes is None:
+            base = self.num_placements + (sq * 4 + d) * self.num_patterns
+            codes = array('i', [base + pattern for pattern in self.get_spread_patterns(max_carry, distance, flatten)])
+            self.spread_code_cache[key] = codes
+
+        return codes
+
+    def get_spread_patterns(self, max_carry: int, distance: int, flatten: bool) -> list:
+        '''Returns the indices of the drop patterns of the spreads described by the arguments of spread_codes'''
+        key = (max_carry, distance, bool(flatten))
+
+        if key not in self.spread_patterns:
+            patterns = []
+            for carry in range(1, max_carry + 1):
+                patterns += [self.pattern_indices[drops] for drops in self.spread_table.spreads[carry][distance]]
+                if flatten:
+                    patterns += [self.pattern_indices[drops] for drops in self.spread_table.flattening[carry][distance]]
+            self.spread_patterns[key] = patterns
+
+        return self.spread_patterns[key]
+
+    def encode(self, move: Move) -> int:
+        '''Returns the code of a valid move (NO_MOVE for None)'''
+        if move is None:
+            return NO_MOVE
+
+        sq = move.pos.row * self.board_size + move.pos.col
+
+        if isinstance(move, (MovePiece, SplitStack)):
+            drops = (1, ) if isinstance(move, MovePiece) else tuple(move.split[1:])
+            index = sq * 4 + self.geometry.directions.index(move.direction)
+            return self.num_placements + index * self.num_patterns + self.pattern_indices[drops]
+
+        return 3 * sq + PLACEMENT_MOVES.index(type(move))
+
+    def to_move(self, code: int, height: int) -> Move:
+        '''Returns the Move with the given code, given the height of the stack on its square (before the move)'''
+        if code < self.num_placements:
+            return PLACEMENT_MOVES[code % 3](self.geometry.positions[code // 3])
+
+        index, pattern = divmod(code - self.num_placements, self.num_patterns)
+        pos, direction = self.geometry.positions[index >> 2], self.geometry.directions[index & 3]
+
+        if height == 1:
+            return MovePiece(pos, direction)
+        return SplitStack(pos, direction, (height - self.carries[pattern], ) + self.patterns[pattern])
+
+    def transform(self, code: int, symmetry: int) -> int:
+        '''Returns the code of the image of a move under one of the symmetries of the board (see Move.transform)'''
+        squares = self.geometry.symmetries[symmetry]
+
+        if code < self.num_placements:
+            return 3 * squares[code // 3] + code % 3
+
+        index, pattern = divmod(code - self.num_placements, self.num_patterns)
+        index = squares[index >> 2] * 4 + self.direction_images[symmetry][index & 3]
+        return self.num_placements + index * self.num_patterns + pattern
+
+move_table_cache = {}
+def get_move_table(board_size: int) -> MoveTable:
+    '''Returns the (cached) move table for the given board size'''
+    if board_size not in move_table_cache:
+        move_table_cache[board_size] = MoveTable(board_size)
+    return move_table_cache[board_size]
@@ -0,0 +1,242 @@
+from array import array
+from multiprocessing import shared_memory
+
+from tak import PlaceFlat, PlaceWall, PlaceCap, MovePiece, SplitStack, NO_MOVE
+from utils import Position, directions
+
+class TranspositionTable:
+    '''
+    Fixed-capacity transposition table, stored in preallocated arrays (one entry per slot) so that its
+    memory usage does not grow during the search. Each position is mapped to a bucket with two slots:
+    the first one keeps the entry searched to the greatest depth, while the second one always stores
+    the most recent entry that did not fit in the first. Entries written by previous searches (older
+    generations) can always be replaced, which allows the table to be kept between consecutive searches.
+    Moves are stored as their codes (see tak.MoveTable), with NO_MOVE in the slots without a move.
+    '''
+
+    # Approximate number of bytes used by each slot (key, value, move code, generation and the smaller fields)
+    ENTRY_SIZE = 26
+
+    # Generations are 32-bit counters, so a table kept for a whole game (or server session) never sees an entry
+    # from a previous search that looks current because the counter wrapped around
+    GENERATION_MASK = 0xFFFFFFFF
+    SLOTS_PER_BUCKET = 2
+
+    def __init__(self, size_mb: float = 16):
+        self.num_buckets = max(1, int(size_mb * 2**20) // (TranspositionTable.ENTRY_SIZE * TranspositionTable.SLOTS_PER_BUCKET))
+        num_slots = self.num_buckets * TranspositionTable.SLOTS_PER_BUCKET
+
+        self.keys = array('Q', [0]) * num_slots
+        self.values = array('q', [0]) * num_slots
+        self.depths = array('b', [-1]) * num_slots # A negative depth marks an empty slot
+        self.flags = array('B', [0]) * num_slots
+        self.generations = array('I', [0]) * num_slots
+        self.moves = array('i', [NO_MOVE]) * num_slots
+
+        self.generation = 0
+
+    def new_search(self):
+        '''Starts a new generation, making the entries of previous searches replaceable'''
+        self.generation = (self.generation + 1) & TranspositionTable.GENERATION_MASK
+
+    def clear(self):
+        '''Removes every entry from the table'''
+        num_slots = len(self.keys)
+        self.depths = array('b', [-1]) * num_slots
+        self.moves = array('i', [NO_MOVE]) * num_slots
+        self.generation = 0
+
+    def probe(self, key: int):
+        '''Returns the (depth, flag, value, move) entry stored for the position with the given hash, or None'''
+        slot = (key % self.num_buckets) * TranspositionTable.SLOTS_PER_BUCKET
+
+        for slot in (slot, slot + 1):
+            if self.keys[slot] == key and self.depths[slot] >= 0:
+                # Entries that are still useful are kept from aging
+                self.generations[slot] = self.generation
+                return self.depths[slot], self.flags[slot], self.values[slot], self.moves[slot]
+
+        return None
+
+    def store(self, key: int, depth: int, flag: int, value: int, move: int):
+        '''Stores the result of searching the position with the given hash'''
+        slot = (key % self.num_buckets) * TranspositionTable.SLOTS_PER_BUCKET
+
+        # The depth-preferred slot is only replaced by deeper (or equally deep) searches of the current
+        # generation, unless it holds the same position or an entry from a previous search
+        if self.keys[slot] != key and self.depths[slot] > depth and self.generations[slot] == self.generation:
+            slot += 1
+
+        self.keys[slot] = key
+        self.values[slot] = value
+        self.depths[slot] = depth
+        self.flags[slot] = flag
+        self.generations[slot] = self.generation
+        self.moves[slot] = move
+
+    def usage(self) -> float:
+        '''Returns the fraction of slots in use'''
+        return sum(1 for depth in self.depths if depth >= 0) / len(self.depths)
+
+# Moves are stored in files (such as the opening book) as integers that don't depend on the board size: the move type
+# (1 to 5, 0 is no move), the square, the direction and, for split stacks, the number of pieces left behind, the number
+# carried and where the carried pieces are split
+move_types = [None, PlaceFlat, PlaceWall, PlaceCap, MovePiece, SplitStack]
+move_directions = list(directions.values())
+
+def pack_move(move) -> int:
+    '''Encodes a move (or None) as an integer'''
+    if move is None:
+        return 0
+
+    code = move_types.index(type(move)) | (move.pos.row * 8 + move.pos.col) << 3
+
+    if isinstance(move, (MovePiece, SplitStack)):
+        code |= move_directions.index(move.direction) << 9
+
+    if isinstance(move, SplitStack):
+        carry, splits = 0, 0
+        for num_pieces in move.split[1:-1]:
+            carry += num_pieces
+            splits |= 1 << (carry - 1)
+        carry += move.split[-1]
+
+        code |= move.split[0] << 11 | carry << 18 | splits << 22
+
+    return code
+
+def unpack_move(code: int):
+    '''Decodes a move encoded by pack_move'''
+    if code == 0:
+        return None
+
+    move_type = move_types[code & 0x7]
+    pos = Position((code >> 3 & 0x3F) // 8, (code >> 3 & 0x3F) % 8)
+
+    if move_type is SplitStack:
+        carry, splits = code >> 18 & 0xF, code >> 22
+        split = [code >> 11 & 0x7F]
+        num_pieces = 0
+        for i in range(carry):
+            num_pieces += 1
+            if splits >> i & 1 or i == carry - 1:
+                split.append(num_pieces)
+                num_pieces = 0
+        return SplitStack(pos, move_directions[code >> 9 & 0x3], tuple(split))
+
+    if move_type is MovePiece:
+        return MovePiece(pos, move_directions[code >> 9 & 0x3])
+
+    return move_type(pos)
+
+class SharedTranspositionTable:
+    '''
+    Transposition table stored in a shared memory block, so that the worker processes of a parallel search
+    can use the results of each other's searches. It has the same interface and replacement scheme as
+    TranspositionTable. Entries are written without locks: each slot holds two data words and the XOR of
+    the key with both of them, so an entry that was partially overwritten by another process (or that
+    belongs to a different position) fails the key verification and is treated as a miss. The move word holds
+    the move code plus one (see tak.MoveTable), so that an empty word is NO_MOVE.
+
+    The process that creates the table owns it (and its generation counter), while the workers attach to
+    it by name. The table must be closed by every process that uses it.
+    '''
+
+    # Each slot is made of three 64-bit words: the verification word and the two data words
+    WORDS_PER_SLOT = 3
+    SLOTS_PER_BUCKET = 2
+
+    # Offset added to the values, which are stored as unsigned 32-bit numbers
+    VALUE_OFFSET = 2**31
+
+    # The generation takes the 22 highest bits of the data word (after the value, the depth and the flag), so it
+    # only wraps around after about four million searches
+    GENERATION_SHIFT = 42
+    GENERATION_MASK = 0x3FFFFF
+
+    def __init__(self, size_mb: float = 16, name: str = None):
+        slot_size = SharedTranspositionTable.WORDS_PER_SLOT * 8
+        self.num_buckets = max(1, int(size_mb * 2**20) // (slot_size * SharedTranspositionTable.SLOTS_PER_BUCKET))
+        size = 8 + self.num_buckets * SharedTranspositionTable.SLOTS_PER_BUCKET * slot_size
+
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+
+        # The first word holds the generation, followed by the slots
+        self.words = self.memory.buf.cast('Q')
+        if self.owner:
+            self.clear()
+
+    @property
+    def name(self) -> str:
+        '''Name used by other processes to attach to the table'''
+        return self.memory.name
+
+    @property
+    def generation(self) -> int:
+        return self.words[0]
+
+    def close(self):
+        '''Detaches from the shared memory block (which is removed when the owner closes it)'''
+        self.words.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def new_search(self):
+        '''Starts a new generation. Only the owner of the table starts new searches, so this does nothing in the workers'''
+        if self.owner:
+            self.words[0] = (self.words[0] + 1) & SharedTranspositionTable.GENERATION_MASK
+
+    def clear(self):
+        '''Removes every entry from the table'''
+        self.memory.buf[:] = bytes(len(self.memory.buf))
+
+    def probe(self, key: int):
+        '''Returns the (depth, flag, value, move) entry stored for the position with the given hash, or None'''
+        words = self.words
+        index = 1 + (key % self.num_buckets) * SharedTranspositionTable.SLOTS_PER_BUCKET * SharedTranspositionTable.WORDS_PER_SLOT
+
+        for index in (index, index + SharedTranspositionTable.WORDS_PER_SLOT):
+            data, move = words[index + 1], words[index + 2]
+
+            # Empty slots have no data (stored depths are offset by one)
+            if data and words[index] ^ data ^ move == key:
+                # Entries that are still useful are kept from aging. If another process overwrites the slot meanwhile,
+                # the mixed words fail the verification, which only loses the entry
+                generation = words[0]
+                if data >> SharedTranspositionTable.GENERATION_SHIFT != generation:
+                    refreshed = data & (1 << SharedTranspositionTable.GENERATION_SHIFT) - 1 | generation << SharedTranspositionTable.GENERATION_SHIFT
+                    words[index + 1] = refreshed
+                    words[index] = key ^ refreshed ^ move
+
+                return (data >> 32 & 0xFF) - 1, data >> 40 & 0x3, (data & 0xFFFFFFFF) - SharedTranspositionTable.VALUE_OFFSET, move - 1
+
+        return None
+
+    def store(self, key: int, depth: int, flag: int, value: int, move: int):
+        '''Stores the result of searching the position with the given hash'''
+        words = self.words
+        generation = words[0]
+        index = 1 + (key % self.num_buckets) * SharedTranspositionTable.SLOTS_PER_BUCKET * SharedTranspositionTable.WORDS_PER_SLOT
+
+        # The depth-preferred slot is only replaced by deeper (or equally deep) searches of the current
+        # generation, unless it holds the same position or an entry from a previous search
+        data = words[index + 1]
+        if data and words[index] ^ data ^ words[index + 2] != key and (data >> 32 & 0xFF) - 1 > depth and data >> SharedTranspositionTable.GENERATION_SHIFT == generation:
+            index += SharedTranspositionTable.WORDS_PER_SLOT
+
+        data = (value + SharedTranspositionTable.VALUE_OFFSET) | (depth + 1) << 32 | flag << 40 | generation << SharedTranspositionTable.GENERATION_SHIFT
+        move += 1
+
+        words[index + 1] = data
+        words[index + 2] = move
+        words[index] = key ^ data ^ move
+
+    def usage(self) -> float:
+        '''Returns the fraction of slots in use'''
+        num_slots = self.num_buckets * SharedTranspositionTable.SLOTS_PER_BUCKET
+        return sum(1 for slot in range(num_slots) if self.words[1 + slot * SharedTranspositionTable.WORDS_PER_SLOT + 1]) / num_slots
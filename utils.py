@@ -1,42 +1,74 @@
-
 class Position:
-    def __init__(self, row: int, col: int):
-        self.row = row
-        self.col = col
+    '''
+    Immutable pair of coordinates (a square of the board or a direction). Positions are interned: every position
+    in the range of the board and of the directions and squares next to it is a single shared object, so the
+    arithmetic below (used in every loop over the board) doesn't allocate new objects. The methods look positions up
+    with get_position, which is faster than calling Position.
+    '''
+
+    __slots__ = ('row', 'col')
+
+    def __new__(cls, row: int, col: int):
+        return get_position(row, col)
+
+    @staticmethod
+    def create(row: int, col: int):
+        '''Returns a new position (Position(row, col) returns the interned one when there is one)'''
+        position = object.__new__(Position)
+        object.__setattr__(position, 'row', row)
+        object.__setattr__(position, 'col', col)
+        return position
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Positions are immutable')
+
+    def __reduce__(self):
+        # Unpickled (and copied) positions are interned again
+        return Position, (self.row, self.col)
 
     def __repr__(self):
         return "(" + str(self.row) + ", " + str(self.col) + ")"
     
     def __eq__(self, other):
-        return self.row == other.row and self.col == other.col
+        return self is other or (self.row == other.row and self.col == other.col)
     
     def __hash__(self):
         return hash((self.row, self.col))
 
     def __add__(self, other):
-        return Position(self.row + other.row, self.col + other.col)
+        return get_position(self.row + other.row, self.col + other.col)
 
     def __sub__(self, other):
-        return Position(self.row - other.row, self.col - other.col)
+        return get_position(self.row - other.row, self.col - other.col)
     
     def scalar_mult(self, scalar: int):
-        return Position(self.row * scalar, self.col * scalar)
+        return get_position(self.row * scalar, self.col * scalar)
 
     def up(self):
-        return Position(self.row - 1, self.col)
+        return get_position(self.row - 1, self.col)
     
     def down(self):
-        return Position(self.row + 1, self.col)
+        return get_position(self.row + 1, self.col)
 
     def left(self):
-        return Position(self.row, self.col - 1)
+        return get_position(self.row, self.col - 1)
 
     def right(self):
-        return Position(self.row, self.col + 1)
+        return get_position(self.row, self.col + 1)
     
     def is_within_bounds(self, lower, upper) -> bool:
         return self.row >= lower and self.row <= upper and self.col >= lower and self.col <= upper
 
+# Range of the interned coordinates: the largest board and the positions reached by moving up to a board away from it
+INTERNED_MIN, INTERNED_MAX = -8, 16
+interned_positions = [[Position.create(row, col) for col in range(INTERNED_MIN, INTERNED_MAX)] for row in range(INTERNED_MIN, INTERNED_MAX)]
+
+def get_position(row: int, col: int) -> Position:
+    '''Returns the interned position with the given coordinates (or a new one, if they are outside of the interned range)'''
+    if INTERNED_MIN <= row < INTERNED_MAX and INTERNED_MIN <= col < INTERNED_MAX:
+        return interned_positions[row - INTERNED_MIN][col - INTERNED_MIN]
+    return Position.create(row, col)
+
 
 def get_partitions_with_leading_zero(num: int) -> set:
     '''
@@ -65,4 +97,160 @@ def get_partitions(num: int) -> set:
             answer.add((x, ) + y)
 
     partition_cache[num] = answer
-    return answer
\ No newline at end of file
+    return answer
+
+class SpreadTable:
+    '''
+    Precomputed ways of dropping the pieces carried from a stack, for a given board size. A player can
+    carry at most board_size pieces, and the pieces dropped on each square (at least one per square)
+    are given by a tuple, starting with the square closest to the stack.
+    '''
+
+    def __init__(self, board_size: int):
+        self.board_size = board_size
+
+        # spreads[carry][distance]: every way of dropping carry pieces over at most distance squares
+        # flattening[carry][distance]: every way of dropping carry pieces over exactly distance + 1 squares
+        # with a single piece (the capstone) on the last one, used when a capstone can flatten the wall
+        # found after distance free squares
+        self.spreads = [[[] for _ in range(board_size)] for _ in range(board_size + 1)]
+        self.flattening = [[[] for _ in range(board_size)] for _ in range(board_size + 1)]
+
+        for carry in range(1, board_size + 1):
+            for drops in sorted(get_partitions(carry)):
+                for distance in range(board_size):
+                    if len(drops) <= distance:
+                        self.spreads[carry][distance].append(drops)
+                    elif len(drops) == distance + 1 and drops[-1] == 1:
+                        self.flattening[carry][distance].append(drops)
+
+spread_table_cache = {}
+def get_spread_table(board_size: int) -> SpreadTable:
+    '''Returns the (cached) spread table for the given board size'''
+    if board_size not in spread_table_cache:
+        spread_table_cache[board_size] = SpreadTable(board_size)
+    return spread_table_cache[board_size]
+
+
+directions = {
+    'UP': Position(-1, 0),
+    'DOWN': Position(1, 0),
+    'LEFT': Position(0, -1),
+    'RIGHT': Position(0, 1)
+}
+
+# The board has 8 symmetries: the identity, three rotations (by 90, 180 and 270 degrees) and four reflections
+NUM_SYMMETRIES = 8
+
+def transform(pos: Position, last: int, symmetry: int) -> Position:
+    '''
+    Returns the image of a position under one of the symmetries of a board whose last row and column have index last.
+    With last = 0, the position is treated as a direction (only rotated or reflected).
+    '''
+    row, col = pos.row, pos.col
+    return [
+        Position(row, col), Position(col, last - row), Position(last - row, last - col), Position(last - col, row),
+        Position(row, last - col), Position(last - row, col), Position(col, row), Position(last - col, last - row)
+    ][symmetry]
+
+# Squares are numbered in row-major order, so square (row, col) corresponds to bit row * board_size + col of every mask.
+
+class Geometry:
+    '''Masks and lookup tables that only depend on the board size'''
+
+    def __init__(self, board_size: int):
+        n = board_size
+        self.board_size = n
+        self.full = (1 << (n * n)) - 1
+
+        self.rows = [((1 << n) - 1) << (row * n) for row in range(n)]
+        self.cols = [sum(1 << (row * n + col) for row in range(n)) for col in range(n)]
+        self.lines = self.rows + self.cols
+
+        self.first_col, self.last_col = self.cols[0], self.cols[-1]
+        self.first_row, self.last_row = self.rows[0], self.rows[-1]
+
+        self.positions = [Position(sq // n, sq % n) for sq in range(n * n)]
+
+        # Squares reachable from each square in each direction, ordered by distance
+        self.directions = list(directions.values())
+        self.rays = []
+        for direction in self.directions:
+            rays = []
+            for pos in self.positions:
+                ray = []
+                pos_to = pos + direction
+                while pos_to.is_within_bounds(0, n - 1):
+                    ray.append(pos_to.row * n + pos_to.col)
+                    pos_to = pos_to + direction
+                rays.append(ray)
+            self.rays.append(rays)
+
+        self.neighbours = [0] * (n * n)
+        for d in range(len(self.directions)):
+            for sq in range(n * n):
+                if self.rays[d][sq]:
+                    self.neighbours[sq] |= 1 << self.rays[d][sq][0]
+
+        # Symmetries of the board (rotations and reflections): symmetries[t][sq] is the square that sq is mapped
+        # to by symmetry t (0 is the identity) and inverse_symmetries[t] is the symmetry that undoes t
+        self.symmetries = []
+        for t in range(NUM_SYMMETRIES):
+            images = [transform(pos, n - 1, t) for pos in self.positions]
+            self.symmetries.append([image.row * n + image.col for image in images])
+
+        self.inverse_symmetries = []
+        for t in range(NUM_SYMMETRIES):
+            self.inverse_symmetries.append(next(u for u in range(NUM_SYMMETRIES)
+                if all(self.symmetries[u][image] == sq for sq, image in enumerate(self.symmetries[t]))))
+
+    def grow(self, mask: int) -> int:
+        '''Returns the mask extended by one square in every direction'''
+        n = self.board_size
+        return (mask | ((mask << 1) & ~self.first_col) | ((mask >> 1) & ~self.last_col) | (mask << n) | (mask >> n)) & self.full
+
+    def flood(self, mask: int, region: int) -> int:
+        '''Returns the squares of the region connected to the squares of the mask'''
+        mask &= region
+        while True:
+            grown = self.grow(mask) & region
+            if grown == mask:
+                return mask
+            mask = grown
+
+    def has_road(self, road: int) -> bool:
+        '''Checks if the squares in the mask connect two opposite edges of the board'''
+        for start, end in ((self.first_col, self.last_col), (self.first_row, self.last_row)):
+            reached = road & start
+
+            # Flood fill from one edge until the opposite edge is reached or the region stops growing
+            while reached:
+                if reached & end:
+                    return True
+
+                grown = self.grow(reached) & road
+                if grown == reached:
+                    break
+                reached = grown
+
+        return False
+
+    def road_threats(self, road: int, empty: int) -> int:
+        '''Returns the empty squares which would complete a road if they were added to the road squares'''
+        threats = 0
+
+        for start, end in ((self.first_col, self.last_col), (self.first_row, self.last_row)):
+            # A square completes a road if it touches both the part of the road connected to one edge
+            # and the part connected to the opposite edge (or is on the edge itself)
+            from_start = self.flood(start, road)
+            from_end = self.flood(end, road)
+            threats |= (self.grow(from_start) | start) & (self.grow(from_end) | end)
+
+        return threats & empty
+
+geometry_cache = {}
+def get_geometry(board_size: int) -> Geometry:
+    '''Returns the (cached) geometry for the given board size'''
+    if board_size not in geometry_cache:
+        geometry_cache[board_size] = Geometry(board_size)
+    return geometry_cache[board_size]
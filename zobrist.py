@@ -0,0 +1,35 @@
+import random
+
+# Zobrist hashing: every (square, height, piece) combination is assigned a random 64-bit number and the
+# hash of a position is the XOR of the numbers of all its pieces (plus the side to move and the first turn
+# flag). Since XOR is its own inverse, the hash can be updated incrementally when pieces are added,
+# removed or flattened, instead of being recomputed from the whole board.
+
+# Piece variants: white flat, wall and capstone followed by black flat, wall and capstone
+NUM_VARIANTS = 6
+
+class ZobristKeys:
+    '''Random keys for a given board size'''
+
+    def __init__(self, board_size: int, max_height: int, seed: int = 0):
+        # A fixed seed keeps hashes reproducible between runs (and between processes)
+        rng = random.Random(seed * 100 + board_size)
+
+        self.board_size = board_size
+        self.max_height = max_height
+
+        # Indexed by (square * max_height + height) * NUM_VARIANTS + variant
+        self.pieces = [rng.getrandbits(64) for _ in range(board_size * board_size * max_height * NUM_VARIANTS)]
+        self.black_to_move = rng.getrandbits(64)
+        self.first_turn = rng.getrandbits(64)
+
+    def piece(self, sq: int, height: int, variant: int) -> int:
+        '''Returns the key for the piece variant at the given height (0 is the bottom) of a square'''
+        return self.pieces[(sq * self.max_height + height) * NUM_VARIANTS + variant]
+
+keys_cache = {}
+def get_zobrist_keys(board_size: int, max_height: int) -> ZobristKeys:
+    '''Returns the (cached) Zobrist keys for the given board size'''
+    if board_size not in keys_cache:
+        keys_cache[board_size] = ZobristKeys(board_size, max_height)
+    return keys_cache[board_size]